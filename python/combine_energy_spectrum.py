@@ -8,6 +8,7 @@ import multiprocessing
 import numpy as np
 from joblib import Parallel, delayed
 
+import spectrum_series
 from json_functions import read_data_from_json
 from shell_functions import mkdir_p
 
@@ -17,7 +18,8 @@ EMIN = 1E-5
 EMAX = 1E3
 INCLUDE_BFIELDS = False
 
-def combine_energy_spectrum(run_dir, run_name, tframe, species='e'):
+def combine_energy_spectrum(run_dir, run_name, tframe, species='e',
+                            append_series=True):
     """Combine particle energy spectrum from different mpi_rank
 
     Args:
@@ -25,6 +27,12 @@ def combine_energy_spectrum(run_dir, run_name, tframe, species='e'):
         run_name: PIC simulation run name
         tframe: time frame
         species: 'e' for electrons, 'H' for ions
+        append_series: whether to append the spectrum to the time series
+            of the run. Set it to False when frames are combined in
+            parallel and appended by the caller.
+
+    Returns:
+        flog_tot: the combined spectrum
     """
     picinfo_fname = '../data/pic_info/pic_info_' + run_name + '.json'
     pic_info = read_data_from_json(picinfo_fname)
@@ -61,6 +69,25 @@ def combine_energy_spectrum(run_dir, run_name, tframe, species='e'):
     mkdir_p(fdir)
     fname = fdir + 'spectrum-' + species.lower() + '.' + str(tframe)
     flog_tot.tofile(fname)
+    if append_series:
+        append_spectrum_series(run_name, species, [tframe], [flog_tot])
+    return flog_tot
+
+
+def append_spectrum_series(run_name, species, tframes, fspects):
+    """Append combined spectra to the time series of one run
+
+    Args:
+        run_name: PIC simulation run name
+        species: 'e' for electrons, 'H' for ions
+        tframes: time frames
+        fspects: combined spectra of these time frames
+    """
+    fname = spectrum_series.series_name(run_name, species)
+    ebins = spectrum_series.log_ebins(EMIN, EMAX, NBINS)
+    spectrum_series.append_frames(fname, tframes, np.asarray(fspects),
+                                  ebins=ebins, emin=EMIN, emax=EMAX,
+                                  normalization='dN/dE')
 
 
 def get_cmd_args():
@@ -85,8 +112,11 @@ def get_cmd_args():
 def process_input(run_dir, run_name, tframe):
     """process one time frame"""
     print("Time frame: %d" % tframe)
-    combine_energy_spectrum(run_dir, run_name, tframe, species='e')
-    combine_energy_spectrum(run_dir, run_name, tframe, species='h')
+    fe = combine_energy_spectrum(run_dir, run_name, tframe, species='e',
+                                 append_series=False)
+    fh = combine_energy_spectrum(run_dir, run_name, tframe, species='h',
+                                 append_series=False)
+    return (fe, fh)
 
 
 def main():
@@ -99,10 +129,15 @@ def main():
     if args.multi_frames:
         ncores = multiprocessing.cpu_count()
         tframes = range(pic_info.ntf)
-        Parallel(n_jobs=ncores)(delayed(process_input)(run_dir,
-                                                       run_name,
-                                                       tframe)
-                                for tframe in tframes)
+        fdata = Parallel(n_jobs=ncores)(delayed(process_input)(run_dir,
+                                                               run_name,
+                                                               tframe)
+                                        for tframe in tframes)
+        # HDF5 does not support concurrent writers, so append here
+        append_spectrum_series(run_name, 'e', tframes,
+                               [fspect[0] for fspect in fdata])
+        append_spectrum_series(run_name, 'H', tframes,
+                               [fspect[1] for fspect in fdata])
     else:
         combine_energy_spectrum(run_dir, run_name,
                                 args.tframe, species=args.species)
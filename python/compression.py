@@ -31,9 +31,11 @@ from scipy.ndimage.filters import median_filter, gaussian_filter
 
 import palettable
 import pic_information
+import stencils
 from contour_plots import find_closest, plot_2d_contour, read_2d_fields
 from dolointerpolation import MultilinearInterpolator
 from energy_conversion import read_data_from_json, read_jdote_data
+from frame_window import FrameWindow, gda_frame_reader
 from particle_compression import read_fields, read_hydro_velocity_density
 from runs_name_path import ApJ_long_paper_runs
 from serialize_json import data_to_json, json_to_data
@@ -2136,9 +2138,8 @@ def calc_compression(run_dir, pic_info):
     x, z, uix = read_2d_fields(pic_info, fname, **kwargs)
     fname = run_dir + 'data-ave/uiz-ave_' + str(tindex) + '.gda'
     x, z, uiz = read_2d_fields(pic_info, fname, **kwargs)
-    divu = np.zeros((nz, nx))
-    divu[:nz-1, :nx-1] = np.diff(uix, axis=1)[:nz-1, :nx-1] / dx
-    divu[:nz-1, :nx-1] += np.diff(uiz, axis=0)[:nz-1, :nx-1] / dz
+    stencil = stencils.Stencil(uix.shape, {"dx": dx, "dz": dz})
+    divu = stencil.divergence([uix, None, uiz], shift=1)
     ng = 5
     kernel = np.ones((ng, ng)) / float(ng * ng)
     divu = signal.convolve2d(divu, kernel, 'same')
@@ -2889,6 +2890,66 @@ def calc_jpolar_dote(pic_info, current_time, run_dir, species):
     return jpolar_dote_tot
 
 
+def calc_jpolar_dote_series(pic_info, run_dir, run_name, species, tframes):
+    """Calculate the energy conversion due to polarization drift (inertial
+    term) for consecutive time frames, reading each frame only once
+
+    The time derivative of the bulk 4-velocity is the centered difference
+    between the neighbouring frames, which should be evenly spaced. The
+    results are saved in ../data/jpolar_dote/ for the plotting functions.
+    """
+    varnames = ["ex", "ey", "ez", "bx", "by", "bz", "n" + species]
+    varnames += ["v" + species + comp for comp in ["x", "y", "z"]]
+    varnames += ["u" + species + comp for comp in ["x", "y", "z"]]
+    tframes = list(tframes)
+    tsteps = np.unique(np.diff(tframes))
+    if len(tsteps) > 1 or (len(tsteps) == 1 and tsteps[0] <= 0):
+        raise ValueError("The time frames should be evenly spaced and increasing")
+    tstep = tsteps[0] if len(tsteps) else 1
+    read_frame = gda_frame_reader(run_dir + "data/", pic_info, varnames)
+    window = FrameWindow(read_frame, tframes,
+                         tstep * pic_info.fields_interval * pic_info.dtwpe)
+    pmass = 1.0 if species == 'e' else pic_info.mime
+    smime = math.sqrt(pic_info.mime)
+    dx = pic_info.dx_di * smime
+    dy = pic_info.dy_di * smime
+    dz = pic_info.dz_di * smime
+    dv = dx * dz if pic_info.ny == 1 else dx * dy * dz
+    sigma = 3
+    jpolar_dote = np.zeros(len(tframes))
+    stencil = None
+    for iframe, tframe in enumerate(window):
+        if stencil is None:
+            stencil = stencils.Stencil(window["ex"].shape,
+                                       {"dx": dx, "dy": dy, "dz": dz})
+            grad = stencil.empty(3)
+        ex = gaussian_filter(window["ex"], sigma)
+        ey = gaussian_filter(window["ey"], sigma)
+        ez = gaussian_filter(window["ez"], sigma)
+        bx, by, bz = window["bx"], window["by"], window["bz"]
+        ib2 = 1.0 / (bx**2 + by**2 + bz**2)
+        vexb = [(ey * bz - ez * by) * ib2,
+                (ez * bx - ex * bz) * ib2,
+                (ex * by - ey * bx) * ib2]
+        vel = [window["v" + species + comp] for comp in ["x", "y", "z"]]
+        tmp = np.zeros(ex.shape)
+        for icomp, comp in enumerate(["x", "y", "z"]):
+            var = "u" + species + comp
+            stencil.gradient(window[var], grad)
+            acc = window.ddt(var)
+            for idim in range(3):
+                acc += vel[idim] * grad[idim]
+            tmp += acc * vexb[icomp]
+        tmp *= window["n" + species] * pmass
+        jpolar_dote[iframe] = np.sum(tmp) * dv
+
+    fdir = '../data/jpolar_dote/'
+    mkdir_p(fdir)
+    fname = fdir + 'jpolar_dote_' + run_name + '_' + species + '.dat'
+    jpolar_dote.tofile(fname)
+    return jpolar_dote
+
+
 def calc_comperssional_heating(pic_info, current_time, run_dir, species):
     """Calculate the energy conversion due to compression 
     """
@@ -3102,14 +3163,14 @@ def calc_jdote_terms_multi(pic_info, run_dir, run_name, species='e'):
     """
     """
     ntf = pic_info.ntf
-    jdote = np.zeros((ntf, 2))
     # calc_jpolar_dote(pic_info, 30, run_dir, species)
     # calc_para_perp_heating(pic_info, 50, run_dir, species)
     # calc_comperssional_heating(pic_info, 30, run_dir, species)
-    for ct in range(ntf):
-        print(ct)
-        jdote[ct] = calc_jpolar_dote(pic_info, ct, run_dir, species)
-        # jdote[ct] = calc_para_perp_heating(pic_info, ct, run_dir, species)
+    calc_jpolar_dote_series(pic_info, run_dir, run_name, species, range(ntf))
+    # jdote = np.zeros((ntf, 2))
+    # for ct in range(ntf):
+    #     print(ct)
+    #     jdote[ct] = calc_para_perp_heating(pic_info, ct, run_dir, species)
 
     # # var = 'jpolar_dote'
     # var = 'jpara_perp_dote'
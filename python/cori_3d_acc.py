@@ -25,6 +25,7 @@ from scipy.ndimage.filters import median_filter, gaussian_filter
 
 import fitting_funcs
 import pic_information
+import stencils
 from contour_plots import read_2d_fields
 from dolointerpolation import MultilinearInterpolator
 from joblib import Parallel, delayed
@@ -792,12 +793,8 @@ def calc_vexb_kappa_2d(plot_config):
     bx = bx * ib
     by = by * ib
     bz = bz * ib
-    kappax = (bx * np.gradient(bx, axis=1) / dx_de +
-              bz * np.gradient(bx, axis=0) / dz_de)
-    kappay = (bx * np.gradient(by, axis=1) / dx_de +
-              bz * np.gradient(by, axis=0) / dz_de)
-    kappaz = (bx * np.gradient(bz, axis=1) / dx_de +
-              bz * np.gradient(bz, axis=0) / dz_de)
+    stencil = stencils.Stencil(bx.shape, {"dx": dx_de, "dz": dz_de})
+    kappax, kappay, kappaz = stencil.curvature([bx, by, bz])
     vexb_x = (ey * bz - ez * by) * ib
     vexb_y = (ez * bx - ex * bz) * ib
     vexb_z = (ex * by - ey * bx) * ib
@@ -849,12 +846,8 @@ def vkappa_dist_2d(plot_config):
     bx = bx * ib
     by = by * ib
     bz = bz * ib
-    kappax = (bx * np.gradient(bx, axis=1) / dx_de +
-              bz * np.gradient(bx, axis=0) / dz_de)
-    kappay = (bx * np.gradient(by, axis=1) / dx_de +
-              bz * np.gradient(by, axis=0) / dz_de)
-    kappaz = (bx * np.gradient(bz, axis=1) / dx_de +
-              bz * np.gradient(bz, axis=0) / dz_de)
+    stencil = stencils.Stencil(bx.shape, {"dx": dx_de, "dz": dz_de})
+    kappax, kappay, kappaz = stencil.curvature([bx, by, bz])
 
     fname = pic_run_dir + "data/vex.gda"
     x, z, vex = read_2d_fields(pic_info, fname, **kwargs)
@@ -27,6 +27,10 @@ from scipy.optimize import curve_fit
 
 import fitting_funcs
 import pic_information
+import tracer_export
+import tracer_extract
+import tracer_index
+import tracer_periodic
 from contour_plots import read_2d_fields
 from joblib import Parallel, delayed
 from json_functions import read_data_from_json
@@ -94,6 +98,38 @@ def read_particle_data(iptl, particle_tags, pic_info, fh):
     return (ptl, sz)
 
 
+def extract_particle_data(tag, pic_run_dir, pic_info):
+    """Extract the data of one particle from the time-major tracer files
+
+    The tag index of the tracer files has to be built already (see
+    get_unique_tracers). The data has the same format as the one from
+    read_particle_data.
+
+    Args:
+        tag: tracer tag
+        pic_run_dir: PIC run directory
+        pic_info: PIC simulation information
+    """
+    fname_index = pic_run_dir + 'tracer/tracer2_index.h5'
+    cache_dir = '../data/cori_3d/traj_cache/'
+    extractor = tracer_extract.TrajectoryExtractor(fname_index, cache_dir)
+    varnames = extractor.available_varnames()
+    tindices, trajs = extractor.extract([tag], varnames)
+    extractor.close()
+    ptl = tracer_extract.trajectory_dict(trajs[tag], varnames)
+    sz, = ptl['q'].shape
+    ptl['gamma'] = np.sqrt(ptl['Ux']**2 + ptl['Uy']**2 + ptl['Uz']**2 + 1)
+    ptl['t'] = tindices * pic_info.dtwpe
+    index = np.nonzero(ptl['q'])
+    for dset in ptl:
+        ptl[dset] = ptl[dset][index]
+    smime = math.sqrt(pic_info.mime)
+    ptl['dX'] /= smime
+    ptl['dY'] /= smime
+    ptl['dZ'] /= smime
+    return (ptl, sz)
+
+
 def transfer_to_h5part(plot_config):
     """Transfer current HDF5 file to H5Part format
 
@@ -141,29 +177,7 @@ def adjust_pos(pos, length):
         pos: the position along one axis
         length: the box size along that axis
     """
-    crossings = []
-    offsets = []
-    offset = 0
-    nt, = pos.shape
-    pos_b = np.zeros(nt)
-    pos_b = np.copy(pos)
-    for i in range(nt - 1):
-        if (pos[i] - pos[i + 1] > 0.1 * length):
-            crossings.append(i)
-            offset += length
-            offsets.append(offset)
-        if (pos[i] - pos[i + 1] < -0.1 * length):
-            crossings.append(i)
-            offset -= length
-            offsets.append(offset)
-    nc = len(crossings)
-    if nc > 0:
-        crossings = np.asarray(crossings)
-        offsets = np.asarray(offsets)
-        for i in range(nc - 1):
-            pos_b[crossings[i] + 1:crossings[i + 1] + 1] += offsets[i]
-        pos_b[crossings[nc - 1] + 1:] += offsets[nc - 1]
-    return pos_b
+    return tracer_periodic.unwrap_positions(pos, length)
 
 
 def plot_trajectory(plot_config, show_plot=True):
@@ -176,11 +190,16 @@ def plot_trajectory(plot_config, show_plot=True):
     picinfo_fname = '../data/pic_info/pic_info_' + pic_run + '.json'
     pic_info = read_data_from_json(picinfo_fname)
     qm = -1 if species == 'e' else 1.0/pic_info.mime
-    fname = "../data/trajectory/" + pic_run + "/" + plot_config["traj_file"]
-    fh = h5py.File(fname, 'r')
-    particle_tags = list(fh.keys())
-    nptl = len(particle_tags)
-    ptl, sz = read_particle_data(pindex, particle_tags, pic_info, fh)
+    if plot_config.get("tracer_tag") is not None:
+        ptl, sz = extract_particle_data(plot_config["tracer_tag"],
+                                        pic_run_dir, pic_info)
+    else:
+        fname = ("../data/trajectory/" + pic_run + "/" +
+                 plot_config["traj_file"])
+        fh = h5py.File(fname, 'r')
+        particle_tags = list(fh.keys())
+        nptl = len(particle_tags)
+        ptl, sz = read_particle_data(pindex, particle_tags, pic_info, fh)
     smime = math.sqrt(pic_info.mime)
     lx_de = pic_info.lx_di * smime
     ly_de = pic_info.ly_di * smime
@@ -798,6 +817,24 @@ def trans_trajectory_csv(plot_config):
     df.to_csv(fname, mode='w', index=True, header=keys)
 
 
+def export_trajectories(plot_config):
+    """Export all trajectories in a trajectory file for visualization
+    """
+    pic_run = plot_config["pic_run"]
+    picinfo_fname = '../data/pic_info/pic_info_' + pic_run + '.json'
+    pic_info = read_data_from_json(picinfo_fname)
+    fname = "../data/trajectory/" + pic_run + "/" + plot_config["traj_file"]
+    fmt = plot_config["export_fmt"]
+    smime = math.sqrt(pic_info.mime)
+    config = {"tstride": plot_config["tstride"],
+              "pos_scale": [1.0 / smime] * 3,
+              "lengths": [pic_info.lx_di, pic_info.ly_di, pic_info.lz_di]}
+    fdir = '../data/cori_3d/tracer_' + fmt + '/' + pic_run + '/'
+    mkdir_p(fdir)
+    fbase = fdir + os.path.splitext(plot_config["traj_file"])[0]
+    tracer_export.export_tracers(fname, fbase, fmt, config)
+
+
 def get_crossings(pos, length):
     """Get the crossing points along one axis
 
@@ -805,26 +842,7 @@ def get_crossings(pos, length):
         pos: the position along one axis
         length: the box size along that axis
     """
-    crossings = []
-    offsets = []
-    offset = 0
-    nt, = pos.shape
-    pos_b = np.zeros(nt)
-    pos_b = np.copy(pos)
-    for i in range(nt-1):
-        if (pos[i]-pos[i+1] > 0.1*length):
-            crossings.append(i)
-            offset += length
-            offsets.append(offset)
-        if (pos[i]-pos[i+1] < -0.1*length):
-            crossings.append(i)
-            offset -= length
-            offsets.append(offset)
-    nc = len(crossings)
-    if nc > 0:
-        crossings = np.asarray(crossings)
-        offsets = np.asarray(offsets)
-    return (nc, crossings, offsets)
+    return tracer_periodic.get_crossings(pos, length)
 
 
 def plot_traj_pub(plot_config, show_plot=True):
@@ -1427,49 +1445,23 @@ def get_unique_tracers(plot_config, show_plot=True):
         pmass = pic_info.mime
         pcharge = 1.0
 
-    # Particle tags at the initial time step
-    fname = tracer_dir + 'T.0' + '/tracers.h5p'
-    with h5py.File(fname, 'r') as fh:
-        group = fh['Step#0']
-        subgroup = group['electron_tracer']
-        dset = subgroup['q']
-        qinit = np.zeros(dset.shape, dtype=dset.dtype)
-        dset.read_direct(qinit)
-
-    nptl, = qinit.shape
-    mask = np.ones(nptl, dtype=bool)
-
-    # Get particle tags in all time steps
-    for tframe in tframes:
-        print("Time frame: %d" % tframe)
-        fname = tracer_dir + 'T.' + str(tframe) + '/tracers.h5p'
-        with h5py.File(fname, 'r') as fh:
-            group = fh['Step#' + str(tframe)]
-            subgroup = group['electron_tracer']
-            dset = subgroup['q']
-            qtag = np.zeros(dset.shape, dtype=dset.dtype)
-            dset.read_direct(qtag)
-            mask = np.logical_and(mask, np.in1d(qinit, qtag))
-    qunique = qinit[mask]
+    # Tag index of all time steps. It is rebuilt when the steps change.
+    step_config = {"tracer_dir": tracer_dir,
+                   "fname_pattern": "T.{tindex}/tracers.h5p",
+                   "group_pattern": "Step#{tindex}/electron_tracer"}
+    fname_index = pic_run_dir + 'tracer/tracer2_index.h5'
+    if not tracer_index.index_is_current(fname_index, tframes):
+        tracer_index.build_tracer_index(step_config, tframes, fname_index)
+    tracer_idx = tracer_index.TracerIndex(fname_index, cache_steps=False)
+    qunique = tracer_idx.survivors(tframes)
 
     # Get these tracers and save them to new files
     ofile_name = 'electron_tracer_qtag_sorted.h5p'
+    nptl_new, = qunique.shape
     for tframe in tframes:
         print("Time frame: %d" % tframe)
-        fname = tracer_dir + 'T.' + str(tframe) + '/tracers.h5p'
-        ptl = {}
-        with h5py.File(fname, 'r') as fh:
-            group = fh['Step#' + str(tframe)]
-            subgroup = group["electron_tracer"]
-            for dset_name in subgroup:
-                dset = subgroup[dset_name]
-                ptl[dset_name] = np.zeros(dset.shape, dtype=dset.dtype)
-                dset.read_direct(ptl[dset_name])
-        mask = np.in1d(ptl['q'], qunique)
-        nptl_new = np.sum(mask)
-        ptl_new = {}
-        for key in ptl:
-            ptl_new[key] = ptl[key][mask]
+        rows = tracer_idx.rows(tframe, qunique)
+        ptl_new = tracer_idx.read_rows(tframe, rows)
         out_dir = tracer_out_dir + 'T.' + str(tframe) + '/'
         mkdir_p(out_dir)
         fname = out_dir + ofile_name
@@ -1477,6 +1469,7 @@ def get_unique_tracers(plot_config, show_plot=True):
             group = fh.create_group('Step#' + str(tframe))
             for key in ptl_new:
                 group.create_dataset(key, (nptl_new, ), data=ptl_new[key])
+    tracer_idx.close()
 
 
 def get_cmd_args():
@@ -1508,6 +1501,8 @@ def get_cmd_args():
                         help='particle tracer ID')
     parser.add_argument('--nptl', action="store", default='1000', type=int,
                         help='Total number of particle tracers')
+    parser.add_argument('--tracer_tag', action="store", default=None, type=int,
+                        help='tracer tag to extract from the tracer files')
     parser.add_argument('--traj_file', action="store", default='electrons_200.h5p',
                         help='Trajectory file name')
     parser.add_argument('--tint', action="store", default='20', type=int,
@@ -1533,6 +1528,12 @@ def get_cmd_args():
                         help='whether to transfer trajectory to csv format')
     parser.add_argument('--trans_traj_h5part', action="store_true", default=False,
                         help='whether to transfer trajectory to h5part format')
+    parser.add_argument('--export_traj', action="store_true", default=False,
+                        help='whether to export all trajectories in a file')
+    parser.add_argument('--export_fmt', action="store", default='vtu',
+                        help='export format: vtu, h5part or csv')
+    parser.add_argument('--tstride', action="store", default='1', type=int,
+                        help='time stride of the exported trajectories')
     parser.add_argument('--piecewise_traj', action="store_true", default=False,
                         help="whether to get piecewise trajectory")
     parser.add_argument('--piecewise_traj_cross', action="store_true", default=False,
@@ -1572,6 +1573,8 @@ def analysis_single_frames(plot_config, args):
         trans_trajectory_h5part(plot_config)
     elif args.trans_traj_csv:
         trans_trajectory_csv(plot_config)
+    elif args.export_traj:
+        export_trajectories(plot_config)
     elif args.plot_traj_pub:
         plot_traj_pub(plot_config)
     elif args.traj_xz_xgamma:
@@ -1617,9 +1620,12 @@ def main():
     plot_config["species"] = args.species
     plot_config["traj_file"] = args.traj_file
     plot_config["iptl"] = args.iptl
+    plot_config["tracer_tag"] = args.tracer_tag
     plot_config["nptl"] = args.nptl
     plot_config["bg"] = args.bg
     plot_config["tint"] = args.tint
+    plot_config["export_fmt"] = args.export_fmt
+    plot_config["tstride"] = args.tstride
     if args.multi_frames:
         analysis_multi_frames(plot_config, args)
     else:
@@ -0,0 +1,214 @@
+"""
+Magnetic curvature and vexb dot curvature of 3D runs out of core
+
+A time frame is split into slabs along z. Each slab is read from the
+memory-mapped .gda files with a halo of one cell on each side, which is
+what the centered derivatives of the curvature need, and the slabs are
+processed by a pool of processes. The outputs are
+    kappa_dist: histogram of |kappa| in logarithmic bins, saved as
+        [kmin, kmax, nbins, hist[nbins]]
+    vexb_kappa_dist: histogram of vexb.kappa in symmetric logarithmic bins
+        (2*nbins + 2 bins, see vkappa_bins), saved as
+        [vkmin, vkmax, nbins, hist[2*nbins+2]]
+    kappa, vexb_kappa: optional full-volume .gda files with the same layout
+        as the input fields
+The histogram files have the format read by power_law_index.plot_vexb_kappa,
+so the same plots work for 2D and 3D runs.
+"""
+from __future__ import print_function
+
+import argparse
+import math
+import multiprocessing
+import os
+
+import numpy as np
+from joblib import delayed
+
+import derived_expr
+from json_functions import read_data_from_json
+from parallel_functions import bounded_parallel
+from shell_functions import mkdir_p
+
+VOLUME_VARS = ["kappa", "vexb_kappa"]
+
+
+def kappa_bins(kmin=1E-6, kmax=1E2, nbins=80):
+    """Logarithmic bins of |kappa|
+    """
+    return np.logspace(math.log10(kmin), math.log10(kmax), nbins+1)
+
+
+def vkappa_bins(vkmin=1E-5, vkmax=1E3, nbins=80):
+    """Symmetric logarithmic bins of vexb.kappa, with a bin across 0
+    """
+    vkbins = np.zeros(2*nbins+3)
+    fbins = np.logspace(math.log10(vkmin), math.log10(vkmax), nbins+1)
+    vkbins[:nbins+1] = -fbins[::-1]
+    vkbins[nbins+2:] = fbins
+    return vkbins
+
+
+def gda_source(run_dir, pic_info, tframe):
+    """Source of the fields of one time frame
+
+    The fields are in data/bx.gda including all time frames or in
+    data/bx_<tindex>.gda for each time frame.
+    """
+    fdir = run_dir + "data/"
+    nx, ny, nz = pic_info.nx, pic_info.ny, pic_info.nz
+    if os.path.isfile(fdir + "bx.gda"):
+        return derived_expr.GdaSource(fdir, nx, ny, nz).frame(tframe)
+    tindex = tframe * pic_info.fields_interval
+    return derived_expr.GdaSource(fdir, nx, ny, nz, tindex=tindex)
+
+
+def slab_curvature(source, params, zs, ze, bins, save_volume=False):
+    """Curvature and its histograms of the slab [zs, ze) along z
+
+    Args:
+        source: GdaSource of the time frame
+        params: grid spacings dx, dy, dz
+        zs, ze: the slab along z
+        bins: kappa bins and vexb.kappa bins
+        save_volume: whether to write the slab into the volume files
+
+    Returns:
+        kdist, vkdist: histograms of |kappa| and vexb.kappa
+    """
+    names = ["kappa_x", "kappa_y", "kappa_z", "vexb_kappa"]
+    tile = derived_expr.evaluate_tile(source, names, params, zs, ze)
+    tile["kappa"] = derived_expr.evaluate_expr(
+        "sqrt(kappa_x**2 + kappa_y**2 + kappa_z**2)", tile, {})
+    kdist, _ = np.histogram(tile["kappa"], bins=bins[0])
+    vkdist, _ = np.histogram(tile["vexb_kappa"], bins=bins[1])
+    if save_volume:
+        nz, ny, nx = source.shape
+        offset = source.frame_offset() + zs * nx * ny
+        for var in VOLUME_VARS:
+            fdata = np.memmap(source.file_name(var), dtype=np.float32,
+                              mode='r+', offset=offset * 4,
+                              shape=(ze - zs, ny, nx))
+            fdata[:] = tile[var]
+            fdata.flush()
+            del fdata
+    return kdist, vkdist
+
+
+def calc_curvature(source, params, bins, save_volume=False, max_mem=2**32,
+                   ncores=None):
+    """Histograms (and volumes) of the curvature of one time frame
+
+    Args:
+        source: GdaSource of the time frame
+        params: grid spacings dx, dy, dz
+        bins: kappa bins and vexb.kappa bins
+        save_volume: whether to save kappa and vexb_kappa in .gda files
+            next to the input fields
+        max_mem: memory cap of all processes in bytes
+        ncores: number of processes
+
+    Returns:
+        kdist, vkdist: histograms of |kappa| and vexb.kappa
+    """
+    if ncores is None:
+        ncores = multiprocessing.cpu_count()
+    nz, ny, nx = source.shape
+    names = ["kappa_x", "kappa_y", "kappa_z", "vexb_kappa"]
+    nz_slab = derived_expr.tile_size(source, names, max_mem, ncores)
+    if save_volume:
+        fsize = (source.frame_offset() + nx * ny * nz) * 4
+        for var in VOLUME_VARS:
+            with open(source.file_name(var), 'ab') as fh:
+                if fh.tell() < fsize:
+                    fh.truncate(fsize)
+    slabs = [(zs, min(zs + nz_slab, nz)) for zs in range(0, nz, nz_slab)]
+    kdist = np.zeros(len(bins[0]) - 1)
+    vkdist = np.zeros(len(bins[1]) - 1)
+    res = bounded_parallel(
+        (delayed(slab_curvature)(source, params, zs, ze, bins, save_volume)
+         for zs, ze in slabs), ncores)
+    for kdist_slab, vkdist_slab in res:
+        kdist += kdist_slab
+        vkdist += vkdist_slab
+    return kdist, vkdist
+
+
+def save_dist(fname, vmin, vmax, nbins, dist):
+    """Save a histogram as [vmin, vmax, nbins, dist]
+    """
+    fdata = np.zeros(len(dist) + 3)
+    fdata[0] = vmin
+    fdata[1] = vmax
+    fdata[2] = nbins
+    fdata[3:] = dist
+    fdata.tofile(fname)
+
+
+def calc_vexb_kappa(run_dir, pic_run, pic_info, tframe, save_volume=False,
+                    max_mem=2**32, ncores=None):
+    """Curvature distributions of one time frame
+
+    The histograms are saved in ../data/power_law_index/kappa_dist/ and
+    ../data/power_law_index/vexb_kappa_dist/.
+
+    Args:
+        run_dir: PIC run directory with the .gda files in data/
+        pic_run: PIC run name
+        pic_info: PIC simulation information
+        tframe: time frame
+        save_volume: whether to save the full-volume data
+        max_mem: memory cap of all processes in bytes
+        ncores: number of processes
+    """
+    kmin, kmax, vkmin, vkmax, nbins = 1E-6, 1E2, 1E-5, 1E3, 80
+    bins = [kappa_bins(kmin, kmax, nbins), vkappa_bins(vkmin, vkmax, nbins)]
+    source = gda_source(run_dir, pic_info, tframe)
+    params = derived_expr.get_params(pic_info)
+    kdist, vkdist = calc_curvature(source, params, bins, save_volume,
+                                   max_mem, ncores)
+    fdir = '../data/power_law_index/kappa_dist/' + pic_run + '/'
+    mkdir_p(fdir)
+    fname = fdir + 'kappa_dist_' + str(tframe) + '.dat'
+    save_dist(fname, kmin, kmax, nbins, kdist)
+    fdir = '../data/power_law_index/vexb_kappa_dist/' + pic_run + '/'
+    mkdir_p(fdir)
+    fname = fdir + 'vexb_kappa_dist_' + str(tframe) + '.dat'
+    save_dist(fname, vkmin, vkmax, nbins, vkdist)
+
+
+def get_cmd_args():
+    """Get command line arguments """
+    default_pic_run = '3D-Lx150-bg0.2-150ppc-2048KNL'
+    default_pic_run_dir = ('/net/scratch3/xiaocanli/reconnection/Cori_runs/' +
+                           default_pic_run + '/')
+    parser = argparse.ArgumentParser(
+        description='Magnetic curvature and vexb dot curvature of 3D runs')
+    parser.add_argument('--pic_run', action="store",
+                        default=default_pic_run, help='PIC run name')
+    parser.add_argument('--pic_run_dir', action="store",
+                        default=default_pic_run_dir, help='PIC run directory')
+    parser.add_argument('--tstart', action="store", default='0', type=int,
+                        help='starting time frame')
+    parser.add_argument('--tend', action="store", default='10', type=int,
+                        help='ending time frame')
+    parser.add_argument('--save_volume', action="store_true", default=False,
+                        help='whether to save kappa and vexb_kappa volumes')
+    parser.add_argument('--max_mem', action="store", default='4', type=float,
+                        help='memory cap in GB')
+    return parser.parse_args()
+
+
+def main():
+    """business logic for when running this module as the primary one!"""
+    args = get_cmd_args()
+    picinfo_fname = '../data/pic_info/pic_info_' + args.pic_run + '.json'
+    pic_info = read_data_from_json(picinfo_fname)
+    for tframe in range(args.tstart, args.tend + 1):
+        print("Time frame: %d" % tframe)
+        calc_vexb_kappa(args.pic_run_dir, args.pic_run, pic_info, tframe,
+                        args.save_volume, int(args.max_mem * 2**30))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,367 @@
+"""
+Registry of derived quantities evaluated lazily over tiles
+
+Each derived quantity is declared once with its inputs, which can be base
+fields (.gda files) or other derived quantities, and either
+    expr: an expression of the inputs, evaluated by numexpr when it is
+        installed (one fused pass without full-size temporaries), or
+    func: a function of the tile data, e.g. for spatial derivatives, with
+        halo: number of cells it needs on each side along z
+A request for several quantities is resolved into one evaluation order.
+Every base field is read once per tile and shared by all the quantities
+that need it, and the intermediate quantities only live for one tile.
+
+Arrays have the shape (nz, ny, nx) and tiles are slabs along z. The
+parameters (e.g. mime) and the grid spacings dx, dy, dz are passed in a
+dictionary and can be used in the expressions.
+"""
+from __future__ import print_function
+
+import argparse
+import math
+
+import numpy as np
+from joblib import delayed
+
+import stencils
+from json_functions import read_data_from_json
+from parallel_functions import bounded_parallel
+from shell_functions import mkdir_p
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+# file names of the base fields that are not valid Python names
+BASE_FILES = {}
+for species in ['e', 'i']:
+    for comp in ['xx', 'xy', 'xz', 'yy', 'yz', 'zz']:
+        BASE_FILES['p' + species + '_' + comp] = 'p' + species + '-' + comp
+
+
+def ddx(fdata, params, axis):
+    """Centered derivative along one axis of a tile, 0 for a flat axis
+    """
+    stencil = stencils.Stencil(fdata.shape, params)
+    return stencil.ddx(fdata, ['z', 'y', 'x'][axis])
+
+
+def curvature(comp):
+    """Magnetic curvature kappa = (b.grad)b along one direction
+    """
+    def func(env, params):
+        bcomp = env['bhat_' + comp]
+        return (env['bhat_x'] * ddx(bcomp, params, 2) +
+                env['bhat_y'] * ddx(bcomp, params, 1) +
+                env['bhat_z'] * ddx(bcomp, params, 0))
+    return func
+
+
+DERIVED = {
+    "absb": {"inputs": ["bx", "by", "bz"],
+             "expr": "sqrt(bx**2 + by**2 + bz**2)"},
+    "epara": {"inputs": ["ex", "ey", "ez", "bx", "by", "bz", "absb"],
+              "expr": "(ex*bx + ey*by + ez*bz) / absb"},
+    "eperp": {"inputs": ["ex", "ey", "ez", "epara"],
+              "expr": "sqrt(abs(ex**2 + ey**2 + ez**2 - epara**2))"},
+    "vexb_x": {"inputs": ["ey", "ez", "by", "bz", "absb"],
+               "expr": "(ey*bz - ez*by) / absb**2"},
+    "vexb_y": {"inputs": ["ex", "ez", "bx", "bz", "absb"],
+               "expr": "(ez*bx - ex*bz) / absb**2"},
+    "vexb_z": {"inputs": ["ex", "ey", "bx", "by", "absb"],
+               "expr": "(ex*by - ey*bx) / absb**2"},
+    "bhat_x": {"inputs": ["bx", "absb"], "expr": "bx / absb"},
+    "bhat_y": {"inputs": ["by", "absb"], "expr": "by / absb"},
+    "bhat_z": {"inputs": ["bz", "absb"], "expr": "bz / absb"},
+    "kappa_x": {"inputs": ["bhat_x", "bhat_y", "bhat_z"],
+                "func": curvature('x'), "halo": 1},
+    "kappa_y": {"inputs": ["bhat_x", "bhat_y", "bhat_z"],
+                "func": curvature('y'), "halo": 1},
+    "kappa_z": {"inputs": ["bhat_x", "bhat_y", "bhat_z"],
+                "func": curvature('z'), "halo": 1},
+    "vexb_kappa": {"inputs": ["vexb_x", "vexb_y", "vexb_z",
+                              "kappa_x", "kappa_y", "kappa_z"],
+                   "expr": "vexb_x*kappa_x + vexb_y*kappa_y + vexb_z*kappa_z"},
+    "vsingle_x": {"inputs": ["vex", "vix", "ne", "ni"],
+                  "expr": "(vex*ne + vix*ni*mime) / (ne + ni*mime)"},
+    "vsingle_y": {"inputs": ["vey", "viy", "ne", "ni"],
+                  "expr": "(vey*ne + viy*ni*mime) / (ne + ni*mime)"},
+    "vsingle_z": {"inputs": ["vez", "viz", "ne", "ni"],
+                  "expr": "(vez*ne + viz*ni*mime) / (ne + ni*mime)"},
+}
+
+for species in ['e', 'i']:
+    pname = 'p' + species
+    DERIVED[pname + "_para"] = {
+        "inputs": [pname + '_' + comp
+                   for comp in ['xx', 'xy', 'xz', 'yy', 'yz', 'zz']] +
+                  ["bx", "by", "bz", "absb"],
+        "expr": ("({0}_xx*bx**2 + {0}_yy*by**2 + {0}_zz*bz**2 + "
+                 "2*({0}_xy*bx*by + {0}_xz*bx*bz + {0}_yz*by*bz)) / "
+                 "absb**2").format(pname)}
+    DERIVED[pname + "_perp"] = {
+        "inputs": [pname + '_xx', pname + '_yy', pname + '_zz',
+                   pname + "_para"],
+        "expr": "0.5 * ({0}_xx + {0}_yy + {0}_zz - {0}_para)".format(pname)}
+
+
+def resolve(names):
+    """Evaluation order of the requested quantities
+
+    Returns:
+        order: derived quantities, each after its inputs
+        bases: base fields to read
+    """
+    order = []
+    bases = []
+
+    def visit(name):
+        if name in order or name in bases:
+            return
+        if name not in DERIVED:
+            bases.append(name)
+            return
+        for var in DERIVED[name]["inputs"]:
+            visit(var)
+        order.append(name)
+    for name in names:
+        visit(name)
+    return order, bases
+
+
+def total_halo(name):
+    """Number of cells along z needed on each side to evaluate a quantity
+    """
+    if name not in DERIVED:
+        return 0
+    halo = DERIVED[name].get("halo", 0)
+    return halo + max(total_halo(var) for var in DERIVED[name]["inputs"])
+
+
+def evaluate_expr(expr, env, params):
+    """Evaluate an expression of the tile data in one fused pass
+    """
+    local_dict = dict(params)
+    local_dict.update(env)
+    if numexpr is not None:
+        return numexpr.evaluate(expr, local_dict=local_dict)
+    namespace = {"sqrt": np.sqrt, "abs": np.abs, "__builtins__": {}}
+    return eval(expr, namespace, local_dict)
+
+
+class GdaSource(object):
+    def __init__(self, fdir, nx, ny, nz, tindex=None, tframe=0):
+        """Base fields in .gda files
+
+        Args:
+            fdir: directory of the .gda files
+            nx, ny, nz: grid sizes
+            tindex: time index in the file names, <var>_<tindex>.gda.
+                When it is None, <var>.gda includes all time frames.
+            tframe: time frame in the files including all time frames
+        """
+        self.fdir = fdir
+        self.shape = (nz, ny, nx)
+        self.tindex = tindex
+        self.tframe = tframe
+
+    def file_name(self, var):
+        fname = self.fdir + BASE_FILES.get(var, var)
+        if self.tindex is None:
+            return fname + '.gda'
+        return fname + '_' + str(self.tindex) + '.gda'
+
+    def frame_offset(self):
+        """Offset of the time frame in the files, in number of cells
+        """
+        nz, ny, nx = self.shape
+        return 0 if self.tindex is not None else self.tframe * nx * ny * nz
+
+    def frame(self, tframe):
+        """The same source at another time frame
+        """
+        nz, ny, nx = self.shape
+        return GdaSource(self.fdir, nx, ny, nz, self.tindex, tframe)
+
+    def read(self, var, zs, ze):
+        """Read the slab [zs, ze) along z of one base field
+        """
+        nz, ny, nx = self.shape
+        fdata = np.memmap(self.file_name(var), dtype=np.float32, mode='r',
+                          offset=(self.frame_offset() + zs * nx * ny) * 4,
+                          shape=(ze - zs, ny, nx))
+        return np.array(fdata)
+
+
+def evaluate_tile(source, names, params, zs, ze):
+    """Evaluate the requested quantities on the slab [zs, ze) along z
+
+    Args:
+        source: source of the base fields, e.g. GdaSource
+        names: requested quantities (derived or base)
+        params: parameters and grid spacings dx, dy, dz
+        zs, ze: the slab along z
+
+    Returns:
+        tile: dictionary of (ze - zs, ny, nx) arrays
+    """
+    order, bases = resolve(names)
+    nz = source.shape[0]
+    halo = max(total_halo(name) for name in names)
+    zs_h, ze_h = max(zs - halo, 0), min(ze + halo, nz)
+    env = {}
+    for var in bases:
+        env[var] = source.read(var, zs_h, ze_h)
+    for name in order:
+        recipe = DERIVED[name]
+        if "expr" in recipe:
+            env[name] = evaluate_expr(recipe["expr"], env, params)
+        else:
+            env[name] = recipe["func"](env, params)
+        # drop the intermediate quantities that are not needed any more
+        for var in recipe["inputs"]:
+            if var in names:
+                continue
+            if all(var not in DERIVED[later]["inputs"]
+                   for later in order[order.index(name)+1:]):
+                env.pop(var, None)
+    tile = {}
+    for name in names:
+        tile[name] = np.asarray(env[name][zs-zs_h:ze-zs_h], dtype=np.float32)
+    return tile
+
+
+def evaluate(source, names, params, nz_tile=None):
+    """Evaluate the requested quantities over the whole grid, tile by tile
+
+    Returns:
+        fields: dictionary of (nz, ny, nx) arrays
+    """
+    nz, ny, nx = source.shape
+    if nz_tile is None:
+        nz_tile = nz
+    fields = {name: np.zeros((nz, ny, nx), dtype=np.float32)
+              for name in names}
+    for zs in range(0, nz, nz_tile):
+        ze = min(zs + nz_tile, nz)
+        tile = evaluate_tile(source, names, params, zs, ze)
+        for name in names:
+            fields[name][zs:ze] = tile[name]
+    return fields
+
+
+def tile_size(source, names, max_mem, ncores=1):
+    """Number of cells along z in one tile so that ncores tiles fit in memory
+
+    Args:
+        max_mem: memory cap in bytes
+    """
+    order, bases = resolve(names)
+    nz, ny, nx = source.shape
+    # base fields, intermediate quantities and the output copies
+    narrays = len(bases) + len(order) + len(names)
+    nz_tile = int(max_mem // (ncores * narrays * nx * ny * 4))
+    nz_tile -= 2 * max(total_halo(name) for name in names)
+    return max(1, min(nz_tile, nz))
+
+
+def write_tile(source, names, params, zs, ze, fnames_out):
+    """Evaluate one tile and write it into the matching block of the outputs
+    """
+    tile = evaluate_tile(source, names, params, zs, ze)
+    nz, ny, nx = source.shape
+    offset = source.frame_offset() + zs * nx * ny
+    for name, fname in zip(names, fnames_out):
+        fdata = np.memmap(fname, dtype=np.float32, mode='r+',
+                          offset=offset * 4, shape=(ze - zs, ny, nx))
+        fdata[:] = tile[name]
+        fdata.flush()
+        del fdata
+
+
+def evaluate_to_files(source, names, params, fnames_out, tframes=None,
+                      max_mem=2**30, ncores=1):
+    """Evaluate the requested quantities out of core, tile by tile
+
+    The outputs have the same layout as the inputs, so the tiles of all
+    time frames are written into matching blocks of the output files.
+
+    Args:
+        source: GdaSource of the base fields
+        names: requested quantities
+        params: parameters and grid spacings dx, dy, dz
+        fnames_out: output file names, one for each quantity
+        tframes: time frames to process when the input files include all
+            time frames. Only the frame of the source is processed when
+            it is None.
+        max_mem: memory cap of all processes in bytes
+        ncores: number of processes
+    """
+    if tframes is None:
+        tframes = [source.tframe]
+    nz, ny, nx = source.shape
+    nz_tile = tile_size(source, names, max_mem, ncores)
+    fsize = (source.frame(max(tframes)).frame_offset() + nx * ny * nz) * 4
+    for fname in fnames_out:
+        with open(fname, 'ab') as fh:
+            if fh.tell() < fsize:
+                fh.truncate(fsize)
+    tiles = [(tframe, zs, min(zs + nz_tile, nz))
+             for tframe in tframes for zs in range(0, nz, nz_tile)]
+    for _ in bounded_parallel(
+            (delayed(write_tile)(source.frame(tframe), names, params, zs, ze,
+                                 fnames_out)
+             for tframe, zs, ze in tiles), ncores):
+        pass
+
+
+def get_params(pic_info):
+    """Parameters and grid spacings (in de) of a run
+    """
+    smime = math.sqrt(pic_info.mime)
+    return {"mime": pic_info.mime,
+            "dx": pic_info.dx_di * smime,
+            "dy": pic_info.dy_di * smime,
+            "dz": pic_info.dz_di * smime}
+
+
+def get_cmd_args():
+    """Get command line arguments """
+    default_run_name = 'mime25_beta002_guide00'
+    default_run_dir = ('/net/scratch3/xiaocanli/reconnection/' +
+                       'mime25-sigma1-beta002-guide00-200-100/')
+    parser = argparse.ArgumentParser(description='Derived quantities')
+    parser.add_argument('--run_name', action="store", default=default_run_name,
+                        help='run name')
+    parser.add_argument('--run_dir', action="store", default=default_run_dir,
+                        help='run directory')
+    parser.add_argument('--tframe', action="store", default='0', type=int,
+                        help='time frame')
+    parser.add_argument('--names', action="store", default='absb',
+                        help='comma-separated derived quantities')
+    parser.add_argument('--max_mem', action="store", default='1', type=float,
+                        help='memory cap in GB')
+    parser.add_argument('--ncores', action="store", default='1', type=int,
+                        help='number of processes')
+    return parser.parse_args()
+
+
+def main():
+    """business logic for when running this module as the primary one!"""
+    args = get_cmd_args()
+    picinfo_fname = '../data/pic_info/pic_info_' + args.run_name + '.json'
+    pic_info = read_data_from_json(picinfo_fname)
+    source = GdaSource(args.run_dir + 'data/', pic_info.nx, pic_info.ny,
+                       pic_info.nz, tframe=args.tframe)
+    names = args.names.split(',')
+    fdir = args.run_dir + 'data1/'
+    mkdir_p(fdir)
+    # same layout as the inputs, so only the tiles of this frame are written
+    fnames_out = [fdir + name + '.gda' for name in names]
+    evaluate_to_files(source, names, get_params(pic_info), fnames_out,
+                      max_mem=int(args.max_mem * 2**30), ncores=args.ncores)
+
+
+if __name__ == "__main__":
+    main()
@@ -17,43 +17,31 @@ import numpy as np
 from joblib import Parallel, delayed
 from matplotlib import rc
 
+import derived_expr
 import pic_information
 from energy_conversion import read_data_from_json
 from shell_functions import mkdir_p
 
 
-def calc_vsingle(run_dir, mime):
+def calc_vsingle(run_dir, pic_info, max_mem=2**32, ncores=1):
     """Calculate single fluid velocity
+
+    The fields of all time frames are processed out of core, tile by tile,
+    so the memory is bounded by max_mem (in bytes).
     """
+    nx, ny, nz = pic_info.nx, pic_info.ny, pic_info.nz
     fname = run_dir + 'data/ne.gda'
-    ne = np.fromfile(fname, dtype=np.float32)
-    fname = run_dir + 'data/ni.gda'
-    ni = np.fromfile(fname, dtype=np.float32)
-    inrho = 1.0 / (ne + ni * mime)
+    nframes = os.path.getsize(fname) // (nx * ny * nz * 4)
+    source = derived_expr.GdaSource(run_dir + 'data/', nx, ny, nz)
 
     fdir = run_dir + 'data1/'
     mkdir_p(fdir)
 
-    fname = run_dir + 'data/vex.gda'
-    ve = np.fromfile(fname, dtype=np.float32)
-    fname = run_dir + 'data/vix.gda'
-    vi = np.fromfile(fname, dtype=np.float32)
-    vs = (ve * ne + vi * ni * mime) * inrho
-    vs.tofile(fdir + 'vx.gda')
-
-    fname = run_dir + 'data/vey.gda'
-    ve = np.fromfile(fname, dtype=np.float32)
-    fname = run_dir + 'data/viy.gda'
-    vi = np.fromfile(fname, dtype=np.float32)
-    vs = (ve * ne + vi * ni * mime) * inrho
-    vs.tofile(fdir + 'vy.gda')
-
-    fname = run_dir + 'data/vez.gda'
-    ve = np.fromfile(fname, dtype=np.float32)
-    fname = run_dir + 'data/viz.gda'
-    vi = np.fromfile(fname, dtype=np.float32)
-    vs = (ve * ne + vi * ni * mime) * inrho
-    vs.tofile(fdir + 'vz.gda')
+    names = ['vsingle_x', 'vsingle_y', 'vsingle_z']
+    fnames_out = [fdir + 'vx.gda', fdir + 'vy.gda', fdir + 'vz.gda']
+    derived_expr.evaluate_to_files(source, names, {"mime": pic_info.mime},
+                                   fnames_out, range(nframes), max_mem,
+                                   ncores)
 
 
 if __name__ == "__main__":
@@ -66,8 +54,8 @@ if __name__ == "__main__":
         run_name = 'mime25_beta002_guide00'
     picinfo_fname = '../data/pic_info/pic_info_' + run_name + '.json'
     pic_info = read_data_from_json(picinfo_fname)
-    mime = pic_info.mime
-    calc_vsingle(run_dir, mime)
+    ncores = multiprocessing.cpu_count()
+    calc_vsingle(run_dir, pic_info, ncores=ncores)
     def processInput(job_id):
         print job_id
     ncores = multiprocessing.cpu_count()
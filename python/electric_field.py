@@ -36,6 +36,7 @@ import color_maps as cm
 import colormap.colormaps as cmaps
 import palettable
 import pic_information
+import stencils
 from energy_conversion import read_data_from_json
 from contour_plots import plot_2d_contour, read_2d_fields
 
@@ -841,9 +842,8 @@ def j_curlB(pic_info, ct, root_dir='../../'):
     dx = (x[1] - x[0])*smime
     dz = (z[1] - z[0])*smime
 
-    cbx = -np.gradient(by, dz, axis=0)
-    cby = np.gradient(bx, dz, axis=0) - np.gradient(bz, dx, axis=1)
-    cbz = np.gradient(by, dx, axis=1)
+    stencil = stencils.Stencil(bx.shape, {"dx": dx, "dz": dz})
+    cbx, cby, cbz = stencil.curl([bx, by, bz])
 
     ng = 3
     kernel = np.ones((ng, ng)) / float(ng * ng)
@@ -0,0 +1,163 @@
+"""
+Smoothing filters for field data in float32
+
+Gaussian, box and median filters keep the data in float32. A large frame
+is split into tiles along the first axis, each with a halo of the filter
+radius, and the tiles are filtered by a pool of threads (the scipy.ndimage
+filters release the GIL). Gaussian filters with a large sigma use FFT
+convolution. Multi-frame .gda files are filtered by batches of frames
+across processes.
+"""
+from __future__ import print_function
+
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+from joblib import delayed
+from scipy.ndimage import (fourier_gaussian, gaussian_filter, median_filter,
+                           uniform_filter)
+
+from parallel_functions import bounded_parallel
+
+# Gaussian filters with larger sigma use FFT convolution
+SIGMA_FFT = 16.0
+
+
+def filter_radius(method, size):
+    """Number of cells that a filter reaches on each side
+
+    Args:
+        method: 'gaussian', 'box' or 'median'
+        size: sigma of the Gaussian filter or the size of the others
+    """
+    if method == 'gaussian':
+        return int(4.0 * size + 0.5)
+    return int(size) // 2
+
+
+def gaussian_fft(fdata, sigma, mode='reflect'):
+    """Gaussian filter by FFT convolution
+
+    The data are padded by the filter radius consistently with the
+    boundary mode of the direct filter.
+    """
+    if mode == 'wrap':
+        fpad, radius = fdata, 0
+    else:
+        radius = filter_radius('gaussian', sigma)
+        pad_mode = {'reflect': 'symmetric', 'mirror': 'reflect',
+                    'nearest': 'edge', 'constant': 'constant'}[mode]
+        fpad = np.pad(fdata, radius, mode=pad_mode)
+    fdata_k = np.fft.rfftn(fpad)
+    fdata_k = fourier_gaussian(fdata_k, sigma, n=fpad.shape[-1])
+    fpad = np.fft.irfftn(fdata_k, fpad.shape)
+    if radius > 0:
+        fpad = fpad[tuple(slice(radius, -radius) for _ in fpad.shape)]
+    return fpad.astype(np.float32)
+
+
+def filter_array(fdata, method, size, mode='reflect'):
+    """Filter one array in float32
+    """
+    if method == 'gaussian':
+        if size > SIGMA_FFT:
+            return gaussian_fft(fdata, size, mode)
+        return gaussian_filter(fdata, size, output=np.float32, mode=mode)
+    elif method == 'box':
+        return uniform_filter(fdata, size, output=np.float32, mode=mode)
+    elif method == 'median':
+        return median_filter(fdata, size, mode=mode)
+    raise ValueError("Unknown filter: %s" % method)
+
+
+def filter_tile(fdata, fout, method, size, mode, ts, te, radius):
+    """Filter the tile [ts, te) along the first axis with its halo
+    """
+    nlen = fdata.shape[0]
+    if mode == 'wrap':
+        rows = np.arange(ts - radius, te + radius) % nlen
+        hs = radius
+    else:
+        rows = np.arange(max(ts - radius, 0), min(te + radius, nlen))
+        hs = ts - rows[0]
+    ftile = filter_array(fdata[rows], method, size, mode)
+    fout[ts:te] = ftile[hs:hs+te-ts]
+
+
+def smooth(fdata, method='gaussian', size=3, mode='reflect', nthreads=None,
+           ntile=None):
+    """Smooth one frame in float32 with tiles filtered by a thread pool
+
+    Args:
+        fdata: field data, e.g. (nz, nx) or (nz, ny, nx)
+        method: 'gaussian', 'box' or 'median'
+        size: sigma of the Gaussian filter or the size of the others
+        mode: boundary mode as in scipy.ndimage
+        nthreads: number of threads
+        ntile: number of slices along the first axis in one tile
+
+    Returns:
+        fout: smoothed data in float32
+    """
+    fdata = np.asarray(fdata, dtype=np.float32)
+    if nthreads is None:
+        nthreads = multiprocessing.cpu_count()
+    nlen = fdata.shape[0]
+    radius = filter_radius(method, size)
+    if ntile is None:
+        ntile = max(-(-nlen // nthreads), 4 * radius)
+    # FFT convolution needs the whole frame along every axis
+    if nthreads == 1 or ntile >= nlen or (method == 'gaussian' and
+                                          size > SIGMA_FFT):
+        return filter_array(fdata, method, size, mode)
+    fout = np.empty_like(fdata)
+    tiles = [(ts, min(ts + ntile, nlen)) for ts in range(0, nlen, ntile)]
+    pool = ThreadPool(nthreads)
+    pool.map(lambda tile: filter_tile(fdata, fout, method, size, mode,
+                                      tile[0], tile[1], radius), tiles)
+    pool.close()
+    pool.join()
+    return fout
+
+
+def smooth_gda_frame(fname_in, fname_out, shape, tframe, config):
+    """Smooth one frame of a multi-frame .gda file
+    """
+    size_frame = int(np.prod(shape))
+    fdata = np.memmap(fname_in, dtype=np.float32, mode='r',
+                      offset=size_frame * tframe * 4, shape=shape)
+    fout = smooth(fdata, **config)
+    fdata = np.memmap(fname_out, dtype=np.float32, mode='r+',
+                      offset=size_frame * tframe * 4, shape=shape)
+    fdata[:] = fout
+    fdata.flush()
+    del fdata
+
+
+def smooth_gda(fname_in, fname_out, shape, tframes, config, ncores=None,
+               nthreads=1):
+    """Smooth the frames of a multi-frame .gda file
+
+    Args:
+        fname_in, fname_out: input and output file names
+        shape: shape of one frame, e.g. (nz, nx)
+        tframes: time frames to smooth
+        config: dictionary of the arguments of smooth, e.g.
+            {"method": "median", "size": 5}
+        ncores: number of processes, each smoothing one frame at a time
+        nthreads: number of threads of each process
+    """
+    if ncores is None:
+        ncores = multiprocessing.cpu_count()
+    config = dict(config)
+    config["nthreads"] = nthreads
+    fsize = int(np.prod(shape)) * (max(tframes) + 1) * 4
+    with open(fname_out, 'ab') as fh:
+        if fh.tell() < fsize:
+            fh.truncate(fsize)
+    for _ in bounded_parallel(
+            (delayed(smooth_gda_frame)(fname_in, fname_out, shape, tframe,
+                                       config)
+             for tframe in tframes), ncores):
+        pass
@@ -0,0 +1,274 @@
+"""
+Fluid energization terms of all time frames in one pass
+
+For each time frame, E, B, the hydro moments of both species and the
+previous and next frames of the bulk 4-velocities (u<s>x_pre.gda,
+u<s>x_post.gda, ...) are read once, and the drift velocity vE, unit
+vector b, curvature kappa and the gradients are shared by all terms. The
+volume-integrated terms are saved in the time series files used by the
+plotting scripts (e.g. cori_3d.fluid_energization),
+    emf_ptensor_<s>.gda: curvature drift, bulk curvature, gradient drift,
+        magnetization, compression, shear, pressure tensor and
+        agyrotropic pressure terms
+    para_perp_acc_<s>.gda: the time derivative and spatial parts of the
+        inertial (polarization) term, j_para.E_para and j_perp.E_perp
+Both are float32 files of [nvar, nframes, var0[nframes], var1[nframes],
+...]. Frames are processed in parallel, and the new frames are written
+into the existing files.
+"""
+from __future__ import print_function
+
+import argparse
+import multiprocessing
+import os
+
+import numpy as np
+from joblib import delayed
+
+import field_filters
+import stencils
+from derived_expr import GdaSource, get_params
+from json_functions import read_data_from_json
+from parallel_functions import bounded_parallel
+from shell_functions import mkdir_p
+
+EMF_PTENSOR_VARS = ["curv_drift_dote", "bulk_curv_dote", "grad_drift_dote",
+                    "magnetization_dote", "comp_ene", "shear_ene",
+                    "ptensor_ene", "pgyro_ene"]
+PARA_PERP_ACC_VARS = ["acc_drift_dote_t", "acc_drift_dote_s",
+                      "epara_ene", "eperp_ene"]
+# peak number of frame-sized float32 arrays in frame_energization
+NARRAYS_FRAME = 48
+
+
+def dot(avec, bvec):
+    return avec[0] * bvec[0] + avec[1] * bvec[1] + avec[2] * bvec[2]
+
+
+def frame_energization(source, params, config):
+    """Energization terms of both species at one time frame
+
+    Args:
+        source: GdaSource of the time frame
+        params: grid spacings dx, dy, dz
+        config: dictionary of
+            'mime': ion-to-electron mass ratio
+            'dt_pre_post': time between the previous and next frames
+            'sigma': sigma of the Gaussian filter of E (0 for no smoothing)
+            'periodic': whether the boundaries along x, y, z are periodic
+
+    Returns:
+        res: dictionary of species -> dictionary of volume-integrated terms
+    """
+    nz, ny, nx = source.shape
+    stencil = stencils.Stencil(source.shape, params,
+                               config.get("periodic", (False, False, False)))
+    grad = stencil.empty(3)  # work buffer of the gradients
+
+    def read(var):
+        return source.read(var, 0, nz).astype(np.float32)
+
+    efield = [read(var) for var in ["ex", "ey", "ez"]]
+    if config.get("sigma", 0) > 0:
+        efield = [field_filters.smooth(fdata, 'gaussian', config["sigma"],
+                                       nthreads=1) for fdata in efield]
+    bfield = [read(var) for var in ["bx", "by", "bz"]]
+    absb = np.sqrt(dot(bfield, bfield))
+    ib2 = 1.0 / absb**2
+    bhat = [bcomp / absb for bcomp in bfield]
+    vexb = [(efield[1] * bfield[2] - efield[2] * bfield[1]) * ib2,
+            (efield[2] * bfield[0] - efield[0] * bfield[2]) * ib2,
+            (efield[0] * bfield[1] - efield[1] * bfield[0]) * ib2]
+    kappa_vexb = dot(stencil.curvature(bhat), vexb)
+    gradb_vexb = dot(stencil.gradient(absb, grad), vexb) / absb
+    edotb = dot(efield, bhat)
+    divv = stencil.divergence(vexb)
+    grad_vexb = [stencil.gradient(vcomp) for vcomp in vexb]
+    # traceless rate of strain projected on b
+    bsb = -divv / 3
+    for i in range(3):
+        for j in range(3):
+            bsb += 0.5 * bhat[i] * bhat[j] * (grad_vexb[i][j] +
+                                              grad_vexb[j][i])
+    del grad_vexb
+
+    cells = [nx, ny, nz]
+    dv = 1.0
+    for ncell, spacing in zip(cells, ['dx', 'dy', 'dz']):
+        if ncell > 1:
+            dv *= params[spacing]
+    idt = 1.0 / config["dt_pre_post"]
+
+    def total(fdata):
+        return np.sum(fdata, dtype=np.float64) * dv
+
+    res = {}
+    for species in ['e', 'i']:
+        pmass = 1.0 if species == 'e' else config["mime"]
+        charge = -1.0 if species == 'e' else 1.0
+        nrho = read("n" + species)
+        vel = [read("v" + species + comp) for comp in ['x', 'y', 'z']]
+        ptensor = {}
+        for comp in ['xx', 'xy', 'xz', 'yy', 'yz', 'zz']:
+            ptensor[comp] = read("p" + species + "_" + comp)
+        ppara = (ptensor['xx'] * bhat[0]**2 + ptensor['yy'] * bhat[1]**2 +
+                 ptensor['zz'] * bhat[2]**2 +
+                 2 * (ptensor['xy'] * bhat[0] * bhat[1] +
+                      ptensor['xz'] * bhat[0] * bhat[2] +
+                      ptensor['yz'] * bhat[1] * bhat[2]))
+        pperp = 0.5 * (ptensor['xx'] + ptensor['yy'] + ptensor['zz'] - ppara)
+        pscalar = (ppara + 2 * pperp) / 3
+        vpara = dot(vel, bhat)
+
+        terms = {}
+        terms["curv_drift_dote"] = total(ppara * kappa_vexb)
+        terms["bulk_curv_dote"] = total(nrho * pmass * vpara**2 * kappa_vexb)
+        terms["grad_drift_dote"] = total(pperp * gradb_vexb)
+        jmag = stencil.curl([-pperp * bcomp / absb for bcomp in bhat])
+        terms["magnetization_dote"] = total(dot(jmag, efield))
+        del jmag
+        terms["comp_ene"] = total(-pscalar * divv)
+        terms["shear_ene"] = total((pperp - ppara) * bsb)
+        divp = stencil.tensor_divergence(ptensor)
+        terms["ptensor_ene"] = total(dot(divp, vexb))
+        # agyrotropic part: P - pperp I - (ppara - pperp) bb
+        dpp = ppara - pperp
+        pagyro = {}
+        for i, ci in enumerate(['x', 'y', 'z']):
+            for j, cj in enumerate(['x', 'y', 'z']):
+                if i > j:
+                    continue
+                comp = ci + cj
+                pagyro[comp] = ptensor[comp] - dpp * bhat[i] * bhat[j]
+                if i == j:
+                    pagyro[comp] -= pperp
+        divp = stencil.tensor_divergence(pagyro, divp)
+        terms["pgyro_ene"] = total(dot(divp, vexb))
+        del pagyro, divp, ptensor
+
+        uvec = [read("u" + species + comp) for comp in ['x', 'y', 'z']]
+        dudt = [(read("u" + species + comp + "_post") -
+                 read("u" + species + comp + "_pre")) * idt
+                for comp in ['x', 'y', 'z']]
+        terms["acc_drift_dote_t"] = total(nrho * pmass * dot(dudt, vexb))
+        del dudt
+        vgrad_u = [dot(vel, stencil.gradient(ucomp, grad)) for ucomp in uvec]
+        terms["acc_drift_dote_s"] = total(nrho * pmass * dot(vgrad_u, vexb))
+        del vgrad_u, uvec
+        jvec = [charge * nrho * vcomp for vcomp in vel]
+        jpara_dote = dot(jvec, bhat) * edotb
+        terms["epara_ene"] = total(jpara_dote)
+        terms["eperp_ene"] = total(dot(jvec, efield) - jpara_dote)
+        res[species] = terms
+    return res
+
+
+def update_series(fname, varnames, tframes, values):
+    """Write the values of some time frames into a time series file
+
+    Args:
+        fname: file of [nvar, nframes, var0[nframes], ...]
+        varnames: names of the variables
+        tframes: time frames of the values
+        values: list of dictionaries (one for each frame) of the variables
+    """
+    nvar = len(varnames)
+    nframes = max(tframes) + 1
+    if os.path.isfile(fname):
+        fdata = np.fromfile(fname, dtype=np.float32)
+        if int(fdata[0]) != nvar:
+            raise ValueError("%s has %d variables instead of %d" %
+                             (fname, int(fdata[0]), nvar))
+        nframes_old = int(fdata[1])
+        series = fdata[2:].reshape((nvar, nframes_old))
+        nframes = max(nframes, nframes_old)
+    else:
+        nframes_old = 0
+    fdata = np.zeros((nvar, nframes), dtype=np.float32)
+    if nframes_old > 0:
+        fdata[:, :nframes_old] = series
+    for tframe, value in zip(tframes, values):
+        for ivar, var in enumerate(varnames):
+            fdata[ivar, tframe] = value[var]
+    header = np.asarray([nvar, nframes], dtype=np.float32)
+    np.concatenate([header, fdata.ravel()]).tofile(fname)
+
+
+def frame_cores(pic_info, max_mem):
+    """Number of processes so that their frames fit in memory
+
+    Args:
+        pic_info: PIC simulation information
+        max_mem: memory cap in bytes
+    """
+    frame_size = pic_info.nx * pic_info.ny * pic_info.nz * 4
+    ncores = int(max_mem // (NARRAYS_FRAME * frame_size))
+    return max(1, min(ncores, multiprocessing.cpu_count()))
+
+
+def calc_fluid_energization(run_dir, pic_info, tframes, fdir, config,
+                            ncores=None, max_mem=2**32):
+    """Calculate the fluid energization terms of some time frames
+
+    Args:
+        run_dir: PIC run directory with the .gda files in data/
+        pic_info: PIC simulation information
+        tframes: time frames
+        fdir: directory of the time series files
+        config: see frame_energization
+        ncores: number of processes, chosen from max_mem when it is None
+        max_mem: memory cap of all processes in bytes
+    """
+    if ncores is None:
+        ncores = frame_cores(pic_info, max_mem)
+    params = get_params(pic_info)
+    source = GdaSource(run_dir + "data/", pic_info.nx, pic_info.ny,
+                       pic_info.nz)
+    res = list(bounded_parallel(
+        (delayed(frame_energization)(source.frame(tframe), params, config)
+         for tframe in tframes), ncores))
+    mkdir_p(fdir)
+    for species in ['e', 'i']:
+        values = [res_frame[species] for res_frame in res]
+        update_series(fdir + "emf_ptensor_" + species + ".gda",
+                      EMF_PTENSOR_VARS, tframes, values)
+        update_series(fdir + "para_perp_acc_" + species + ".gda",
+                      PARA_PERP_ACC_VARS, tframes, values)
+
+
+def get_cmd_args():
+    """Get command line arguments """
+    default_pic_run = '3D-Lx150-bg0.2-150ppc-2048KNL'
+    default_pic_run_dir = ('/net/scratch3/xiaocanli/reconnection/Cori_runs/' +
+                           default_pic_run + '/')
+    parser = argparse.ArgumentParser(description='Fluid energization')
+    parser.add_argument('--pic_run', action="store",
+                        default=default_pic_run, help='PIC run name')
+    parser.add_argument('--pic_run_dir', action="store",
+                        default=default_pic_run_dir, help='PIC run directory')
+    parser.add_argument('--tstart', action="store", default='0', type=int,
+                        help='starting time frame')
+    parser.add_argument('--tend', action="store", default='10', type=int,
+                        help='ending time frame')
+    parser.add_argument('--sigma', action="store", default='3', type=float,
+                        help='sigma of the Gaussian filter of E')
+    parser.add_argument('--max_mem', action="store", default='4', type=float,
+                        help='memory cap in GB')
+    return parser.parse_args()
+
+
+def main():
+    """business logic for when running this module as the primary one!"""
+    args = get_cmd_args()
+    picinfo_fname = '../data/pic_info/pic_info_' + args.pic_run + '.json'
+    pic_info = read_data_from_json(picinfo_fname)
+    config = {"mime": pic_info.mime, "dt_pre_post": 2 * pic_info.dtwpe,
+              "sigma": args.sigma}
+    fdir = "../data/fluid_energization/" + args.pic_run + "/"
+    tframes = list(range(args.tstart, args.tend + 1))
+    calc_fluid_energization(args.pic_run_dir, pic_info, tframes, fdir, config,
+                            max_mem=int(args.max_mem * 2**30))
+
+
+if __name__ == "__main__":
+    main()
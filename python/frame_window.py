@@ -0,0 +1,87 @@
+"""
+Sliding window of three time frames for time derivatives
+
+The window keeps frames t-1, t and t+1 in memory and slides forward by
+one frame at each step, so every frame is read only once in a time loop.
+Centered time derivatives are available for the frames inside the time
+range and one-sided ones at the two ends.
+"""
+import numpy as np
+
+from derived_expr import GdaSource
+
+
+class FrameWindow(object):
+    def __init__(self, read_frame, tframes, dt):
+        """
+        Args:
+            read_frame: function of the time frame, returning a dictionary
+                of the data of the frame
+            tframes: consecutive time frames to go through
+            dt: time interval between two frames
+        """
+        self.read_frame = read_frame
+        self.tframes = list(tframes)
+        self.dt = dt
+        self.window = [None, None, None]  # t-1, t, t+1
+
+    def __iter__(self):
+        """Slide through the time frames, yielding the current frame
+        """
+        nframes = len(self.tframes)
+        for iframe, tframe in enumerate(self.tframes):
+            if iframe == 0:
+                self.window = [None, self.read_frame(tframe), None]
+            else:
+                self.window = [self.window[1], self.window[2], None]
+            if iframe + 1 < nframes:
+                self.window[2] = self.read_frame(self.tframes[iframe + 1])
+            yield tframe
+
+    def __getitem__(self, var):
+        """Data of the current frame
+        """
+        return self.window[1][var]
+
+    def frame(self, offset):
+        """Data of the frame t + offset (offset = -1, 0 or 1), or None
+        """
+        return self.window[offset + 1]
+
+    def ddt(self, var):
+        """Time derivative of a variable at the current frame
+        """
+        prev, cur, post = self.window
+        if prev is not None and post is not None:
+            return (post[var] - prev[var]) / (2 * self.dt)
+        if post is not None:
+            return (post[var] - cur[var]) / self.dt
+        if prev is not None:
+            return (cur[var] - prev[var]) / self.dt
+        return np.zeros_like(cur[var])
+
+
+def gda_frame_reader(fdir, pic_info, varnames):
+    """Function reading some variables of one frame from the .gda files
+
+    Args:
+        fdir: directory of the .gda files including all time frames
+        pic_info: PIC simulation information
+        varnames: variables to read
+
+    Returns:
+        read_frame: function of the time frame. The arrays have the shape
+            (nz, nx) for 2D runs and (nz, ny, nx) for 3D runs.
+    """
+    source = GdaSource(fdir, pic_info.nx, pic_info.ny, pic_info.nz)
+
+    def read_frame(tframe):
+        fsource = source.frame(tframe)
+        nz, ny, _ = fsource.shape
+        fdata = {}
+        for var in varnames:
+            fdata[var] = fsource.read(var, 0, nz)
+            if ny == 1:
+                fdata[var] = fdata[var][:, 0, :]
+        return fdata
+    return read_frame
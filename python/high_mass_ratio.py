@@ -21,6 +21,7 @@ from scipy.ndimage.filters import median_filter, gaussian_filter
 
 import fitting_funcs
 import pic_information
+import spectrum_series
 from contour_plots import read_2d_fields
 from joblib import Parallel, delayed
 from json_functions import read_data_from_json
@@ -1416,9 +1417,7 @@ def energy_spectrum_early(bg, species, tframe, show_plot=True):
         elog /= eth
         elog_mid /= eth
         nptot = pic_info.nx * pic_info.ny * pic_info.nz * pic_info.nppc
-        fdir = '../data/spectra/' + run_name + '/'
-        fname = fdir + 'spectrum-' + species.lower() + '.' + str(tframe1)
-        flog = np.fromfile(fname)
+        flog = spectrum_series.read_frame(run_name, species, tframe1)
         flog /= nptot
         if species != 'e':
             flog /= pic_info.mime
@@ -1551,6 +1550,9 @@ def stacked_spectrum(species='e', const_va=False, show_plot=True):
             tframes = range(ntf)
             nframes = len(tframes)
             flogs = np.zeros((nframes, nbins))
+            if not (const_va or mime == 400):
+                flogs_run = spectrum_series.read_frames(run_name, species_name,
+                                                        tframes)
             for iframe, tframe in enumerate(tframes):
                 # tframe1 = tframe + tshifts[str(mime)]
                 tframe1 = tframe
@@ -1565,9 +1567,7 @@ def stacked_spectrum(species='e', const_va=False, show_plot=True):
                     # re-normalize using the thermal of energy of mime=400
                     flog /= eth0 * 400 / (eth * pic_info.mime)
                 else:
-                    fdir = '../data/spectra/' + run_name + '/'
-                    fname = fdir + 'spectrum-' + species_name.lower() + '.' + str(tframe1)
-                    flog = np.fromfile(fname)
+                    flog = flogs_run[iframe].copy()
                 flog /= nptot
                 if species != 'e':
                     flog /= pic_info.mime
@@ -1706,6 +1706,7 @@ def evolving_spectrum(species='e', const_va=False, high_bg=False, show_plot=True
         tframes = [40, 60, 90]
     nframes = len(tframes)
     COLORS = palettable.tableau.Tableau_10.mpl_colors
+    flogs_run = {}  # spectra of all the frames of each run
     for iframe, tframe in enumerate(tframes):
         rect = np.copy(rect0)
         for ibg, bg in enumerate(bgs):
@@ -1755,9 +1756,10 @@ def evolving_spectrum(species='e', const_va=False, high_bg=False, show_plot=True
                 nptot = pic_info.nx * pic_info.ny * pic_info.nz * pic_info.nppc
 
                 if bg < 1.0:
-                    tframe1 = tframe + tshifts[str(mime)]
+                    tshift = tshifts[str(mime)]
                 else:
-                    tframe1 = tframe + 3 if mime > 25 else tframe
+                    tshift = 3 if mime > 25 else 0
+                tframe1 = tframe + tshift
                 print("Time frame: %d" % tframe1)
                 if const_va or mime == 400:
                     tindex1 = tframe1 * pic_info.ehydro_interval
@@ -1767,9 +1769,11 @@ def evolving_spectrum(species='e', const_va=False, high_bg=False, show_plot=True
                     flog = fdata[3:] # the first 3 are magnetic field components
                     flog /= delog
                 else:
-                    fdir = '../data/spectra/' + run_name + '/'
-                    fname = fdir + 'spectrum-' + species_name.lower() + '.' + str(tframe1)
-                    flog = np.fromfile(fname)
+                    # all the frames of a run are read at its first frame
+                    if run_name not in flogs_run:
+                        flogs_run[run_name] = spectrum_series.read_frames(
+                            run_name, species_name, np.asarray(tframes) + tshift)
+                    flog = flogs_run[run_name][iframe].copy()
                 flog /= nptot
                 # re-normalize using the thermal of energy of mime=400
                 flog /= eth0[species] / eth
@@ -1945,6 +1949,7 @@ def evolving_momentum_spectrum(species='e', const_va=False, high_bg=False, show_
         tframes = [40, 60, 90]
     nframes = len(tframes)
     COLORS = palettable.tableau.Tableau_10.mpl_colors
+    flogs_run = {}  # spectra of all the frames of each run
     for iframe, tframe in enumerate(tframes):
         rect = np.copy(rect0)
         for ibg, bg in enumerate(bgs):
@@ -1999,9 +2004,10 @@ def evolving_momentum_spectrum(species='e', const_va=False, high_bg=False, show_
                 nptot = pic_info.nx * pic_info.ny * pic_info.nz * pic_info.nppc
 
                 if bg < 1.0:
-                    tframe1 = tframe + tshifts[str(mime)]
+                    tshift = tshifts[str(mime)]
                 else:
-                    tframe1 = tframe + 3 if mime > 25 else tframe
+                    tshift = 3 if mime > 25 else 0
+                tframe1 = tframe + tshift
                 print("Time frame: %d" % tframe1)
                 if const_va or mime == 400:
                     tindex1 = tframe1 * pic_info.ehydro_interval
@@ -2012,9 +2018,11 @@ def evolving_momentum_spectrum(species='e', const_va=False, high_bg=False, show_
                     pspect = flog / dplog
                     flog /= delog
                 else:
-                    fdir = '../data/spectra/' + run_name + '/'
-                    fname = fdir + 'spectrum-' + species_name.lower() + '.' + str(tframe1)
-                    flog = np.fromfile(fname)
+                    # all the frames of a run are read at its first frame
+                    if run_name not in flogs_run:
+                        flogs_run[run_name] = spectrum_series.read_frames(
+                            run_name, species_name, np.asarray(tframes) + tshift)
+                    flog = flogs_run[run_name][iframe].copy()
                     pspect = flog * delog / dplog
                 flog /= nptot
                 pspect /= nptot
@@ -16,12 +16,12 @@ import matplotlib as mpl
 import matplotlib.pyplot as plt
 import numpy as np
 import palettable
-from scipy.optimize import curve_fit
 from scipy.special import erf
 from scipy.interpolate import interp1d
 
-import fitting_funcs
 import pic_information
+import spectrum_cube
+import spectrum_fitting_batch
 from contour_plots import read_2d_fields
 from joblib import Parallel, delayed
 from json_functions import read_data_from_json
@@ -50,43 +50,18 @@ def mkdir_p(path):
 def combine_spectrum(plot_config):
     """Combine the spectrum in the whole box
 
-    Here we assume that PIC only splits z into different zones
+    Here we assume that PIC only splits z into different zones. The MPI
+    ranks are read in parallel and written into a memory-mapped spectrum
+    cube, which can be queried with the functions in spectrum_cube.
     """
-    pic_run_dir = plot_config["pic_run_dir"]
-    spect_dir = plot_config["spect_dir"]
-    species = plot_config["species"]
-    mpi_size = plot_config["mpi_size"]
-    mpi_sizex = plot_config["mpi_sizex"]
-    mpi_sizey = plot_config["mpi_sizey"]
-    mpi_sizez = plot_config["mpi_sizez"]
-    num_fold = plot_config["num_fold"]
-    nbins = plot_config["nbins"]
     tindex = plot_config["tframe"] * plot_config["tinterval"]
-    fdir = pic_run_dir + spect_dir + '/0/T.' + str(tindex) + '/'
-    fname = fdir + 'spectrum-' + species + 'hydro.' + str(tindex) + '.0'
-    fdata = np.fromfile(fname, dtype=np.float32)
-    nzones = fdata.shape[0] // nbins
-    fspect = np.zeros((nzones * mpi_sizez, mpi_sizey, mpi_sizex, nbins))
-    nxy = mpi_sizex * mpi_sizey
-    for mpi_rank in range(mpi_size):
-        print("MPI rank: %d" % mpi_rank)
-        iz = mpi_rank // nxy
-        iy = (mpi_rank % nxy) // mpi_sizex
-        ix = mpi_rank % mpi_sizex
-        findex = mpi_rank // num_fold
-        fdir = (pic_run_dir + spect_dir + '/' + str(findex) +
-                '/T.' + str(tindex) + '/')
-        fname = (fdir + 'spectrum-' + species + 'hydro.' +
-                 str(tindex) + '.' + str(mpi_rank))
-        fdata = np.fromfile(fname, dtype=np.float32)
-        # fdata = fdata.reshape((nzones, nbins))
-        # fspect[iz*nzones:(iz+1)*nzones, iy, ix, :] = fdata
-
+    config = dict(plot_config)
+    config["tindex"] = tindex
     fdir = ('/net/scratch3/xiaocanli/reconnection/NERSC_ADAM/' +
             plot_config['pic_run'] + '/spectrum/')
     mkdir_p(fdir)
-    fname = fdir + species + 'spectrum.gda'
-    fspect.tofile(fname)
+    fname = fdir + plot_config["species"] + 'spectrum.gda'
+    spectrum_cube.assemble_spectrum_cube(config, fname)
 
 
 def fit_thermal_core(ene, f):
@@ -103,18 +78,13 @@ def fit_thermal_core(ene, f):
         fthermal: thermal part of the particle distribution.
     """
     print('Fitting to get the thermal core of the particle distribution')
-    estart = 0
-    ng = 3
-    kernel = np.ones(ng) / float(ng)
-    fnew = np.convolve(f, kernel, 'same')
     nshift = 10  # grids shift for fitting thermal core.
-    eend = np.argmax(fnew) + nshift
-    popt, pcov = curve_fit(fitting_funcs.func_maxwellian,
-                           ene[estart:eend], f[estart:eend])
-    fthermal = fitting_funcs.func_maxwellian(ene, popt[0], popt[1])
-    print('Energy with maximum flux: %f' % ene[eend - 10])
+    popt, _, eend, fthermal = spectrum_fitting_batch.fit_thermal_core_batch(
+        ene, f.reshape((1, -1)), estart=0, nshift=nshift, ncores=1)
+    popt = popt[0]
+    print('Energy with maximum flux: %f' % ene[eend[0] - nshift])
     print('Energy with maximum flux in fitted thermal core: %f' % (0.5 / popt[1]))
-    return fthermal
+    return fthermal[0]
 
 
 def accumulated_particle_info(ene, f):
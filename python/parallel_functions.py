@@ -0,0 +1,44 @@
+"""
+Process pools with bounded memory
+
+The tasks are run by a joblib pool and their results are yielded in order
+as they are consumed. At most pre_dispatch tasks are dispatched ahead of
+the consumer, so only a few results are held in memory at a time, and a
+process starts its next task as soon as it is free instead of waiting for
+the slowest task of a group.
+"""
+from __future__ import print_function
+
+import itertools
+
+from joblib import Parallel
+
+
+def bounded_parallel(tasks, ncores, pre_dispatch='2*n_jobs'):
+    """Run tasks with ncores processes and yield their results in order
+
+    Args:
+        tasks: iterable of joblib.delayed tasks
+        ncores: number of processes
+        pre_dispatch: number of tasks dispatched ahead of the consumer
+
+    Yields:
+        the result of each task, in the order of tasks
+    """
+    try:
+        parallel = Parallel(n_jobs=ncores, return_as='generator',
+                            pre_dispatch=pre_dispatch)
+    except TypeError:
+        parallel = None
+    if parallel is not None:
+        for res in parallel(tasks):
+            yield res
+        return
+    # joblib < 1.3 cannot return a generator, so run ncores tasks at a time
+    tasks = iter(tasks)
+    while True:
+        wave = list(itertools.islice(tasks, ncores))
+        if not wave:
+            return
+        for res in Parallel(n_jobs=ncores)(wave):
+            yield res
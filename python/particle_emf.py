@@ -21,6 +21,10 @@ from mpl_toolkits.mplot3d import Axes3D
 from scipy.interpolate import interp1d
 
 import pic_information
+import tracer_energization
+import tracer_periodic
+import tracer_selection
+import tracer_transpose
 from energy_conversion import *
 from shell_functions import *
 
@@ -135,30 +139,14 @@ def particle_energy(iptl, particle_tags, pic_info, stride, odir, fh):
     tnew = np.linspace(t[0], t[-1], sz_new)
     dt_new = sz * dt / sz_new
     ptl = interp_data(sz_new, sz, ptl, pic_info, interp_kind='linear')
-    ibtot2 = 1.0 / (ptl['Bx']**2 + ptl['By']**2 + ptl['Bz']**2)
-    edotb = ptl['Ex'] * ptl['Bx'] + ptl['Ey'] * ptl['By'] + ptl['Ez'] * ptl[
-        'Bz']
-    Eparax = edotb * ibtot2 * ptl['Bx']
-    Eparay = edotb * ibtot2 * ptl['By']
-    Eparaz = edotb * ibtot2 * ptl['Bz']
-    Eperpx = ptl['Ex'] - Eparax
-    Eperpy = ptl['Ey'] - Eparay
-    Eperpz = ptl['Ez'] - Eparaz
     gama = ptl['gamma']
-    jdote_para = -(ptl['Ux']*Eparax + ptl['Uy']*Eparay + \
-                   ptl['Uz']*Eparaz) / gama
-    jdote_perp = -(ptl['Ux']*Eperpx + ptl['Uy']*Eperpy + \
-                   ptl['Uz']*Eperpz) / gama
-    jdote_tot = -(ptl['Ux']*ptl['Ex'] + ptl['Uy']*ptl['Ey'] + \
-                  ptl['Uz']*ptl['Ez']) / gama
+    rates = tracer_energization.energization_rates(ptl)
+    jdote_para = rates['para']
+    jdote_perp = rates['perp']
+    jdote_tot = rates['tot']
 
     if 'Vx' in ptl:
-        Einx = ptl['Vz'] * ptl['By'] - ptl['Vy'] * ptl['Bz']
-        Einy = ptl['Vx'] * ptl['Bz'] - ptl['Vz'] * ptl['Bx']
-        Einz = ptl['Vy'] * ptl['Bx'] - ptl['Vx'] * ptl['By']
-        jdote_in = -(ptl['Ux']*Einx + ptl['Uy']*Einy + \
-                     ptl['Uz']*Einz) / gama
-        jdote_in_cum = np.cumsum(jdote_in[::stride]) * dt_new * stride
+        jdote_in_cum = np.cumsum(rates['in'][::stride]) * dt_new * stride
 
     jdote_para_cum = np.cumsum(jdote_para[::stride]) * dt_new * stride
     jdote_perp_cum = np.cumsum(jdote_perp[::stride]) * dt_new * stride
@@ -221,29 +209,7 @@ def adjust_pos(pos, length):
         pos: the position along one axis
         length: the box size along that axis
     """
-    crossings = []
-    offsets = []
-    offset = 0
-    nt, = pos.shape
-    pos_b = np.zeros(nt)
-    pos_b = np.copy(pos)
-    for i in range(nt - 1):
-        if (pos[i] - pos[i + 1] > 0.1 * length):
-            crossings.append(i)
-            offset += length
-            offsets.append(offset)
-        if (pos[i] - pos[i + 1] < -0.1 * length):
-            crossings.append(i)
-            offset -= length
-            offsets.append(offset)
-    nc = len(crossings)
-    if nc > 0:
-        crossings = np.asarray(crossings)
-        offsets = np.asarray(offsets)
-        for i in range(nc - 1):
-            pos_b[crossings[i] + 1:crossings[i + 1] + 1] += offsets[i]
-        pos_b[crossings[nc - 1] + 1:] += offsets[nc - 1]
-    return pos_b
+    return tracer_periodic.unwrap_positions(pos, length)
 
 
 def save_new_data(iptl, particle_tags, pic_info, fh_in, fh_out):
@@ -315,27 +281,6 @@ def transfer_to_h5part(particle_tags,
     told = np.linspace(0, ntf, ntf, endpoint=False)
     ntf_new = (ntf - 1) * tinterval + 1
     tnew = np.linspace(0, ntf - 1, ntf_new)
-    Ux = np.zeros(ntf_new * nptl, dtype=ptl['Ux'].dtype)
-    Uy = np.zeros(ntf_new * nptl, dtype=ptl['Uy'].dtype)
-    Uz = np.zeros(ntf_new * nptl, dtype=ptl['Uz'].dtype)
-    dX = np.zeros(ntf_new * nptl, dtype=ptl['dX'].dtype)
-    dY = np.zeros(ntf_new * nptl, dtype=ptl['dY'].dtype)
-    dZ = np.zeros(ntf_new * nptl, dtype=ptl['dZ'].dtype)
-    i = np.zeros(ntf_new * nptl, dtype=ptl['i'].dtype)
-    q = np.zeros(ntf_new * nptl, dtype=ptl['q'].dtype)
-    gamma = np.zeros(ntf_new * nptl, dtype=ptl['gamma'].dtype)
-    t = np.zeros(ntf_new * nptl, dtype=ptl['t'].dtype)
-    if 'Bx' in ptl:
-        Bx = np.zeros(ntf_new * nptl, dtype=ptl['Bx'].dtype)
-        By = np.zeros(ntf_new * nptl, dtype=ptl['By'].dtype)
-        Bz = np.zeros(ntf_new * nptl, dtype=ptl['Bz'].dtype)
-        Ex = np.zeros(ntf_new * nptl, dtype=ptl['Ex'].dtype)
-        Ey = np.zeros(ntf_new * nptl, dtype=ptl['Ey'].dtype)
-        Ez = np.zeros(ntf_new * nptl, dtype=ptl['Ez'].dtype)
-    if 'Vx' in ptl:
-        Vx = np.zeros(ntf_new * nptl, dtype=ptl['Vx'].dtype)
-        Vy = np.zeros(ntf_new * nptl, dtype=ptl['Vy'].dtype)
-        Vz = np.zeros(ntf_new * nptl, dtype=ptl['Vz'].dtype)
 
     # Additional information besides the original particle data
     additional_info = ''
@@ -349,10 +294,7 @@ def transfer_to_h5part(particle_tags,
         additional_info += '_' + interp_kind + '_t' + str(tinterval)
 
     # Save the interpolated particle data
-    if 'Bx' in ptl:
-        file_name = species + additional_info + '.h5p'
-    else:
-        file_name = species + additional_info + '.h5p'
+    file_name = species + additional_info + '.h5p'
     fname = filepath + file_name
     with h5py.File(fname, 'w') as fh_out:
         for iptl in range(nptl):
@@ -366,67 +308,14 @@ def transfer_to_h5part(particle_tags,
             for key in ptl:
                 grp.create_dataset(
                     key, (ntf_new, ), data=ptl[key], dtype=ptl[key].dtype)
-            Ux[iptl::nptl] = ptl['Ux']
-            Uy[iptl::nptl] = ptl['Uy']
-            Uz[iptl::nptl] = ptl['Uz']
-            dX[iptl::nptl] = ptl['dX']
-            dY[iptl::nptl] = ptl['dY']
-            dZ[iptl::nptl] = ptl['dZ']
-            i[iptl::nptl] = ptl['i']
-            q[iptl::nptl] = ptl['q']
-            gamma[iptl::nptl] = ptl['gamma']
-            t[iptl::nptl] = ptl['t']
-            if 'Bx' in ptl:
-                Bx[iptl::nptl] = ptl['Bx']
-                By[iptl::nptl] = ptl['By']
-                Bz[iptl::nptl] = ptl['Bz']
-                Ex[iptl::nptl] = ptl['Ex']
-                Ey[iptl::nptl] = ptl['Ey']
-                Ez[iptl::nptl] = ptl['Ez']
-            if 'Vx' in ptl:
-                Vx[iptl::nptl] = ptl['Vx']
-                Vy[iptl::nptl] = ptl['Vy']
-                Vz[iptl::nptl] = ptl['Vz']
 
+    # Transpose the interpolated data in blocks into time-major H5Part
     nx, ny, nz = pic_info.nx, pic_info.ny, pic_info.nz
     lx, ly, lz = pic_info.lx_di, pic_info.ly_di, pic_info.lz_di
-    dX *= nx / lx * 0.5
-    dY *= ny / ly * 0.5
-    dZ *= nz / lz * 0.5
-    dY += ny * 0.25
-    dZ += nz * 0.25
-
-    if 'Bx' in ptl:
-        file_name = species + additional_info + '.h5part'
-    else:
-        file_name = species + additional_info + '.h5part'
-    fname = filepath + file_name
-    with h5py.File(fname, 'w') as fh_out:
-        for tindex in range(0, ntf_new):
-            print tindex
-            grp = fh_out.create_group('Step#' + str(tindex))
-            index = range(tindex * nptl, (tindex + 1) * nptl)
-            grp.create_dataset('Ux', (nptl, ), data=Ux[index])
-            grp.create_dataset('Uy', (nptl, ), data=Uy[index])
-            grp.create_dataset('Uz', (nptl, ), data=Uz[index])
-            grp.create_dataset('dX', (nptl, ), data=dX[index])
-            grp.create_dataset('dY', (nptl, ), data=dY[index])
-            grp.create_dataset('dZ', (nptl, ), data=dZ[index])
-            grp.create_dataset('i', (nptl, ), data=i[index])
-            grp.create_dataset('q', (nptl, ), data=q[index])
-            grp.create_dataset('gamma', (nptl, ), data=gamma[index])
-            grp.create_dataset('t', (nptl, ), data=t[index])
-            if 'Bx' in ptl:
-                grp.create_dataset('Bx', (nptl, ), data=Bx[index])
-                grp.create_dataset('By', (nptl, ), data=By[index])
-                grp.create_dataset('Bz', (nptl, ), data=Bz[index])
-                grp.create_dataset('Ex', (nptl, ), data=Ex[index])
-                grp.create_dataset('Ey', (nptl, ), data=Ey[index])
-                grp.create_dataset('Ez', (nptl, ), data=Ez[index])
-            if 'Vx' in ptl:
-                grp.create_dataset('Vx', (nptl, ), data=Vx[index])
-                grp.create_dataset('Vy', (nptl, ), data=Vy[index])
-                grp.create_dataset('Vz', (nptl, ), data=Vz[index])
+    config = {"pos_scale": [nx / lx * 0.5, ny / ly * 0.5, nz / lz * 0.5],
+              "pos_shift": [0, ny * 0.25, nz * 0.25]}
+    fname_h5part = filepath + species + additional_info + '.h5part'
+    tracer_transpose.transpose_tracers(fname, fname_h5part, config)
 
 
 def save_reduced_data_in_same_file(rootpath):
@@ -453,27 +342,42 @@ def save_reduced_data_in_same_file(rootpath):
                     grp.create_dataset(str(dset), (sz, ), data=pdata)
 
 
-def sort_particles_by_energies(fname):
-    """Sort particles by their energies
+def get_selection_index(fname):
+    """Get the energy selection index of a H5Part file
+
+    The index keeps the particles with q = 0, so its rows are the particle
+    indices of the file. It is built when it is missing or out of date.
     """
     with h5py.File(fname, 'r') as fh:
-        gnames = fh.keys()
-        nt = len(gnames)
-        gname = 'Step#' + str(nt - 1)
-        group = fh[gname]
-        dset = group['dX']
-        nptl, = dset.shape
-        ptl = {}
-        for dset in group:
-            dset = str(dset)
-            ptl[str(dset)] = read_var(group, dset, nptl)
-    wtype = np.dtype([('q', ptl['q'].dtype), ('index', np.int32),
-                      ('gamma', ptl['gamma'].dtype)])
-    w = np.empty(nptl, dtype=wtype)
-    w['q'] = ptl['q']
-    w['gamma'] = ptl['gamma']
-    w['index'] = np.arange(nptl)
-    ptl_sorted = np.sort(w, order='gamma')
+        nt = len(fh.keys())
+    steps = [(fname, 'Step#' + str(tindex), tindex) for tindex in range(nt)]
+    fname_index = os.path.splitext(fname)[0] + '_selection.h5'
+    return tracer_selection.open_selection_index(steps, fname_index,
+                                                 keep_zero_tags=True)
+
+
+# sorted particles of each H5Part file, computed once in each process
+PTL_SORTED_CACHE = {}
+
+
+def sort_particles_by_energies(fname):
+    """Sort particles by their energies at the last step
+
+    Particles with the same energy are sorted by their tags and indices.
+    """
+    if fname in PTL_SORTED_CACHE:
+        return PTL_SORTED_CACHE[fname]
+    selection = get_selection_index(fname)
+    gamma, qtag, rows = selection.step(selection.tindices[-1])
+    selection.close()
+    wtype = np.dtype([('q', qtag.dtype), ('index', np.int32),
+                      ('gamma', gamma.dtype)])
+    ptl_sorted = np.empty(len(rows), dtype=wtype)
+    # increasing energies
+    ptl_sorted['q'] = qtag[::-1]
+    ptl_sorted['gamma'] = gamma[::-1]
+    ptl_sorted['index'] = rows[::-1]
+    PTL_SORTED_CACHE[fname] = ptl_sorted
     return ptl_sorted
 
 
@@ -684,6 +588,7 @@ if __name__ == "__main__":
             fname_h5traj, fname_h5part, iptl, gamma_type=3)
         # plot_particle_energy(fname_h5traj, fname_h5part, iptl)
 
+    get_selection_index(fname_h5part).close()  # build it before the workers
     ncores = multiprocessing.cpu_count()
     Parallel(n_jobs=ncores)(delayed(processInput)(iptl)
                             for iptl in ptl_indices)
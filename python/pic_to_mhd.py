@@ -21,91 +21,37 @@ from matplotlib.ticker import MaxNLocator
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 from mpl_toolkits.mplot3d import Axes3D
 
+import derived_expr
 import pic_information
-from contour_plots import read_2d_fields
 from json_functions import read_data_from_json
 from shell_functions import mkdir_p
 
 
-def transfer_pic_to_mhd(run_dir, run_name, tframe):
-    """Transfer the required fields
+MHD_VARS = ["vsingle_x", "vsingle_z", "vsingle_y", "absv",
+            "bx", "bz", "by", "absb"]
+
+
+def fill_mhd_frame(source, mhd_data, mime):
+    """Fill the MHD fields of one time frame into a preallocated buffer
+
+    The single-fluid velocity and |B| are evaluated together, so ne and ni
+    are read only once.
 
     Args:
-        run_dir: simulation directory
-        run_name: name of the simulation run
-        tframe: time frame
-        boundary_x: boundary condition along x-direction
-                    0 for periodic; 1 for others
-        boundary_z: boundary condition along z-direction
+        source: GdaSource of the time frame
+        mhd_data: (nz+4, nx+4, 8) buffer
+        mime: ion-to-electron mass ratio
     """
-    print("Time frame: %d" % tframe)
-    picinfo_fname = '../data/pic_info/pic_info_' + run_name + '.json'
-    pic_info = read_data_from_json(picinfo_fname)
-    lx_di = pic_info.lx_di
-    lz_di = pic_info.lz_di
-    kwargs = {"current_time": tframe, "xl": 0, "xr": lx_di,
-              "zb": -0.5 * lz_di, "zt": 0.5 * lz_di}
-    fname = run_dir + "data/bx.gda"
-    x, z, bx = read_2d_fields(pic_info, fname, **kwargs)
-    fname = run_dir + "data/by.gda"
-    x, z, by = read_2d_fields(pic_info, fname, **kwargs)
-    fname = run_dir + "data/bz.gda"
-    x, z, bz = read_2d_fields(pic_info, fname, **kwargs)
-    nx, = x.shape
-    nz, = z.shape
-    mhd_data = np.zeros((nz+4, nx+4, 8), dtype=np.float32)
-
+    nz, _, nx = source.shape
+    names = ["vsingle_x", "vsingle_y", "vsingle_z", "bx", "by", "bz", "absb"]
+    tile = derived_expr.evaluate_tile(source, names, {"mime": mime}, 0, nz)
+    tile["absv"] = derived_expr.evaluate_expr(
+        "sqrt(vsingle_x**2 + vsingle_y**2 + vsingle_z**2)", tile, {})
     # We need to switch y and z directions
-    absB = np.sqrt(bx**2 + by**2 + bz**2)
-    mhd_data[2:nz+2, 2:nx+2, 4] = bx
-    mhd_data[2:nz+2, 2:nx+2, 5] = bz
-    mhd_data[2:nz+2, 2:nx+2, 6] = -by
-    mhd_data[2:nz+2, 2:nx+2, 7] = absB
-
-    del bx, by, bz, absB
-
-    mime = pic_info.mime
-
-    # Electron
-    fname = run_dir + "data/ne.gda"
-    x, z, ne = read_2d_fields(pic_info, fname, **kwargs)
-    fname = run_dir + "data/vex.gda"
-    x, z, vex = read_2d_fields(pic_info, fname, **kwargs)
-    fname = run_dir + "data/vey.gda"
-    x, z, vey = read_2d_fields(pic_info, fname, **kwargs)
-    fname = run_dir + "data/vez.gda"
-    x, z, vez = read_2d_fields(pic_info, fname, **kwargs)
-
-    vx = ne * vex
-    vy = ne * vey
-    vz = ne * vez
-
-    del vex, vey, vez
-
-    # Ion
-    fname = run_dir + "data/ni.gda"
-    x, z, ni = read_2d_fields(pic_info, fname, **kwargs)
-    fname = run_dir + "data/vix.gda"
-    x, z, vix = read_2d_fields(pic_info, fname, **kwargs)
-    fname = run_dir + "data/viy.gda"
-    x, z, viy = read_2d_fields(pic_info, fname, **kwargs)
-    fname = run_dir + "data/viz.gda"
-    x, z, viz = read_2d_fields(pic_info, fname, **kwargs)
-
-    imass = 1.0 / (ne + ni * mime)
-    vx = (vx + ni * mime * vix) * imass
-    vy = (vy + ni * mime * viy) * imass
-    vz = (vz + ni * mime * viz) * imass
-
-    del vix, viy, viz, ne, ni, imass
-
-    absV = np.sqrt(vx**2 + vy**2 + vz**2)
-    mhd_data[2:nz+2, 2:nx+2, 0] = vx
-    mhd_data[2:nz+2, 2:nx+2, 1] = vz
-    mhd_data[2:nz+2, 2:nx+2, 2] = -vy
-    mhd_data[2:nz+2, 2:nx+2, 3] = absV
-
-    del vx, vy, vz, absV
+    for ivar, var in enumerate(MHD_VARS):
+        mhd_data[2:nz+2, 2:nx+2, ivar] = tile[var][:, 0, :]
+        if var in ["vsingle_y", "by"]:
+            mhd_data[2:nz+2, 2:nx+2, ivar] *= -1
 
     # Assuming periodic boundary along x for fields and particles
     # Assuming conducting boundary along z for fields and reflective for particles
@@ -114,12 +60,52 @@ def transfer_pic_to_mhd(run_dir, run_name, tframe):
     mhd_data[0:2, :, :] = mhd_data[3:1:-1, :, :]
     mhd_data[nz+2:, :, :] = mhd_data[nz+1:nz-1:-1, :, :]
 
+
+def transfer_frames(run_dir, run_name, tframes):
+    """Transfer the required fields of some time frames
+
+    One buffer is allocated and reused for all the frames.
+
+    Args:
+        run_dir: simulation directory
+        run_name: name of the simulation run
+        tframes: time frames
+    """
+    picinfo_fname = '../data/pic_info/pic_info_' + run_name + '.json'
+    pic_info = read_data_from_json(picinfo_fname)
+    nx, nz = pic_info.nx, pic_info.nz
+    source = derived_expr.GdaSource(run_dir + "data/", nx, pic_info.ny, nz)
+    mhd_data = np.zeros((nz+4, nx+4, 8), dtype=np.float32)
     fpath = run_dir + 'bin_data/'
     mkdir_p(fpath)
-    fname = fpath + 'mhd_data_' + str(tframe).zfill(4)
-    print(mhd_data.shape)
-    print(np.isfortran(mhd_data))
-    mhd_data.tofile(fname)
+    for tframe in tframes:
+        print("Time frame: %d" % tframe)
+        fill_mhd_frame(source.frame(tframe), mhd_data, pic_info.mime)
+        fname = fpath + 'mhd_data_' + str(tframe).zfill(4)
+        mhd_data.tofile(fname)
+
+
+def transfer_pic_to_mhd(run_dir, run_name, tframe):
+    """Transfer the required fields
+
+    Args:
+        run_dir: simulation directory
+        run_name: name of the simulation run
+        tframe: time frame
+    """
+    transfer_frames(run_dir, run_name, [tframe])
+
+
+def transfer_pic_to_mhd_multi(run_dir, run_name, tframes, ncores):
+    """Transfer the required fields of many time frames in parallel
+
+    Each process takes a contiguous chunk of frames and reuses its buffer.
+    """
+    ncores = min(ncores, len(tframes))
+    chunks = np.array_split(np.asarray(tframes), ncores)
+    Parallel(n_jobs=ncores)(delayed(transfer_frames)(run_dir, run_name,
+                                                     chunk.tolist())
+                            for chunk in chunks)
 
 
 def save_mhd_config(run_name):
@@ -223,7 +209,4 @@ if __name__ == "__main__":
     ncores = multiprocessing.cpu_count()
     ncores = 10
     cts = range(pic_info.ntf)
-    def processInput(job_id):
-        time_frame = job_id
-        transfer_pic_to_mhd(run_dir, run_name, time_frame)
-    Parallel(n_jobs=ncores)(delayed(processInput)(ct) for ct in cts)
+    transfer_pic_to_mhd_multi(run_dir, run_name, cts, ncores)
@@ -25,8 +25,14 @@ from scipy import signal, stats
 from scipy.ndimage.filters import gaussian_filter
 from scipy.special import kv
 
+import curvature_3d
 import fitting_funcs
 import pic_information
+import stencils
+import tracer_diffusion
+import tracer_periodic
+import tracer_selection
+import tracer_stream
 from contour_plots import read_2d_fields
 from joblib import Parallel, delayed
 from json_functions import read_data_from_json
@@ -1760,12 +1766,8 @@ def calc_vexb_kappa(plot_config):
     bx = bx * ib
     by = by * ib
     bz = bz * ib
-    kappax = (bx * np.gradient(bx, axis=1) / dx_de +
-              bz * np.gradient(bx, axis=0) / dz_de)
-    kappay = (bx * np.gradient(by, axis=1) / dx_de +
-              bz * np.gradient(by, axis=0) / dz_de)
-    kappaz = (bx * np.gradient(bz, axis=1) / dx_de +
-              bz * np.gradient(bz, axis=0) / dz_de)
+    stencil = stencils.Stencil(bx.shape, {"dx": dx_de, "dz": dz_de})
+    kappax, kappay, kappaz = stencil.curvature([bx, by, bz])
     kappa = np.sqrt(kappax**2 + kappay**2 + kappaz**2)
     kmin, kmax = 1E-6, 1E2
     nbins = 80
@@ -1819,6 +1821,21 @@ def calc_vexb_kappa(plot_config):
             grp = fh.create_dataset(dname, (nz, nx), data=vexb_kappa)
 
 
+def calc_vexb_kappa_3d(plot_config):
+    """Get the vexb dot magnetic curvature for the 3D simulations
+
+    The slabs of the domain are processed by a pool of processes.
+    """
+    tframe = plot_config["tframe"]
+    pic_run = plot_config["pic_run"]
+    pic_run_dir = plot_config["pic_run_dir"]
+    picinfo_fname = '../data/pic_info/pic_info_' + pic_run + '.json'
+    pic_info = read_data_from_json(picinfo_fname)
+    curvature_3d.calc_vexb_kappa(pic_run_dir, pic_run, pic_info, tframe,
+                                 plot_config["save_volume"],
+                                 plot_config["max_mem"])
+
+
 def vexb_kappa_dist(plot_config, show_plot=True):
     """Get 2D histogram vexb_kappa and kappa
     """
@@ -2078,12 +2095,8 @@ def calc_curvature_radius(plot_config):
     bx = bx * ib
     by = by * ib
     bz = bz * ib
-    kappax = (bx * np.gradient(bx, axis=1) / dx_de +
-              bz * np.gradient(bx, axis=0) / dz_de)
-    kappay = (bx * np.gradient(by, axis=1) / dx_de +
-              bz * np.gradient(by, axis=0) / dz_de)
-    kappaz = (bx * np.gradient(bz, axis=1) / dx_de +
-              bz * np.gradient(bz, axis=0) / dz_de)
+    stencil = stencils.Stencil(bx.shape, {"dx": dx_de, "dz": dz_de})
+    kappax, kappay, kappaz = stencil.curvature([bx, by, bz])
     curv_radius = 1.0 / np.sqrt(kappax**2 + kappay**2 + kappaz**2)
     fig = plt.figure(figsize=[12, 5])
     rect0 = [0.08, 0.55, 0.62, 0.4]
@@ -2442,12 +2455,8 @@ def velocity_profile(plot_config):
     vexb_x = (ey * bz - ez * by) * ib
     vexb_y = (ez * bx - ex * bz) * ib
     vexb_z = (ex * by - ey * bx) * ib
-    kappax = (bx * np.gradient(bx, axis=1) / dx_de +
-              bz * np.gradient(bx, axis=0) / dz_de)
-    kappay = (bx * np.gradient(by, axis=1) / dx_de +
-              bz * np.gradient(by, axis=0) / dz_de)
-    kappaz = (bx * np.gradient(bz, axis=1) / dx_de +
-              bz * np.gradient(bz, axis=0) / dz_de)
+    stencil = stencils.Stencil(bx.shape, {"dx": dx_de, "dz": dz_de})
+    kappax, kappay, kappaz = stencil.curvature([bx, by, bz])
     vexb_kappa = vexb_x * kappax + vexb_y * kappay + vexb_z * kappaz
     fig = plt.figure(figsize=[12, 5])
     rect0 = [0.08, 0.55, 0.62, 0.4]
@@ -4932,29 +4941,7 @@ def adjust_pos(pos, length):
         pos: the position along one axis
         length: the box size along that axis
     """
-    crossings = []
-    offsets = []
-    offset = 0
-    nt, = pos.shape
-    pos_b = np.zeros(nt)
-    pos_b = np.copy(pos)
-    for i in range(nt - 1):
-        if (pos[i] - pos[i + 1] > 0.1 * length):
-            crossings.append(i)
-            offset += length
-            offsets.append(offset)
-        if (pos[i] - pos[i + 1] < -0.1 * length):
-            crossings.append(i)
-            offset -= length
-            offsets.append(offset)
-    nc = len(crossings)
-    if nc > 0:
-        crossings = np.asarray(crossings)
-        offsets = np.asarray(offsets)
-        for i in range(nc - 1):
-            pos_b[crossings[i] + 1:crossings[i + 1] + 1] += offsets[i]
-        pos_b[crossings[nc - 1] + 1:] += offsets[nc - 1]
-    return pos_b
+    return tracer_periodic.unwrap_positions(pos, length)
 
 
 def plot_trajectory_j(plot_config, show_plot=True):
@@ -5370,7 +5357,6 @@ def calc_rates_tracer(plot_config, show_plot=True):
             tindex = int(fsplit[-1])
             tframes.append(tindex)
     tframes = np.sort(np.asarray(tframes))
-    nfiles = len(tframes)
 
     if species in ["e", "electron"]:
         sname = "electron"
@@ -5457,83 +5443,77 @@ def calc_rates_tracer(plot_config, show_plot=True):
     else:
         tracer_interval = pic_info.tracer_interval
     dee_interval = get_time_interval(pic_run)
-    for ifile, tindex_file in enumerate(tframes):
-        print("File %d of %d" % (ifile, nfiles))
-        if pic_run == "turbulent-sheet3D-mixing-sigma100":
-            fname = tracer_dir + 'T.' + str(tindex_file) + '/' + sname + '_tracer_sorted.h5p'
-        else:
-            fname = tracer_dir + 'T.' + str(tindex_file) + '/' + sname + '_tracer_qtag_sorted.h5p'
-        with h5py.File(fname, 'r') as fh:
-            for istep in range(nsteps_file):
-                tindex = tindex_file + istep * tracer_interval
-                tframe = ifile * nsteps_file + istep
-                if tindex > tmax:
-                    break
-                gname = 'Step#' + str(tindex)
-                group = fh[gname]
-                for dset_name in dset_names:
-                    dset = group[dset_name]
-                    dset.read_direct(ptl[dset_name])
-                gamma = np.sqrt(1.0 + ptl["Ux"]**2 + ptl["Uy"]**2 + ptl["Uz"]**2)
-                ene = gamma - 1
-                cond_escape = ene > (ene_final * threshold)  # Close to final energy
-                # Particle should be energetic in the end
-                # cond_escape = np.logical_and(cond_escape, cond_energetic_final)
-                escaped_new = np.logical_and(cond_escape, np.logical_not(escaped_all))
-                escaped_all = np.logical_or(cond_escape, escaped_all)
-                # Particle in acceleration regions should be energetic.
-                # They cannot not be escaped particles at the same time.
-                cond_energetic = ene > (emin * temp/2)  # Energetic enough
-                # cond_energetic = np.logical_and(cond_energetic, cond_energetic_final)
-                acc_high = np.logical_and(cond_energetic, np.logical_not(escaped_all))
-                dene = ptl["Ux"] * ptl["Ex"] + ptl["Uy"] * ptl["Ey"] + ptl["Uz"] * ptl["Ez"]
-                dene /= gamma * pcharge
-                for ibin in range(nbins):
-                    cond_bin = np.logical_and(ene > ebins[ibin], ene <= ebins[ibin+1])
-                    cond = np.logical_and(escaped_new, cond_bin)
-                    dnptl_esc[tframe, ibin] = np.sum(cond)
-                    cond = np.logical_and(escaped_all, cond_bin)
-                    nptl_esc[tframe, ibin] = np.sum(cond)
-                    acc_rate_esc[tframe, ibin] = np.sum(dene[cond] / ene[cond])
-                    cond = np.logical_and(acc_high, cond_bin)
-                    nptl_acc[tframe, ibin] = np.sum(cond)
-                    acc_rate_sum[tframe, ibin] = np.sum(dene[cond] / ene[cond])
-
-                # High-energy particles for calculating energy diffusion
-                if tframe % dee_interval == 0:
-                    ibin_max = -1
-                    ptl_indices = np.zeros((nbins, nptl), dtype=bool)
-                    for ibin in range(nbins):
-                        ptl_indices[ibin] = np.logical_and(ene > ebins[ibin],
-                                                           ene < ebins[ibin+1])
-                        if np.sum(ptl_indices[ibin]) > 0:
-                            ibin_max = ibin
-                    tstart = tframe
-                    gamma_avg = np.zeros([nbins, dee_interval])
-                    dgamma = np.zeros([nbins, dee_interval])
-                for ibin in range(0, ibin_max+1):
-                    # cond = np.logical_and(np.logical_not(escaped_all), ptl_indices[ibin])
-                    # gamma_selected = gamma[cond]
-                    # if np.sum(cond) > 0:
-                    gamma_selected = gamma[ptl_indices[ibin]]
-                    if len(gamma_selected) > 0:
-                        gamma_avg[ibin, tframe-tstart] = np.mean(gamma_selected)
-                        if len(gamma_selected) == 1:
-                            dgamma[ibin, tframe-tstart] = 0.0
-                        else:
-                            dtmp = np.mean(gamma_selected**2) - gamma_avg[ibin, tframe-tstart]**2
-                            if dtmp > 0:
-                                dgamma[ibin, tframe-tstart] = math.sqrt(dtmp)
-                            else:
-                                dgamma[ibin, tframe-tstart] = 0.0
-
-                if (tframe + 1) % dee_interval == 0 or tindex == tmax:
-                    fdir = '../data/power_law_index/rates_tracer/' + pic_run + '/'
-                    mkdir_p(fdir)
-                    fname = fdir + 'gamma_avg_' + str(tframe//dee_interval) + '.dat'
-                    gamma_avg.tofile(fname)
-                    fname = fdir + 'dgamma_' + str(tframe//dee_interval) + '.dat'
-                    dgamma.tofile(fname)
+    if pic_run == "turbulent-sheet3D-mixing-sigma100":
+        file_name = sname + '_tracer_sorted.h5p'
+    else:
+        file_name = sname + '_tracer_qtag_sorted.h5p'
+    steps = tracer_stream.tracer_steps(tracer_dir, tframes, nsteps_file,
+                                       tracer_interval, file_name, tmax)
+    nsteps = len(steps)
+    for tframe, ptl in tracer_stream.stream_tracer_steps(steps, dset_names):
+        tindex = steps[tframe][2]
+        if tframe % 100 == 0:
+            print("Step %d of %d" % (tframe, nsteps))
+        gamma = np.sqrt(1.0 + ptl["Ux"]**2 + ptl["Uy"]**2 + ptl["Uz"]**2)
+        ene = gamma - 1
+        cond_escape = ene > (ene_final * threshold)  # Close to final energy
+        # Particle should be energetic in the end
+        # cond_escape = np.logical_and(cond_escape, cond_energetic_final)
+        escaped_new = np.logical_and(cond_escape, np.logical_not(escaped_all))
+        escaped_all = np.logical_or(cond_escape, escaped_all)
+        # Particle in acceleration regions should be energetic.
+        # They cannot not be escaped particles at the same time.
+        cond_energetic = ene > (emin * temp/2)  # Energetic enough
+        # cond_energetic = np.logical_and(cond_energetic, cond_energetic_final)
+        acc_high = np.logical_and(cond_energetic, np.logical_not(escaped_all))
+        dene = ptl["Ux"] * ptl["Ex"] + ptl["Uy"] * ptl["Ey"] + ptl["Uz"] * ptl["Ez"]
+        dene /= gamma * pcharge
+        for ibin in range(nbins):
+            cond_bin = np.logical_and(ene > ebins[ibin], ene <= ebins[ibin+1])
+            cond = np.logical_and(escaped_new, cond_bin)
+            dnptl_esc[tframe, ibin] = np.sum(cond)
+            cond = np.logical_and(escaped_all, cond_bin)
+            nptl_esc[tframe, ibin] = np.sum(cond)
+            acc_rate_esc[tframe, ibin] = np.sum(dene[cond] / ene[cond])
+            cond = np.logical_and(acc_high, cond_bin)
+            nptl_acc[tframe, ibin] = np.sum(cond)
+            acc_rate_sum[tframe, ibin] = np.sum(dene[cond] / ene[cond])
+
+        # High-energy particles for calculating energy diffusion
+        if tframe % dee_interval == 0:
+            ibin_max = -1
+            ptl_indices = np.zeros((nbins, nptl), dtype=bool)
+            for ibin in range(nbins):
+                ptl_indices[ibin] = np.logical_and(ene > ebins[ibin],
+                                                   ene < ebins[ibin+1])
+                if np.sum(ptl_indices[ibin]) > 0:
+                    ibin_max = ibin
+            tstart = tframe
+            gamma_avg = np.zeros([nbins, dee_interval])
+            dgamma = np.zeros([nbins, dee_interval])
+        for ibin in range(0, ibin_max+1):
+            # cond = np.logical_and(np.logical_not(escaped_all), ptl_indices[ibin])
+            # gamma_selected = gamma[cond]
+            # if np.sum(cond) > 0:
+            gamma_selected = gamma[ptl_indices[ibin]]
+            if len(gamma_selected) > 0:
+                gamma_avg[ibin, tframe-tstart] = np.mean(gamma_selected)
+                if len(gamma_selected) == 1:
+                    dgamma[ibin, tframe-tstart] = 0.0
+                else:
+                    dtmp = np.mean(gamma_selected**2) - gamma_avg[ibin, tframe-tstart]**2
+                    if dtmp > 0:
+                        dgamma[ibin, tframe-tstart] = math.sqrt(dtmp)
+                    else:
+                        dgamma[ibin, tframe-tstart] = 0.0
+
+        if (tframe + 1) % dee_interval == 0 or tindex == tmax:
+            fdir = '../data/power_law_index/rates_tracer/' + pic_run + '/'
+            mkdir_p(fdir)
+            fname = fdir + 'gamma_avg_' + str(tframe//dee_interval) + '.dat'
+            gamma_avg.tofile(fname)
+            fname = fdir + 'dgamma_' + str(tframe//dee_interval) + '.dat'
+            dgamma.tofile(fname)
 
     fdir = '../data/power_law_index/rates_tracer/' + pic_run + '/'
     mkdir_p(fdir)
@@ -5670,6 +5650,51 @@ def reject_outliers(data, m=2):
     return data[abs(data - np.mean(data)) < m * np.std(data)]
 
 
+def energy_diffusion_tracer(plot_config, show_plot=True):
+    """
+    Calculate energy diffusion coefficients and drift rates using tracers
+
+    Args:
+        plot_config: plotting configuration
+    """
+    species = plot_config["species"]
+    pic_run = plot_config["pic_run"]
+    picinfo_fname = '../data/pic_info/pic_info_' + pic_run + '.json'
+    pic_info = read_data_from_json(picinfo_fname)
+    if "3D-Lx150" in pic_run:
+        pic_run_dir = "/net/scratch3/xiaocan/reconnection/Cori_runs/" + pic_run + "/"
+    else:
+        pic_run_dir = pic_info.run_dir
+    dtwpe_tracer = pic_info.dtwpe * pic_info.tracer_interval
+    tracer_dir = pic_run_dir + 'tracer/tracer1/'
+    nfiles = len(os.listdir(tracer_dir))
+
+    if species in ["e", "electron"]:
+        sname = "electron"
+        pmass = 1.0
+        temp = pic_info.Te
+    else:
+        sname = "H"
+        pmass = pic_info.mime
+        temp = pic_info.Ti
+
+    # Check how many steps in each file
+    fname = tracer_dir + 'T.0/' + sname + '_tracer_qtag_sorted.h5p'
+    with h5py.File(fname, 'r') as fh:
+        nsteps_file = len(fh.keys())
+    steps = tracer_stream.sorted_tracer_steps(tracer_dir, sname, nfiles,
+                                              nsteps_file,
+                                              pic_info.tracer_interval)
+    ebins = np.logspace(-1, 3, 41) * temp * pmass
+    lags = [1, 2, 4, 8, 16]
+    res = tracer_diffusion.estimate_diffusion(steps, ebins, lags,
+                                              dtwpe_tracer, pmass=pmass)
+    fdir = '../data/power_law_index/rates_tracer/' + pic_run + '/'
+    mkdir_p(fdir)
+    fname = fdir + 'energy_diffusion_' + species + '.npz'
+    np.savez(fname, **res)
+
+
 def plot_rates_tracer(plot_config, show_plot=True):
     """
     Plot particle acceleration and escape rates using tracer particles
@@ -6366,24 +6391,27 @@ def get_trajectory(plot_config, show_plot=True):
         tinterval = tframes[1] - tframes[0]
         tinterval_file = tinterval
 
-    # Select tracers from the last time step
-    tmax_dir = tframes[-1]
-    fname = tracer_dir + 'T.' + str(tmax_dir) + '/electron_tracer_qtag_sorted.h5p'
+    # Select tracers from the last time step using the selection index,
+    # which keeps the particles with q = 0 so that its rows index the files
+    tracer_interval = pic_info.tracer_interval
+    steps = tracer_stream.sorted_tracer_steps(tracer_dir, sname, nfiles,
+                                              nsteps_file, tracer_interval)
+    fdir = '../data/power_law_index/trajectory/' + pic_run + '/'
+    mkdir_p(fdir)
+    fname_index = fdir + sname + '_selection.h5'
+    selection = tracer_selection.open_selection_index(steps, fname_index,
+                                                      keep_zero_tags=True)
+    tmax = selection.tindices[-1]
+    gamma_final, qtag_final, rows_final = selection.step(tmax)
+    selection.close()
+    fname, gname, _ = steps[-1]
     with h5py.File(fname, 'r') as fh:
-        groups = list(fh.keys())
-        tsteps = [int(group[5:]) for group in groups]
-        tsteps.sort()
-        tmax = tsteps[-1]
-        group = fh['Step#' + str(tmax)]
-        dset = group['dX']
-        nptl, = dset.shape
+        group = fh[gname]
         ptl = {}
         for dset in group:
-            dset = str(dset)
-            ptl[str(dset)] = read_var(group, dset, nptl)
+            ptl[str(dset)] = np.zeros(group[dset].shape, group[dset].dtype)
     nkeys = len(ptl.keys())
-    gamma_final = np.sqrt(1 + ptl["Ux"]**2 + ptl["Uy"]**2 + ptl["Uz"]**2)
-    gamma_max = np.max(gamma_final)
+    gamma_max = gamma_final[0]
     nptl = 200
     band_interval = 5
     nbands = 3
@@ -6394,16 +6422,17 @@ def get_trajectory(plot_config, show_plot=True):
     for iband in range(nbands):
         cond = np.logical_and(gamma_final > gamma_max / band_interval**(iband+1),
                               gamma_final < gamma_max / band_interval**iband)
-        index, = np.where(cond)
+        index = np.sort(rows_final[cond])
         ptl_selected[iband, :] = np.random.choice(index, nptl, replace=False)
     ptl_selected = np.sort(ptl_selected, axis=1)
-    tags = ptl["q"][ptl_selected]
+    qtag = np.zeros(len(rows_final), dtype=qtag_final.dtype)
+    qtag[rows_final] = qtag_final
+    tags = qtag[ptl_selected]
 
     nframes = tmax // tinterval + 1
 
     ptls = np.zeros([nbands, nptl, nframes, nkeys], dtype=np.float32)
 
-    tracer_interval = pic_info.tracer_interval
     for ifile in range(nfiles):
         print("File %d of %d" % (ifile, nfiles))
         tindex_file = ifile * nsteps_file * tracer_interval
@@ -8020,6 +8049,8 @@ def process_run(plot_config, args, pic_run):
     plot_config["pic_run"] = pic_run
     if args.rates_tracer:
         calc_rates_tracer(plot_config, args.show_plot)
+    elif args.ene_diffusion_tracer:
+        energy_diffusion_tracer(plot_config, args.show_plot)
     elif args.ve_kappa_dist:
         vexb_kappa_dist(plot_config, args.show_plot)
     elif args.vel_dist:
@@ -8110,6 +8141,12 @@ def get_cmd_args():
                         help='Multiple particle plot types')
     parser.add_argument('--calc_vexb_kappa', action="store_true", default=False,
                         help='whether to calculate vexb dot magnetic curvature')
+    parser.add_argument('--calc_vexb_kappa_3d', action="store_true", default=False,
+                        help='whether to calculate vexb dot magnetic curvature for 3D runs')
+    parser.add_argument('--save_volume', action="store_true", default=False,
+                        help='whether to save kappa and vexb_kappa volumes')
+    parser.add_argument('--max_mem', action="store", default='4', type=float,
+                        help='memory cap in GB')
     parser.add_argument('--calc_curv_radius', action="store_true", default=False,
                         help='whether to calculate the radius magnetic curvature')
     parser.add_argument('--calc_vdotE', action="store_true", default=False,
@@ -8161,6 +8198,9 @@ def get_cmd_args():
                         help='whether to plot tracer particle trajectory with current density')
     parser.add_argument('--rates_tracer', action="store_true", default=False,
                         help='whether to calculate rates using tracer')
+    parser.add_argument('--ene_diffusion_tracer', action="store_true",
+                        default=False,
+                        help='whether to calculate energy diffusion using tracer')
     parser.add_argument('--plot_rates_tracer', action="store_true", default=False,
                         help='whether to plot rates using tracer')
     parser.add_argument('--rates_sigma_bg', action="store_true", default=False,
@@ -8223,6 +8263,8 @@ def analysis_single_frames(plot_config, args):
             particle_energization(plot_config)
     elif args.calc_vexb_kappa:
         calc_vexb_kappa(plot_config)
+    elif args.calc_vexb_kappa_3d:
+        calc_vexb_kappa_3d(plot_config)
     elif args.calc_curv_radius:
         calc_curvature_radius(plot_config)
     elif args.calc_vdotE:
@@ -8265,6 +8307,8 @@ def analysis_single_frames(plot_config, args):
         plot_trajectory_j(plot_config, args.show_plot)
     elif args.rates_tracer:
         calc_rates_tracer(plot_config, args.show_plot)
+    elif args.ene_diffusion_tracer:
+        energy_diffusion_tracer(plot_config, args.show_plot)
     elif args.plot_rates_tracer:
         plot_rates_tracer(plot_config, args.show_plot)
     elif args.rates_sigma_bg:
@@ -8321,6 +8365,8 @@ def analysis_multi_frames(plot_config, args):
             plot_config["tframe"] = tframe
             if args.calc_vexb_kappa:
                 calc_vexb_kappa(plot_config)
+            elif args.calc_vexb_kappa_3d:
+                calc_vexb_kappa_3d(plot_config)
             elif args.plot_vexb_kappa:
                 plot_vexb_kappa(plot_config, show_plot=False)
             elif args.plot_absj:
@@ -8346,6 +8392,8 @@ def main():
     plot_config["vkappa_threshold"] = args.vkappa_threshold
     plot_config["sigma_type"] = args.sigma_type
     plot_config["bg"] = args.bg
+    plot_config["save_volume"] = args.save_volume
+    plot_config["max_mem"] = int(args.max_mem * 2**30)
     if args.multi_runs:
         analysis_multi_runs(plot_config, args)
     else:
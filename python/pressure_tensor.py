@@ -0,0 +1,170 @@
+"""
+Pressure tensor, pressure anisotropy and instability parameters from the
+hydro_hdf5 and field_hdf5 outputs
+
+The data are streamed in tiles along x. For each tile, one pass computes
+    v<s>x, v<s>y, v<s>z: bulk velocities of species s (e or i)
+    n<s>: number density
+    p<s>xx, ..., p<s>zx: the nine pressure tensor components
+    p<s>para, p<s>perp: pressures parallel and perpendicular to B
+    p<s>agyro: agyrotropy sqrt(Q) (Swisdak 2016)
+    firehose: 1 - (p_para - p_perp) / B^2, unstable when < 0
+    mirror: sum_s beta_perp (beta_perp / beta_para - 1), unstable when > 1
+where p_para and p_perp in the instability parameters are summed over the
+species. The expressions go through derived_expr.evaluate_expr, so they are
+fused by numexpr when it is installed. The results can be saved in
+derived_hdf5/T.<tindex>/pressure_<tindex>.h5 with the same layout as the
+hydro files, so the pressure diagnostics can read them instead.
+"""
+from __future__ import print_function
+
+import os
+
+import h5py
+import numpy as np
+
+from derived_expr import evaluate_expr
+from shell_functions import mkdir_p
+
+HYDRO_VARS = ["rho", "jx", "jy", "jz", "px", "py", "pz",
+              "txx", "tyy", "tzz", "txy", "tyz", "tzx"]
+
+PRESSURE_EXPRS = [
+    ("vx", "jx / rho"), ("vy", "jy / rho"), ("vz", "jz / rho"),
+    ("n", "abs(rho)"),
+    ("xx", "txx - vx*px"), ("yy", "tyy - vy*py"), ("zz", "tzz - vz*pz"),
+    ("yx", "txy - vx*py"), ("xz", "tzx - vz*px"), ("zy", "tyz - vy*pz"),
+    ("xy", "txy - vy*px"), ("yz", "tyz - vz*py"), ("zx", "tzx - vx*pz"),
+    ("para", "(xx*bx**2 + yy*by**2 + zz*bz**2 + (xy + yx)*bx*by + "
+             "(xz + zx)*bx*bz + (yz + zy)*by*bz) / b2"),
+    ("perp", "0.5 * (xx + yy + zz - para)"),
+    ("agyro", "sqrt(abs(1 - 4 * (xx*yy + xx*zz + yy*zz - "
+              "0.25*((xy + yx)**2 + (xz + zx)**2 + (yz + zy)**2)) / "
+              "((xx + yy + zz - para) * (xx + yy + zz + 3*para))))"),
+]
+
+
+def pressure_kernel(bvec, hydro):
+    """Pressure tensor and derived quantities of one tile
+
+    Args:
+        bvec: dictionary of bx, by, bz
+        hydro: dictionary of species ('e' and 'i') -> hydro data
+
+    Returns:
+        res: dictionary of the variables listed in the module docstring
+    """
+    res = dict(bvec)
+    b2 = evaluate_expr("bx**2 + by**2 + bz**2", bvec, {})
+    ptot = {"para": 0, "perp": 0}
+    mirror = 0
+    for species in ["e", "i"]:
+        env = dict(hydro[species])
+        env.update(bvec)
+        env["b2"] = b2
+        for var, expr in PRESSURE_EXPRS:
+            env[var] = evaluate_expr(expr, env, {})
+        for var, _ in PRESSURE_EXPRS:
+            if var in ["vx", "vy", "vz"]:
+                res["v" + species + var[1]] = env[var]
+            elif var == "n":
+                res["n" + species] = env[var]
+            else:
+                res["p" + species + var] = env[var]
+        ptot["para"] = ptot["para"] + env["para"]
+        ptot["perp"] = ptot["perp"] + env["perp"]
+        mirror = mirror + evaluate_expr("2 * perp * (perp / para - 1) / b2",
+                                        env, {})
+    env = {"para": ptot["para"], "perp": ptot["perp"], "b2": b2}
+    res["firehose"] = evaluate_expr("1 - (para - perp) / b2", env, {})
+    res["mirror"] = mirror
+    return res
+
+
+def read_tile(pic_run_dir, tindex, xs, xe, zs, ze):
+    """Read the magnetic field and hydro data of one tile
+
+    Returns:
+        bvec: dictionary of bx, by, bz
+        hydro: dictionary of species ('e' and 'i') -> hydro data
+    """
+    fname = (pic_run_dir + "field_hdf5/T." + str(tindex) +
+             "/fields_" + str(tindex) + ".h5")
+    bvec = {}
+    with h5py.File(fname, 'r') as fh:
+        group = fh["Timestep_" + str(tindex)]
+        for var in ["cbx", "cby", "cbz"]:
+            bvec[var[1:]] = group[var][xs:xe, 0, zs:ze]
+    hydro = {}
+    for species in ["e", "i"]:
+        sname = "electron" if species == 'e' else "ion"
+        fname = (pic_run_dir + "hydro_hdf5/T." + str(tindex) +
+                 "/hydro_" + sname + "_" + str(tindex) + ".h5")
+        hydro[species] = {}
+        with h5py.File(fname, 'r') as fh:
+            group = fh["Timestep_" + str(tindex)]
+            for var in HYDRO_VARS:
+                hydro[species][var] = group[var][xs:xe, 0, zs:ze]
+    return bvec, hydro
+
+
+def derived_file_name(pic_run_dir, tindex):
+    """File name of the saved pressure data
+    """
+    return (pic_run_dir + "derived_hdf5/T." + str(tindex) +
+            "/pressure_" + str(tindex) + ".h5")
+
+
+def calc_pressure(pic_run_dir, tindex, box, nx_tile=256, save=False):
+    """Compute the pressure data of a box tile by tile
+
+    Args:
+        pic_run_dir: PIC run directory
+        tindex: time index
+        box: [xs, zs, xe, ze] in cells
+        nx_tile: number of cells along x in one tile
+        save: whether to save the results in derived_hdf5. The box should
+            be the whole domain in this case.
+
+    Returns:
+        res: dictionary of (xe - xs, ze - zs) arrays
+    """
+    xs, zs, xe, ze = box
+    res = {}
+    for xts in range(xs, xe, nx_tile):
+        xte = min(xts + nx_tile, xe)
+        bvec, hydro = read_tile(pic_run_dir, tindex, xts, xte, zs, ze)
+        tile = pressure_kernel(bvec, hydro)
+        for var in tile:
+            if var not in res:
+                res[var] = np.zeros((xe - xs, ze - zs), dtype=np.float32)
+            res[var][xts-xs:xte-xs] = tile[var]
+    if save:
+        fname = derived_file_name(pic_run_dir, tindex)
+        mkdir_p(os.path.dirname(fname))
+        with h5py.File(fname, 'w') as fh:
+            group = fh.create_group("Timestep_" + str(tindex))
+            for var in res:
+                group.create_dataset(var, data=res[var][:, np.newaxis, :])
+    return res
+
+
+def read_pressure(pic_run_dir, tindex, box, varnames=None):
+    """Read the saved pressure data of a box
+
+    Returns:
+        res: dictionary of (xe - xs, ze - zs) arrays, or None when the
+            data are not saved
+    """
+    fname = derived_file_name(pic_run_dir, tindex)
+    if not os.path.isfile(fname):
+        return None
+    xs, zs, xe, ze = box
+    res = {}
+    with h5py.File(fname, 'r') as fh:
+        group = fh["Timestep_" + str(tindex)]
+        if varnames is None:
+            varnames = list(group.keys())
+        for var in varnames:
+            res[var] = group[var][xs:xe, 0, zs:ze]
+    return res
@@ -26,6 +26,7 @@ from scipy.special import erf
 
 import fitting_funcs
 import pic_information
+import pressure_tensor
 from contour_plots import read_2d_fields
 from joblib import Parallel, delayed
 from json_functions import read_data_from_json
@@ -93,8 +94,13 @@ def read_var(group, dset_name, sz):
     return fdata
 
 
-def get_bfield_pressure(plot_config, box=[0, 0, 1, 1]):
+def get_bfield_pressure(plot_config, box=[0, 0, 1, 1], varnames=None):
     """Get magnetic field and pressure tensor
+
+    Args:
+        plot_config: plotting configuration
+        box: [xs, zs, xe, ze] in cells. [0, 0, 1, 1] for the whole domain.
+        varnames: variables to read when the pressure data are saved
     """
     tframe = plot_config["tframe"]
     pic_run = plot_config["pic_run"]
@@ -103,75 +109,31 @@ def get_bfield_pressure(plot_config, box=[0, 0, 1, 1]):
     pic_run_dir = pic_info.run_dir
     fields_interval = pic_info.fields_interval
     tindex = fields_interval * tframe
-    vpic_info = get_vpic_info(pic_run_dir)
-    vthe = vpic_info["vtheb/c"]
-    n0 = vpic_info["n0"]
-    pnorm = n0 * vthe**2
     if box == [0, 0, 1, 1]:
         xs, xe = 0, pic_info.nx
         zs, ze = 0, pic_info.nz
     else:
         xs, zs, xe, ze = box
 
-    vecb_pre = {}
-
-    # Magnetic field
-    fname = (pic_run_dir + "field_hdf5/T." + str(tindex) +
-             "/fields_" + str(tindex) + ".h5")
-    with h5py.File(fname, 'r') as fh:
-        group = fh["Timestep_" + str(tindex)]
-        for var in ["cbx", "cby", "cbz"]:
-            dset = group[var]
-            var_name = var[1:]
-            vecb_pre[var_name]= dset[xs:xe, 0, zs:ze]
+    box = [xs, zs, xe, ze]
+    vecb_pre = pressure_tensor.read_pressure(pic_run_dir, tindex, box,
+                                             varnames)
+    if vecb_pre is None:
+        vecb_pre = pressure_tensor.calc_pressure(pic_run_dir, tindex, box)
 
-    absB = np.sqrt(vecb_pre["bx"]**2 + vecb_pre["by"]**2 + vecb_pre["bz"]**2)
+    return vecb_pre
 
-    for species in ["e", "i"]:
-        sname = "electron" if species == 'e' else "ion"
-        fname = (pic_run_dir + "hydro_hdf5/T." + str(tindex) +
-                 "/hydro_" + sname + "_" + str(tindex) + ".h5")
-        hydro = {}
-        with h5py.File(fname, 'r') as fh:
-            group = fh["Timestep_" + str(tindex)]
-            for var in group:
-                dset = group[var]
-                hydro[var]= dset[xs:xe, 0, zs:ze]
 
-        irho = 1.0 / hydro["rho"]
-        vx = hydro["jx"] * irho
-        vy = hydro["jy"] * irho
-        vz = hydro["jz"] * irho
-        var = "v" + species
-        vecb_pre[var+"x"] = vx
-        vecb_pre[var+"y"] = vy
-        vecb_pre[var+"z"] = vz
-        vecb_pre["n"+species] = np.abs(hydro["rho"])
-        vpar = "p" + species
-        vecb_pre[vpar+"xx"] = hydro["txx"] - vx * hydro["px"]
-        vecb_pre[vpar+"yy"] = hydro["tyy"] - vy * hydro["py"]
-        vecb_pre[vpar+"zz"] = hydro["tzz"] - vz * hydro["pz"]
-        vecb_pre[vpar+"yx"] = hydro["txy"] - vx * hydro["py"]
-        vecb_pre[vpar+"xz"] = hydro["tzx"] - vz * hydro["px"]
-        vecb_pre[vpar+"zy"] = hydro["tyz"] - vy * hydro["pz"]
-        vecb_pre[vpar+"xy"] = hydro["txy"] - vy * hydro["px"]
-        vecb_pre[vpar+"yz"] = hydro["tyz"] - vz * hydro["py"]
-        vecb_pre[vpar+"zx"] = hydro["tzx"] - vx * hydro["pz"]
-
-        # Parallel and perpendicular pressure
-        vname1 = vpar + "para"
-        vecb_pre[vname1] = (vecb_pre[vpar+"xx"] * vecb_pre["bx"]**2 +
-                            vecb_pre[vpar+"yy"] * vecb_pre["by"]**2 +
-                            vecb_pre[vpar+"zz"] * vecb_pre["bz"]**2 +
-                            (vecb_pre[vpar+"xy"] + vecb_pre[vpar+"yx"]) * vecb_pre["bx"] * vecb_pre["by"] +
-                            (vecb_pre[vpar+"xz"] + vecb_pre[vpar+"zx"]) * vecb_pre["bx"] * vecb_pre["bz"] +
-                            (vecb_pre[vpar+"yz"] + vecb_pre[vpar+"zy"]) * vecb_pre["by"] * vecb_pre["bz"])
-        vecb_pre[vname1] /= absB * absB
-        vname2 = vpar + "perp"
-        vecb_pre[vname2] = 0.5 * (vecb_pre[vpar+"xx"] + vecb_pre[vpar+"yy"] +
-                                  vecb_pre[vpar+"zz"] - vecb_pre[vname1])
-
-    return vecb_pre
+def save_pressure(plot_config):
+    """Save the pressure tensor, anisotropy and instability parameters
+    """
+    tframe = plot_config["tframe"]
+    pic_run = plot_config["pic_run"]
+    picinfo_fname = '../data/pic_info/pic_info_' + pic_run + '.json'
+    pic_info = read_data_from_json(picinfo_fname)
+    tindex = pic_info.fields_interval * tframe
+    box = [0, 0, pic_info.nx, pic_info.nz]
+    pressure_tensor.calc_pressure(pic_info.run_dir, tindex, box, save=True)
 
 
 def plot_absj(plot_config, show_plot=True):
@@ -4677,19 +4639,10 @@ def firehose_parameter(plot_config, show_plot=True):
     nb = n0 * nb_n0
     p0 = nb * Te * Tbe_Te
 
-    bvec_pre = get_bfield_pressure(plot_config, box=[xs, zs, xe, ze])
+    bvec_pre = get_bfield_pressure(plot_config, box=[xs, zs, xe, ze],
+                                   varnames=["firehose"])
     sigma = 3
-    bvec_pre["bx"] = gaussian_filter(bvec_pre["bx"], sigma=sigma).T
-    bvec_pre["by"] = gaussian_filter(bvec_pre["by"], sigma=sigma).T
-    bvec_pre["bz"] = gaussian_filter(bvec_pre["bz"], sigma=sigma).T
-    bvec_pre["pepara"] = gaussian_filter(bvec_pre["pepara"], sigma=sigma).T
-    bvec_pre["pipara"] = gaussian_filter(bvec_pre["pipara"], sigma=sigma).T
-    bvec_pre["peperp"] = gaussian_filter(bvec_pre["peperp"], sigma=sigma).T
-    bvec_pre["piperp"] = gaussian_filter(bvec_pre["piperp"], sigma=sigma).T
-    b2 = bvec_pre["bx"]**2 + bvec_pre["by"]**2 + bvec_pre["bz"]**2
-    ppara = bvec_pre["pepara"] + bvec_pre["pipara"]
-    pperp = bvec_pre["peperp"] + bvec_pre["piperp"]
-    firehose = 1 - (ppara - pperp) / b2
+    firehose = gaussian_filter(bvec_pre["firehose"], sigma=sigma).T
 
     fig = plt.figure(figsize=[7, 3.5])
     rect = [0.12, 0.17, 0.78, 0.73]
@@ -4803,20 +4756,11 @@ def firehose_parameter_zcut(plot_config, show_plot=True):
     p0 = nb * Te * Tbe_Te
     beta0 = Tbe_Te
 
-    bvec_pre = get_bfield_pressure(plot_config, box=[xs, zs, xe, ze])
+    bvec_pre = get_bfield_pressure(plot_config, box=[xs, zs, xe, ze],
+                                   varnames=["firehose", "bx"])
     sigma = 3
-    bvec_pre["bx"] = gaussian_filter(bvec_pre["bx"], sigma=sigma)
-    bvec_pre["by"] = gaussian_filter(bvec_pre["by"], sigma=sigma)
-    bvec_pre["bz"] = gaussian_filter(bvec_pre["bz"], sigma=sigma)
-    bvec_pre["pepara"] = gaussian_filter(bvec_pre["pepara"], sigma=sigma)
-    bvec_pre["pipara"] = gaussian_filter(bvec_pre["pipara"], sigma=sigma)
-    bvec_pre["peperp"] = gaussian_filter(bvec_pre["peperp"], sigma=sigma)
-    bvec_pre["piperp"] = gaussian_filter(bvec_pre["piperp"], sigma=sigma)
-    b2 = bvec_pre["bx"]**2 + bvec_pre["by"]**2 + bvec_pre["bz"]**2
-    ppara = bvec_pre["pepara"] + bvec_pre["pipara"]
-    pperp = bvec_pre["peperp"] + bvec_pre["piperp"]
-    firehose = 1 - (ppara - pperp) / b2
-    bx = np.abs(bvec_pre["bx"] / b0)
+    firehose = gaussian_filter(bvec_pre["firehose"], sigma=sigma)
+    bx = np.abs(gaussian_filter(bvec_pre["bx"], sigma=sigma) / b0)
     # firehose_model = 1 + 0.5 * beta0 * (1/bx - 1/bx**4)
     # Because we didn't use relativistic injection. The electron thermal
     # pressure is smaller than expected.
@@ -12539,6 +12483,8 @@ def get_cmd_args():
                         help='whether to firehose parameter cut along z')
     parser.add_argument('--pxyz', action="store_true", default=False,
                         help='whether to pxx, pyy, pzz cut along z')
+    parser.add_argument('--save_pressure', action="store_true", default=False,
+                        help='whether to save pressure tensor and anisotropy')
     parser.add_argument('--plot_pres', action="store_true", default=False,
                         help='whether to plot pressure')
     parser.add_argument('--plot_temp', action="store_true", default=False,
@@ -12688,6 +12634,8 @@ def analysis_single_frames(plot_config, args):
         firehose_parameter_zcut(plot_config, args.show_plot)
     elif args.pxyz:
         pxyz_zcut(plot_config, args.show_plot)
+    elif args.save_pressure:
+        save_pressure(plot_config)
     elif args.plot_pres:
         plot_pres(plot_config, args.show_plot)
     elif args.pres_avg:
@@ -12793,6 +12741,8 @@ def process_input(plot_config, args, tframe):
         calc_peak_vout(plot_config, show_plot=False)
     elif args.bx_rho:
         get_bx_rho(plot_config, show_plot=False)
+    elif args.save_pressure:
+        save_pressure(plot_config)
 
 
 def analysis_multi_frames(plot_config, args):
@@ -21,6 +21,7 @@ from scipy.optimize import curve_fit
 
 import fitting_funcs
 import pic_information
+import tracer_stream
 from contour_plots import read_2d_fields
 from joblib import Parallel, delayed
 from json_functions import read_data_from_json
@@ -621,75 +622,64 @@ def calc_wpara_wperp(plot_config, show_plot=True):
     fdir = '../data/relativistic_turbulence/wpara_wperp/' + pic_run + '/'
     mkdir_p(fdir)
 
-    for tframe in range(nframes):
-        print("Time frame %d of %d" % (tframe, nframes))
-        tindex0 = tframe * pic_info.tracer_interval * plot_config["nsteps"]
-        fname = (tracer_dir + 'T.' + str(tindex0) + '/' +
-                 sname + '_tracer_qtag_sorted.h5p')
-        fh = h5py.File(fname, 'r')
-        for step in range(plot_config["nsteps"]):
-            tindex = step * pic_info.tracer_interval + tindex0
-            print("Time index: %d" % tindex)
-            gname = 'Step#' + str(tindex)
-            if not gname in fh:
-                break
-            group = fh[gname]
-            ptl = {}
-            for dset in group:
-                dset = str(dset)
-                ptl[str(dset)] = read_var(group, dset, nptl)
-            ux = ptl["Ux"]
-            uy = ptl["Uy"]
-            uz = ptl["Uz"]
-            gamma = np.sqrt(1.0 + ux**2 + uy**2 + uz**2)
-            dgamma = gamma - gamma0
-            dgamma_pos = np.copy(dgamma)
-            ib2 = 1.0 / (ptl["Bx"]**2 + ptl["By"]**2 + ptl["Bz"]**2)
-            edotb = ptl["Ex"] * ptl["Bx"] + ptl["Ey"] * ptl["By"] + ptl["Ez"] * ptl["Bz"]
-            eparax = edotb * ptl["Bx"] * ib2
-            eparay = edotb * ptl["By"] * ib2
-            eparaz = edotb * ptl["Bz"] * ib2
-            eperpx = ptl["Ex"] - eparax
-            eperpy = ptl["Ey"] - eparay
-            eperpz = ptl["Ez"] - eparaz
-            igamma = 1.0 / gamma
-            vx = ux * igamma
-            vy = uy * igamma
-            vz = uz * igamma
-            dene_para[0, :] += -vx * eparax
-            dene_para[1, :] += -vy * eparay
-            dene_para[2, :] += -vz * eparaz
-            dene_para[3, :] = np.sum(dene_para[:3, :], axis=0)
-            dene_perp[0, :] += -vx * eperpx
-            dene_perp[1, :] += -vy * eperpy
-            dene_perp[2, :] += -vz * eperpz
-            dene_perp[3, :] = np.sum(dene_perp[:3, :], axis=0)
-            dene_para *= dtwpe_tracer
-            dene_perp *= dtwpe_tracer
-            cond = np.logical_and(dgamma_pre < 0.5 * sigma_e, dgamma_pos > 0.5 * sigma_e)
-            cond = np.logical_and(cond, np.logical_not(cross_half_sigmae))
-            dene_para_cross[:, cond] = dene_para[:, cond]
-            dene_perp_cross[:, cond] = dene_perp[:, cond]
-            dgamma_pre = np.copy(dgamma_pos)
-
-            istep = tindex // pic_info.tracer_interval
-            if istep % plot_interval == 0:
-                fname = fdir + 'wpara_cross_' + str(istep) + '.dat'
-                dene_para_cross.tofile(fname)
-                fname = fdir + 'wperp_cross_' + str(istep) + '.dat'
-                dene_perp_cross.tofile(fname)
-                fname = fdir + 'wpara_' + str(istep) + '.dat'
-                dene_para.tofile(fname)
-                fname = fdir + 'wperp_' + str(istep) + '.dat'
-                dene_perp.tofile(fname)
-                fdata = cross_half_sigmae.astype(int)
-                fname = fdir + 'cross_half_sigma_' + str(istep) + '.dat'
-                fdata.tofile(fname)
+    steps = tracer_stream.sorted_tracer_steps(tracer_dir, sname, nframes,
+                                              plot_config["nsteps"],
+                                              pic_info.tracer_interval)
+    varnames = ["Ux", "Uy", "Uz", "Ex", "Ey", "Ez", "Bx", "By", "Bz"]
+    for istep_read, ptl in tracer_stream.stream_tracer_steps(steps, varnames):
+        tindex = steps[istep_read][2]
+        print("Time index: %d" % tindex)
+        ux = ptl["Ux"]
+        uy = ptl["Uy"]
+        uz = ptl["Uz"]
+        gamma = np.sqrt(1.0 + ux**2 + uy**2 + uz**2)
+        dgamma = gamma - gamma0
+        dgamma_pos = np.copy(dgamma)
+        ib2 = 1.0 / (ptl["Bx"]**2 + ptl["By"]**2 + ptl["Bz"]**2)
+        edotb = ptl["Ex"] * ptl["Bx"] + ptl["Ey"] * ptl["By"] + ptl["Ez"] * ptl["Bz"]
+        eparax = edotb * ptl["Bx"] * ib2
+        eparay = edotb * ptl["By"] * ib2
+        eparaz = edotb * ptl["Bz"] * ib2
+        eperpx = ptl["Ex"] - eparax
+        eperpy = ptl["Ey"] - eparay
+        eperpz = ptl["Ez"] - eparaz
+        igamma = 1.0 / gamma
+        vx = ux * igamma
+        vy = uy * igamma
+        vz = uz * igamma
+        dene_para[0, :] += -vx * eparax
+        dene_para[1, :] += -vy * eparay
+        dene_para[2, :] += -vz * eparaz
+        dene_para[3, :] = np.sum(dene_para[:3, :], axis=0)
+        dene_perp[0, :] += -vx * eperpx
+        dene_perp[1, :] += -vy * eperpy
+        dene_perp[2, :] += -vz * eperpz
+        dene_perp[3, :] = np.sum(dene_perp[:3, :], axis=0)
+        dene_para *= dtwpe_tracer
+        dene_perp *= dtwpe_tracer
+        cond = np.logical_and(dgamma_pre < 0.5 * sigma_e, dgamma_pos > 0.5 * sigma_e)
+        cond = np.logical_and(cond, np.logical_not(cross_half_sigmae))
+        dene_para_cross[:, cond] = dene_para[:, cond]
+        dene_perp_cross[:, cond] = dene_perp[:, cond]
+        dgamma_pre = np.copy(dgamma_pos)
+
+        istep = tindex // pic_info.tracer_interval
+        if istep % plot_interval == 0:
+            fname = fdir + 'wpara_cross_' + str(istep) + '.dat'
+            dene_para_cross.tofile(fname)
+            fname = fdir + 'wperp_cross_' + str(istep) + '.dat'
+            dene_perp_cross.tofile(fname)
+            fname = fdir + 'wpara_' + str(istep) + '.dat'
+            dene_para.tofile(fname)
+            fname = fdir + 'wperp_' + str(istep) + '.dat'
+            dene_perp.tofile(fname)
+            fdata = cross_half_sigmae.astype(int)
+            fname = fdir + 'cross_half_sigma_' + str(istep) + '.dat'
+            fdata.tofile(fname)
 
-            cross_half_sigmae = np.logical_or(cond, cross_half_sigmae)
-            dene_para /= dtwpe_tracer
-            dene_perp /= dtwpe_tracer
-        fh.close()
+        cross_half_sigmae = np.logical_or(cond, cross_half_sigmae)
+        dene_para /= dtwpe_tracer
+        dene_perp /= dtwpe_tracer
 
 
 def plot_wpara_wperp(plot_config, show_plot=True):
@@ -10,15 +10,14 @@ import struct
 
 import matplotlib.pyplot as plt
 import numpy as np
-from joblib import Parallel, delayed
-from scipy.ndimage.filters import gaussian_filter, median_filter
 
 from contour_plots import read_2d_fields
-from dolointerpolation import MultilinearInterpolator
+import field_filters
+import yee_stagger
 from energy_conversion import read_data_from_json
 
 
-def smooth_interp_emf(run_dir, pic_info, eb_field_name, tframe, coords):
+def smooth_interp_emf(run_dir, pic_info, eb_field_name, tframe):
     """
     Smooth electric and magnetic field and also interpolate them to
     grid locations where hydro quantities are.
@@ -33,35 +32,11 @@ def smooth_interp_emf(run_dir, pic_info, eb_field_name, tframe, coords):
         return
     else:
         x, z, fdata = read_2d_fields(pic_info, fname, **kwargs)
-    if 'ex' in eb_field_name or 'bz' in eb_field_name:
-        f = MultilinearInterpolator(coords["smin_ex_bz"],
-                                    coords["smax_ex_bz"],
-                                    coords["orders"],
-                                    dtype=np.float32)
-    elif 'ez' in eb_field_name or 'bx' in eb_field_name:
-        f = MultilinearInterpolator(coords["smin_ez_bx"],
-                                    coords["smax_ez_bx"],
-                                    coords["orders"],
-                                    dtype=np.float32)
-    elif 'ey' in eb_field_name:
-        f = MultilinearInterpolator(coords["smin_h"],
-                                    coords["smax_h"],
-                                    coords["orders"],
-                                    dtype=np.float32)
-    else:
-        f = MultilinearInterpolator(coords["smin_by"],
-                                    coords["smax_by"],
-                                    coords["orders"],
-                                    dtype=np.float32)
-    f.set_values(np.atleast_2d(np.transpose(fdata).flatten()))
-    nx = pic_info.nx
-    nz = pic_info.nz
-    fdata = f(coords["coord"])
-    fdata = np.transpose(f(coords["coord"]).reshape((nx, nz)))
+    yee_stagger.interp_node(fdata, eb_field_name)
     # only smooth electric field
     if any(ename in eb_field_name for ename in ['ex', 'ey', 'ez']):
         sigma = 3
-        fdata = gaussian_filter(fdata, sigma)
+        fdata = field_filters.smooth(fdata, 'gaussian', sigma)
     fname = run_dir + "data/" + eb_field_name + ".gda"
     with open(fname, 'a+') as f:
         offset = size_one_frame * tframe
@@ -85,7 +60,7 @@ def smooth_emf(run_dir, pic_info, emf_name, tframe, coords):
     else:
         x, z, fdata = read_2d_fields(pic_info, fname, **kwargs)
     sigma = 5
-    fdata = median_filter(fdata, sigma)
+    fdata = field_filters.smooth(fdata, 'median', sigma)
     # fname = run_dir + "data/" + emf_name + ".gda"
     fname = run_dir + "data1/" + emf_name + ".gda"
     with open(fname, 'a+') as f:
@@ -131,6 +106,22 @@ def check_exb(run_dir, pic_info, tframe):
     plt.show()
 
 
+def smooth_emf_frames(run_dir, pic_info, emf_name, ncores=None):
+    """
+    Smooth electric and magnetic field of all available time frames,
+    which are batched across processes
+    """
+    size_one_frame = pic_info.nx * pic_info.nz * 4
+    fname_in = run_dir + "data1/original_data/" + emf_name + ".gda"
+    fname_out = run_dir + "data1/" + emf_name + ".gda"
+    nframes = min(os.stat(fname_in).st_size // size_one_frame, pic_info.ntf)
+    if nframes == 0:
+        return
+    config = {"method": "median", "size": 5}
+    field_filters.smooth_gda(fname_in, fname_out, (pic_info.nz, pic_info.nx),
+                             list(range(nframes)), config, ncores)
+
+
 def get_coordinates(pic_info):
     """Get the coordinates where the fields are
     """
@@ -210,22 +201,17 @@ if __name__ == "__main__":
     run_efields = [{"run_name": run_name, "efield_name": efield_name}
                    for run_name, efield_name
                    in itertools.product(run_names, efield_names)]
-    # smooth_interp_emf(run_dir, pic_info, 'ex', 10, coords)
+    # smooth_interp_emf(run_dir, pic_info, 'ex', 10)
     # for tframe in range(10):
-    #     smooth_interp_emf(run_dir, pic_info, 'ex', tframe, coords)
+    #     smooth_interp_emf(run_dir, pic_info, 'ex', tframe)
     # check_exb(run_dir, pic_info, 50)
-    def processInput(run_efield):
+    ncores = multiprocessing.cpu_count()
+    for run_efield in run_efields:
         run_name = run_efield["run_name"]
         picinfo_fname = '../data/pic_info/pic_info_' + run_name + '.json'
         pic_info = read_data_from_json(picinfo_fname)
-        coords = get_coordinates(pic_info)
-        tframes = range(pic_info.ntf)
         efield_name = run_efield["efield_name"]
         print("Run name and electric field name: %s %s" % (run_name, efield_name))
         run_dir = runs_root_dir + run_name + '/'
-        for tframe in tframes:
-            # smooth_interp_emf(run_dir, pic_info, efield_name, tframe, coords)
-            smooth_emf(run_dir, pic_info, efield_name, tframe, coords)
-    ncores = multiprocessing.cpu_count()
-    Parallel(n_jobs=ncores)(delayed(processInput)(run_efield)
-                            for run_efield in run_efields)
+        # smooth_interp_emf(run_dir, pic_info, efield_name, tframe)
+        smooth_emf_frames(run_dir, pic_info, efield_name, ncores)
@@ -0,0 +1,256 @@
+"""
+Spatially resolved (local) spectrum cube stored on disk
+
+The cube is a raw float32 file with shape (nz, ny, nx, nbins) in C order,
+where nz = nzones * mpi_sizez. It is the same layout as the spectrum.gda
+files read by local_spectrum.plot_spectrum, so it can still be read with
+np.fromfile. A JSON file next to it stores the shape and energy bins.
+Queries go through np.memmap and only touch the cells they need.
+"""
+from __future__ import print_function
+
+import json
+import math
+import multiprocessing
+import os
+
+import numpy as np
+from joblib import Parallel, delayed
+
+from shell_functions import mkdir_p
+
+
+def cube_meta_name(fname):
+    """Get the file name of the meta data of a spectrum cube
+    """
+    return os.path.splitext(fname)[0] + '.json'
+
+
+def rank_spectrum_name(pic_run_dir, spect_dir, species, tindex,
+                       mpi_rank, num_fold):
+    """Get the file name of the local spectrum dumped by one MPI rank
+    """
+    findex = mpi_rank // num_fold
+    fdir = (pic_run_dir + spect_dir + '/' + str(findex) +
+            '/T.' + str(tindex) + '/')
+    fname = (fdir + 'spectrum-' + species + 'hydro.' +
+             str(tindex) + '.' + str(mpi_rank))
+    return fname
+
+
+def cube_ebins(emin, emax, nbins):
+    """Energy bins used by the local spectrum dump
+
+    Args:
+        emin, emax: minimum and maximum energy
+        nbins: number of energy bins
+    """
+    delog = (math.log10(emax) - math.log10(emin)) / (nbins - 1)
+    emin = 10**(math.log10(emin) - delog)
+    ebins = np.logspace(math.log10(emin), math.log10(emax), nbins + 1)
+    return ebins
+
+
+def create_spectrum_cube(fname, shape, ebins=None):
+    """Create an empty spectrum cube and its meta data
+
+    Args:
+        fname: file name of the cube
+        shape: (nz, ny, nx, nbins)
+        ebins: energy bin edges
+    """
+    fdir = os.path.dirname(fname)
+    if fdir:
+        mkdir_p(fdir)
+    fspect = np.memmap(fname, dtype=np.float32, mode='w+', shape=shape)
+    del fspect  # the file is now allocated
+    meta = {'shape': list(shape), 'dtype': 'float32'}
+    if ebins is not None:
+        meta['ebins'] = np.asarray(ebins).tolist()
+    with open(cube_meta_name(fname), 'w') as fh:
+        json.dump(meta, fh)
+
+
+def open_spectrum_cube(fname, mode='r'):
+    """Open a spectrum cube as a memory map
+
+    Args:
+        fname: file name of the cube
+        mode: memmap mode
+
+    Returns:
+        fspect: (nz, ny, nx, nbins) memory-mapped array
+        meta: dictionary with the shape and the energy bins
+    """
+    with open(cube_meta_name(fname), 'r') as fh:
+        meta = json.load(fh)
+    shape = tuple(meta['shape'])
+    fspect = np.memmap(fname, dtype=meta['dtype'], mode=mode, shape=shape)
+    if 'ebins' in meta:
+        meta['ebins'] = np.asarray(meta['ebins'])
+    return fspect, meta
+
+
+def assemble_ranks(fname, ranks, config):
+    """Read the local spectra of some MPI ranks and put them into the cube
+
+    Each worker opens its own memory map and writes to disjoint cells,
+    so the workers do not need to communicate.
+
+    Args:
+        fname: file name of the cube
+        ranks: MPI ranks handled by this worker
+        config: dictionary with the run configuration
+    """
+    mpi_sizex = config["mpi_sizex"]
+    mpi_sizey = config["mpi_sizey"]
+    nzones = config["nzones"]
+    nbins = config["nbins"]
+    nxy = mpi_sizex * mpi_sizey
+    fspect, _ = open_spectrum_cube(fname, mode='r+')
+    for mpi_rank in ranks:
+        iz = mpi_rank // nxy
+        iy = (mpi_rank % nxy) // mpi_sizex
+        ix = mpi_rank % mpi_sizex
+        fname_rank = rank_spectrum_name(config["pic_run_dir"],
+                                        config["spect_dir"],
+                                        config["species"], config["tindex"],
+                                        mpi_rank, config["num_fold"])
+        fdata = np.fromfile(fname_rank, dtype=np.float32)
+        fspect[iz*nzones:(iz+1)*nzones, iy, ix, :] = fdata.reshape((nzones, nbins))
+    fspect.flush()
+    del fspect
+
+
+def assemble_spectrum_cube(config, fname, ncores=None, ranks_per_job=256):
+    """Assemble the local spectra of all MPI ranks into one cube
+
+    Args:
+        config: dictionary with pic_run_dir, spect_dir, species, tindex,
+            mpi_size, mpi_sizex, mpi_sizey, mpi_sizez, num_fold, nbins,
+            emin, emax
+        fname: file name of the cube
+        ncores: number of processes
+        ranks_per_job: number of MPI ranks read by one job
+    """
+    nbins = config["nbins"]
+    fname_rank = rank_spectrum_name(config["pic_run_dir"], config["spect_dir"],
+                                    config["species"], config["tindex"],
+                                    0, config["num_fold"])
+    fdata = np.fromfile(fname_rank, dtype=np.float32)
+    nzones = fdata.shape[0] // nbins
+    config = dict(config)
+    config["nzones"] = nzones
+    shape = (nzones * config["mpi_sizez"], config["mpi_sizey"],
+             config["mpi_sizex"], nbins)
+    ebins = cube_ebins(config["emin"], config["emax"], nbins)
+    create_spectrum_cube(fname, shape, ebins)
+    mpi_size = config["mpi_size"]
+    jobs = [range(rank, min(rank + ranks_per_job, mpi_size))
+            for rank in range(0, mpi_size, ranks_per_job)]
+    if ncores is None:
+        ncores = multiprocessing.cpu_count()
+    Parallel(n_jobs=ncores)(delayed(assemble_ranks)(fname, ranks, config)
+                            for ranks in jobs)
+
+
+def box_spectrum(fspect, zrange, yrange, xrange):
+    """Summed spectrum in a box of cells
+
+    Args:
+        fspect: spectrum cube
+        zrange, yrange, xrange: [start, end) cell indices along each axis
+    """
+    zs, ze = zrange
+    ys, ye = yrange
+    xs, xe = xrange
+    fbox = np.zeros(fspect.shape[-1], dtype=np.float64)
+    for iz in range(zs, ze):
+        fbox += np.sum(fspect[iz, ys:ye, xs:xe, :], axis=(0, 1), dtype=np.float64)
+    return fbox
+
+
+def masked_spectrum(fspect, mask):
+    """Summed spectrum of the cells selected by a mask
+
+    Only the z-planes that have selected cells are read.
+
+    Args:
+        fspect: spectrum cube
+        mask: boolean array with shape (nz, ny, nx)
+    """
+    nz, ny, nx, nbins = fspect.shape
+    if mask.shape != (nz, ny, nx):
+        raise ValueError("mask shape %s does not match cube shape %s" %
+                         (str(mask.shape), str((nz, ny, nx))))
+    fmask = np.zeros(nbins, dtype=np.float64)
+    for iz in np.nonzero(np.any(mask, axis=(1, 2)))[0]:
+        fmask += np.sum(fspect[iz][mask[iz]], axis=0, dtype=np.float64)
+    return fmask
+
+
+def reduce_to_cube_grid(fdata, shape):
+    """Average a 3D field onto the cells of a spectrum cube
+
+    Args:
+        fdata: field data with shape (nzf, nyf, nxf)
+        shape: (nz, ny, nx) of the cube. nzf, nyf, nxf have to be
+            multiples of nz, ny, nx.
+    """
+    nz, ny, nx = shape
+    nzf, nyf, nxf = fdata.shape
+    if nzf % nz or nyf % ny or nxf % nx:
+        raise ValueError("field shape %s is not a multiple of %s" %
+                         (str(fdata.shape), str(shape)))
+    fdata = fdata.reshape((nz, nzf//nz, ny, nyf//ny, nx, nxf//nx))
+    return fdata.mean(axis=(1, 3, 5))
+
+
+def conditioned_spectrum(fspect, fcond, fmin, fmax):
+    """Summed spectrum of the cells with fmin <= fcond < fmax
+
+    Args:
+        fspect: spectrum cube
+        fcond: conditioning field (e.g. |J|). It is averaged onto the cube
+            cells when it has a higher resolution.
+        fmin, fmax: range of the conditioning field
+    """
+    shape = fspect.shape[:3]
+    if fcond.shape != shape:
+        fcond = reduce_to_cube_grid(fcond, shape)
+    mask = np.logical_and(fcond >= fmin, fcond < fmax)
+    return masked_spectrum(fspect, mask), np.count_nonzero(mask)
+
+
+def binned_spectra(fspect, fcond, bins):
+    """Summed spectra for bins of a conditioning field
+
+    The cube is read only once no matter how many bins are given.
+
+    Args:
+        fspect: spectrum cube
+        fcond: conditioning field (e.g. |J|)
+        bins: bin edges of the conditioning field
+
+    Returns:
+        fbins: (nbins_cond, nbins) summed spectra
+        ncells: number of cells in each bin
+    """
+    shape = fspect.shape[:3]
+    if fcond.shape != shape:
+        fcond = reduce_to_cube_grid(fcond, shape)
+    nbins_cond = len(bins) - 1
+    nbins = fspect.shape[-1]
+    ibin = np.digitize(fcond, bins) - 1
+    fbins = np.zeros((nbins_cond, nbins), dtype=np.float64)
+    ncells = np.zeros(nbins_cond, dtype=np.int64)
+    for iz in range(shape[0]):
+        ibin_z = ibin[iz].reshape(-1)
+        cond = np.logical_and(ibin_z >= 0, ibin_z < nbins_cond)
+        if not np.any(cond):
+            continue
+        fz = np.asarray(fspect[iz]).reshape((-1, nbins))[cond]
+        for i in np.unique(ibin_z[cond]):
+            fbins[i] += np.sum(fz[ibin_z[cond] == i], axis=0, dtype=np.float64)
+        ncells += np.bincount(ibin_z[cond], minlength=nbins_cond)
+    return fbins, ncells
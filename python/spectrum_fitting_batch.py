@@ -0,0 +1,346 @@
+"""
+Batched fitting of particle energy spectra
+
+The functions here take a stack of spectra with shape (..., nbins), e.g.
+(time frames, regions, nbins), and fit all of them at once. Thermal cores
+(Maxwellian or Maxwell-Juttner) and power-law tails are linear in a
+suitable log space, so they are first fitted with closed-form least
+squares over masked energy ranges. The thermal cores can then be refined
+with curve_fit started from the closed-form parameters, which is done in
+parallel over chunks of spectra. Results can be cached by input hash.
+"""
+from __future__ import print_function
+
+import hashlib
+import math
+import multiprocessing
+import os
+
+import numpy as np
+from joblib import Parallel, delayed
+from scipy.ndimage import uniform_filter1d
+from scipy.optimize import curve_fit
+from scipy.special import kve
+
+import fitting_funcs
+from shell_functions import mkdir_p
+
+
+def flatten_stack(fstack):
+    """Reshape a stack of spectra to (nspect, nbins)
+    """
+    fstack = np.asarray(fstack, dtype=np.float64)
+    return fstack.reshape((-1, fstack.shape[-1])), fstack.shape[:-1]
+
+
+def range_mask(nbins, estart, eend):
+    """Mask of the energy bins in [estart, eend) for each spectrum
+    """
+    ibins = np.arange(nbins)
+    estart = np.atleast_1d(estart)[:, None]
+    eend = np.atleast_1d(eend)[:, None]
+    return np.logical_and(ibins >= estart, ibins < eend)
+
+
+def masked_linear_fit(x, y, mask):
+    """Least-squares fit of y = a * x + b for every row
+
+    Args:
+        x: (nbins, ) or (nspect, nbins) array
+        y: (nspect, nbins) array
+        mask: (nspect, nbins) bins used in the fitting. Non-finite y
+            values are always excluded.
+
+    Returns:
+        popt: (nspect, 2) array of [a, b]. Rows with fewer than two valid
+            points are NaN.
+    """
+    x = np.broadcast_to(x, y.shape)
+    mask = np.logical_and(mask, np.isfinite(y))
+    w = mask.astype(np.float64)
+    xw = np.where(mask, x, 0.0)
+    yw = np.where(mask, y, 0.0)
+    n = w.sum(axis=-1)
+    sx = xw.sum(axis=-1)
+    sy = yw.sum(axis=-1)
+    sxx = (xw * xw).sum(axis=-1)
+    sxy = (xw * yw).sum(axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        det = n * sxx - sx * sx
+        a = (n * sxy - sx * sy) / det
+        b = (sy - a * sx) / n
+    invalid = np.logical_or(n < 2, det == 0)
+    a[invalid] = np.nan
+    b[invalid] = np.nan
+    return np.stack([a, b], axis=-1)
+
+
+def thermal_core_range(ene, fstack, estart=0, nshift=10, ng=3):
+    """Energy ranges used for fitting the thermal cores
+
+    Same as fit_thermal_core in spectrum_fitting.py: the fitting ends
+    nshift bins above the peak of the smoothed spectrum.
+    """
+    fnew = uniform_filter1d(fstack, ng, axis=-1, mode='constant')
+    eend = np.argmax(fnew, axis=-1) + nshift
+    eend = np.minimum(eend, len(ene))
+    estart = np.full_like(eend, estart)
+    return estart, eend
+
+
+def fit_maxwellian_batch(ene, fstack, estart, eend):
+    """Closed-form fitting of f = a * sqrt(e) * exp(-b * e)
+
+    log(f / sqrt(e)) = log(a) - b * e is linear in e.
+
+    Returns:
+        popt: (nspect, 2) array of [a, b]
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        y = np.log(fstack / np.sqrt(ene))
+    mask = range_mask(len(ene), estart, eend)
+    pline = masked_linear_fit(ene, y, mask)
+    return np.stack([np.exp(pline[:, 1]), -pline[:, 0]], axis=-1)
+
+
+def fit_maxwell_juttner_batch(gamma, fstack, estart, eend):
+    """Closed-form fitting of the Maxwell-Juttner distribution
+
+    f = f0 * gamma^2 * beta / (theta * K2(1/theta)) * exp(-gamma/theta),
+    so log(f / (gamma^2 * beta)) is linear in gamma.
+
+    Returns:
+        popt: (nspect, 2) array of [theta, f0], the same order as
+            fitting_funcs.func_rel_maxwellian
+    """
+    beta = np.sqrt(1 - 1.0 / gamma**2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        y = np.log(fstack / (gamma**2 * beta))
+    mask = range_mask(len(gamma), estart, eend)
+    pline = masked_linear_fit(gamma, y, mask)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        theta = -1.0 / pline[:, 0]
+        # kve(2, z) = kv(2, z) * exp(z) avoids overflow for small theta
+        log_k2 = np.log(kve(2.0, 1.0 / theta)) - 1.0 / theta
+        f0 = np.exp(pline[:, 1] + np.log(theta) + log_k2)
+    return np.stack([theta, f0], axis=-1)
+
+
+def fit_power_law_batch(ene, fstack, estart, eend):
+    """Closed-form power-law fitting in log space
+
+    This is what curve_fit with fitting_funcs.func_line gives for
+    log10(f) = a * log10(e) + b.
+
+    Returns:
+        popt: (nspect, 2) array of [a, b]
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        y = np.log10(fstack)
+    mask = range_mask(len(ene), estart, eend)
+    return masked_linear_fit(np.log10(ene), y, mask)
+
+
+def eval_power_law(ene, popt):
+    """Power-law spectra from the fitting parameters
+    """
+    return np.power(10, popt[:, 0:1] * np.log10(ene) + popt[:, 1:2])
+
+
+def refine_chunk(func, ene, fchunk, p0, estart, eend):
+    """curve_fit for a chunk of spectra started from p0
+    """
+    popt = np.copy(p0)
+    for i in range(fchunk.shape[0]):
+        es, ee = estart[i], eend[i]
+        if not np.all(np.isfinite(p0[i])) or ee - es < 3:
+            continue
+        try:
+            popt[i], _ = curve_fit(func, ene[es:ee], fchunk[i, es:ee],
+                                   p0=p0[i])
+        except RuntimeError:
+            pass  # keep the closed-form parameters
+    return popt
+
+
+def refine_batch(func, ene, fstack, p0, estart, eend, ncores=None,
+                 chunk_size=256):
+    """Refine closed-form parameters with warm-started curve_fit
+
+    Args:
+        func: model function, e.g. fitting_funcs.func_maxwellian
+        ene: energy bins
+        fstack: (nspect, nbins) spectra
+        p0: (nspect, nparams) starting parameters
+        estart, eend: (nspect, ) fitting ranges
+        ncores: number of processes
+        chunk_size: number of spectra for each job
+    """
+    nspect = fstack.shape[0]
+    if ncores is None:
+        ncores = multiprocessing.cpu_count()
+    chunks = range(0, nspect, chunk_size)
+    res = Parallel(n_jobs=ncores)(
+        delayed(refine_chunk)(func, ene, fstack[cs:cs+chunk_size],
+                              p0[cs:cs+chunk_size], estart[cs:cs+chunk_size],
+                              eend[cs:cs+chunk_size])
+        for cs in chunks)
+    return np.concatenate(res, axis=0)
+
+
+def accumulated_particle_info_batch(ene, fstack):
+    """Accumulated particle number and energy for a stack of spectra
+
+    Same as accumulated_particle_info in spectrum_fitting.py but for
+    arrays with shape (..., nbins).
+    """
+    nbins = fstack.shape[-1]
+    dlogE = (math.log10(np.max(ene)) - math.log10(np.min(ene))) / nbins
+    nterm = np.empty(fstack.shape)
+    eterm = np.empty(fstack.shape)
+    nterm[..., 0] = fstack[..., 0] * ene[0]
+    eterm[..., 0] = 0.5 * fstack[..., 0] * ene[0]**2
+    nterm[..., 1:] = fstack[..., 1:] * (ene[1:] + ene[:-1]) * 0.5
+    eterm[..., 1:] = 0.5 * fstack[..., 1:] * (ene[1:] - ene[:-1]) * (
+        ene[1:] + ene[:-1])
+    nacc_ene = np.cumsum(nterm, axis=-1) * dlogE
+    eacc_ene = np.cumsum(eterm, axis=-1) * dlogE
+    return (nacc_ene, eacc_ene)
+
+
+def cache_key(*arrays, **kwargs):
+    """Hash of the input arrays and fitting parameters
+    """
+    sha = hashlib.sha1()
+    for arr in arrays:
+        arr = np.ascontiguousarray(arr)
+        sha.update(str(arr.shape).encode())
+        sha.update(arr.tobytes())
+    for key in sorted(kwargs):
+        sha.update((key + '=' + repr(kwargs[key])).encode())
+    return sha.hexdigest()
+
+
+def fit_thermal_core_batch(ene, fstack, core='maxwellian', estart=0,
+                           nshift=10, ng=3, refine=True, ncores=None):
+    """Fit the thermal cores of a stack of spectra
+
+    Args:
+        ene: energy bins (gamma - 1). Lorentz factors are ene + 1.
+        fstack: (nspect, nbins) spectra
+        core: 'maxwellian' or 'maxwell_juttner'
+        estart: starting bin for fitting the thermal core
+        nshift: thermal core fitting ends nshift bins above the peak
+        ng: number of bins for smoothing the spectra to find the peak
+        refine: whether to refine the thermal cores with curve_fit
+        ncores: number of processes for the refinement
+
+    Returns:
+        popt_th: (nspect, 2) fitting parameters
+        es_th, ee_th: fitting ranges
+        fthermal: (nspect, nbins) thermal cores
+    """
+    es_th, ee_th = thermal_core_range(ene, fstack, estart, nshift, ng)
+    if core == 'maxwellian':
+        popt_th = fit_maxwellian_batch(ene, fstack, es_th, ee_th)
+        func, xfit = fitting_funcs.func_maxwellian, ene
+    elif core == 'maxwell_juttner':
+        popt_th = fit_maxwell_juttner_batch(ene + 1, fstack, es_th, ee_th)
+        func, xfit = fitting_funcs.func_rel_maxwellian, ene + 1
+    else:
+        raise ValueError("unknown thermal core: " + core)
+    if refine:
+        popt_th = refine_batch(func, xfit, fstack, popt_th, es_th, ee_th,
+                               ncores)
+    fthermal = np.zeros_like(fstack)
+    valid = np.all(np.isfinite(popt_th), axis=-1)
+    for i in np.nonzero(valid)[0]:
+        fthermal[i] = func(xfit, popt_th[i, 0], popt_th[i, 1])
+    return popt_th, es_th, ee_th, fthermal
+
+
+def fit_spectra(ene, fstack, core='maxwellian', estart=0, nshift=10,
+                eshift=10, erange=100, refine=True, ncores=None,
+                cache_dir=None):
+    """Fit the thermal cores and the nonthermal power-law tails
+
+    The power-law tail is fitted to f - fthermal, starting eshift bins
+    above its maximum and spanning erange bins, like
+    fit_nonthermal_power_law in spectrum_fitting.py.
+
+    Args:
+        ene: energy bins (gamma - 1). Lorentz factors are ene + 1.
+        fstack: spectra with shape (..., nbins)
+        core: 'maxwellian' or 'maxwell_juttner'
+        estart: starting bin for fitting the thermal core
+        nshift: thermal core fitting ends nshift bins above the peak
+        eshift, erange: power-law fitting range
+        refine: whether to refine the thermal cores with curve_fit
+        ncores: number of processes for the refinement
+        cache_dir: directory to cache the results
+
+    Returns:
+        fit: dictionary with thermal-core parameters 'popt_th',
+            power-law parameters 'popt_pl', fitting ranges, thermal and
+            nonthermal spectra, and nonthermal number and energy fractions,
+            all with the leading shape of fstack.
+    """
+    ene = np.asarray(ene, dtype=np.float64)
+    fstack, lead_shape = flatten_stack(fstack)
+    fname = None
+    if cache_dir is not None:
+        key = cache_key(ene, fstack, core=core, estart=estart, nshift=nshift,
+                        eshift=eshift, erange=erange, refine=refine)
+        fname = os.path.join(cache_dir, 'fit_' + key + '.npz')
+        if os.path.isfile(fname):
+            fit = dict(np.load(fname))
+            return fit
+
+    nbins = len(ene)
+    popt_th, es_th, ee_th, fthermal = fit_thermal_core_batch(
+        ene, fstack, core, estart, nshift, refine=refine, ncores=ncores)
+    fnonthermal = fstack - fthermal
+    es_pl = np.minimum(np.argmax(fnonthermal, axis=-1) + eshift, nbins)
+    ee_pl = np.minimum(es_pl + erange, nbins)
+    popt_pl = fit_power_law_batch(ene, fnonthermal, es_pl, ee_pl)
+
+    ntot, etot = accumulated_particle_info_batch(ene, fstack)
+    nnth, enth = accumulated_particle_info_batch(ene, fnonthermal)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        nnth_frac = nnth[:, -1] / ntot[:, -1]
+        enth_frac = enth[:, -1] / etot[:, -1]
+
+    def unflatten(arr):
+        return arr.reshape(lead_shape + arr.shape[1:])
+
+    fit = {'popt_th': unflatten(popt_th),
+           'es_th': unflatten(es_th),
+           'ee_th': unflatten(ee_th),
+           'fthermal': unflatten(fthermal),
+           'popt_pl': unflatten(popt_pl),
+           'es_pl': unflatten(es_pl),
+           'ee_pl': unflatten(ee_pl),
+           'nnth_frac': unflatten(nnth_frac),
+           'enth_frac': unflatten(enth_frac)}
+    if fname is not None:
+        mkdir_p(cache_dir)
+        np.savez(fname, **fit)
+    return fit
+
+
+def fit_powerlaw_whole_batch(ene, fstack, offset, extend):
+    """Power-law fitting for the high-energy part of whole spectra
+
+    Same as power_law_fit in spectrum_fitting.py for a stack of spectra.
+
+    Returns:
+        popt: power-law parameters with the leading shape of fstack
+        estart, eend: fitting ranges
+    """
+    fstack, lead_shape = flatten_stack(fstack)
+    nbins = len(ene)
+    estart = np.minimum(np.argmax(fstack, axis=-1) + offset, nbins)
+    eend = np.minimum(estart + extend, nbins)
+    popt = fit_power_law_batch(ene, fstack, estart, eend)
+    return (popt.reshape(lead_shape + (2, )), estart.reshape(lead_shape),
+            eend.reshape(lead_shape))
@@ -0,0 +1,229 @@
+"""
+Time series of the particle energy spectra of one run in a single HDF5 file
+
+The store is ../data/spectra/<run_name>/spectrum-<species>.h5 with
+    tframes: (ntf, ) time frames, in the order they were appended
+    spectrum: (ntf, nbins) spectra, chunked along time
+    ebins: (nbins, ) energy bins (optional)
+and the attributes emin, emax, nbins and normalization. The combine step
+appends new frames as they finish, and readers slice time ranges from it
+instead of opening one file per frame.
+"""
+from __future__ import print_function
+
+import math
+import os
+
+import h5py
+import numpy as np
+
+from shell_functions import mkdir_p
+
+
+def series_name(run_name, species, fdir='../data/spectra/'):
+    """File name of the spectrum time series of one run
+    """
+    return fdir + run_name + '/spectrum-' + species.lower() + '.h5'
+
+
+def frame_name(run_name, species, tframe, fdir='../data/spectra/'):
+    """File name of the spectrum of a single time frame
+    """
+    return fdir + run_name + '/spectrum-' + species.lower() + '.' + str(tframe)
+
+
+def log_ebins(emin, emax, nbins):
+    """Logarithmic energy bins used by combine_energy_spectrum
+    """
+    emin_log = math.log10(emin)
+    emax_log = math.log10(emax)
+    return 10**(np.linspace(emin_log, emax_log, nbins))
+
+
+def create_series(fname, nbins, ebins=None, dtype=np.float64, **attrs):
+    """Create an empty spectrum time series
+
+    Args:
+        fname: file name of the store
+        nbins: number of energy bins
+        ebins: energy bins stored with the spectra
+        dtype: data type of the spectra
+        attrs: other meta data, e.g. emin, emax and normalization
+    """
+    fdir = os.path.dirname(fname)
+    if fdir:
+        mkdir_p(fdir)
+    with h5py.File(fname, 'w') as fh:
+        fh.create_dataset('tframes', (0, ), maxshape=(None, ),
+                          dtype=np.int64, chunks=(256, ))
+        fh.create_dataset('spectrum', (0, nbins), maxshape=(None, nbins),
+                          dtype=dtype, chunks=(16, nbins))
+        if ebins is not None:
+            fh.create_dataset('ebins', data=ebins)
+        fh.attrs['nbins'] = nbins
+        for key in attrs:
+            fh.attrs[key] = attrs[key]
+
+
+def append_frame(fname, tframe, fspect, ebins=None, **attrs):
+    """Append the spectrum of one time frame to the store
+
+    The store is created if it does not exist. A frame that is already
+    in the store is overwritten.
+
+    Args:
+        fname: file name of the store
+        tframe: time frame
+        fspect: (nbins, ) spectrum
+        ebins, attrs: meta data used when creating the store
+    """
+    append_frames(fname, [tframe], np.asarray(fspect)[np.newaxis, :],
+                  ebins, **attrs)
+
+
+def append_frames(fname, tframes, fspects, ebins=None, **attrs):
+    """Append the spectra of multiple time frames to the store
+
+    Args:
+        fname: file name of the store
+        tframes: time frames
+        fspects: (len(tframes), nbins) spectra
+        ebins, attrs: meta data used when creating the store
+    """
+    fspects = np.asarray(fspects)
+    if not os.path.isfile(fname):
+        create_series(fname, fspects.shape[1], ebins, fspects.dtype, **attrs)
+    with h5py.File(fname, 'r+') as fh:
+        dset_t = fh['tframes']
+        dset_f = fh['spectrum']
+        if fspects.shape[1] != dset_f.shape[1]:
+            raise ValueError("%s has %d energy bins but got %d" %
+                             (fname, dset_f.shape[1], fspects.shape[1]))
+        tframes_old = dset_t[:]
+        index = dict(zip(tframes_old.tolist(), range(len(tframes_old))))
+        new_rows = []
+        for tframe, fspect in zip(tframes, fspects):
+            if tframe in index:
+                dset_f[index[tframe]] = fspect
+            else:
+                new_rows.append((tframe, fspect))
+        if new_rows:
+            nt = dset_t.shape[0]
+            nnew = len(new_rows)
+            dset_t.resize((nt + nnew, ))
+            dset_f.resize((nt + nnew, dset_f.shape[1]))
+            dset_t[nt:] = [row[0] for row in new_rows]
+            dset_f[nt:] = np.asarray([row[1] for row in new_rows])
+
+
+def read_series(fname, tstart=None, tend=None):
+    """Read a range of time frames from the store
+
+    Args:
+        fname: file name of the store
+        tstart, tend: the first and last time frames (both included).
+            None means from the beginning or to the end.
+
+    Returns:
+        tframes: (nt, ) sorted time frames
+        fspects: (nt, nbins) spectra
+        meta: dictionary with the energy bins and the attributes
+    """
+    with h5py.File(fname, 'r') as fh:
+        tframes = fh['tframes'][:]
+        order = np.argsort(tframes, kind='stable')
+        tsorted = tframes[order]
+        ts = 0 if tstart is None else np.searchsorted(tsorted, tstart, 'left')
+        te = (len(tsorted) if tend is None else
+              np.searchsorted(tsorted, tend, 'right'))
+        rows = order[ts:te]
+        dset = fh['spectrum']
+        if len(rows) == 0:
+            fspects = np.zeros((0, dset.shape[1]), dtype=dset.dtype)
+        elif np.all(np.diff(rows) == 1):
+            fspects = dset[rows[0]:rows[-1]+1]  # one contiguous read
+        else:
+            # h5py needs increasing indices
+            rows_sorted = np.sort(rows)
+            fspects = dset[rows_sorted.tolist()]
+            fspects = fspects[np.searchsorted(rows_sorted, rows)]
+        meta = dict(fh.attrs)
+        if 'ebins' in fh:
+            meta['ebins'] = fh['ebins'][:]
+    return tsorted[ts:te], fspects, meta
+
+
+def read_meta(fname):
+    """Read the energy bins and the attributes of the store
+    """
+    with h5py.File(fname, 'r') as fh:
+        meta = dict(fh.attrs)
+        if 'ebins' in fh:
+            meta['ebins'] = fh['ebins'][:]
+    return meta
+
+
+def read_frame(run_name, species, tframe, fdir='../data/spectra/'):
+    """Read the spectrum of one frame, from the store when it exists
+
+    Falls back to the per-frame binary file written by
+    combine_energy_spectrum.
+    """
+    fname = series_name(run_name, species, fdir)
+    if os.path.isfile(fname):
+        tframes, fspects, _ = read_series(fname, tframe, tframe)
+        if len(tframes):
+            return fspects[0]
+    return np.fromfile(frame_name(run_name, species, tframe, fdir))
+
+
+def read_frames(run_name, species, tframes, fdir='../data/spectra/'):
+    """Read the spectra of multiple frames with one read of the store
+
+    Frames that are not in the store are read from the per-frame binary
+    files written by combine_energy_spectrum.
+
+    Returns:
+        fspects: (len(tframes), nbins) spectra in the order of tframes
+    """
+    tframes = np.asarray(tframes)
+    fname = series_name(run_name, species, fdir)
+    fspects = [None] * len(tframes)
+    if os.path.isfile(fname) and len(tframes):
+        tframes_read, fspects_read, _ = read_series(fname, tframes.min(),
+                                                    tframes.max())
+        rows = np.searchsorted(tframes_read, tframes)
+        for i, row in enumerate(rows):
+            if row < len(tframes_read) and tframes_read[row] == tframes[i]:
+                fspects[i] = fspects_read[row]
+    for i, tframe in enumerate(tframes):
+        if fspects[i] is None:
+            fspects[i] = np.fromfile(frame_name(run_name, species, tframe,
+                                                fdir))
+    return np.asarray(fspects)
+
+
+def import_frames(run_name, species, tframes, nbins, emin, emax,
+                  fdir='../data/spectra/'):
+    """Build the store from existing per-frame spectrum files
+
+    Args:
+        run_name: PIC run name
+        species: particle species
+        tframes: time frames to import. Missing files are skipped.
+        nbins, emin, emax: energy bins of the spectra
+    """
+    fname = series_name(run_name, species, fdir)
+    tframes_read = []
+    fspects = []
+    for tframe in tframes:
+        fname_frame = frame_name(run_name, species, tframe, fdir)
+        if os.path.isfile(fname_frame):
+            tframes_read.append(tframe)
+            fspects.append(np.fromfile(fname_frame))
+    if not tframes_read:
+        print("No spectrum files found for %s" % run_name)
+        return
+    append_frames(fname, tframes_read, np.asarray(fspects),
+                  ebins=log_ebins(emin, emax, nbins), emin=emin, emax=emax,
+                  normalization='dN/dE')
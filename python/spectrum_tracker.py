@@ -0,0 +1,172 @@
+"""
+Incremental tracking of the maximum energy and the nonthermal fractions
+
+The tracker reads the spectra from the time series store of a run
+(spectrum_series) and only processes the frames that are newer than the
+last one it has seen. Its state is saved in an .npz file next to the
+store, so monitoring a long run costs O(new frames) each time.
+"""
+from __future__ import print_function
+
+import argparse
+import math
+import os
+
+import numpy as np
+
+import spectrum_fitting_batch
+import spectrum_series
+from json_functions import read_data_from_json
+
+
+class SpectrumTracker(object):
+    def __init__(self, fname, ebins, eth=1.0, core='maxwellian', nshift=10):
+        """
+        Args:
+            fname: file name of the tracker state
+            ebins: energy bins of the spectra
+            eth: thermal energy for normalizing the maximum energy
+            core: thermal core used for the nonthermal fractions
+            nshift: thermal core fitting ends nshift bins above the peak
+        """
+        self.fname = fname
+        self.ebins = np.asarray(ebins, dtype=np.float64)
+        self.eth = eth
+        self.core = core
+        self.nshift = nshift
+        nbins = len(self.ebins)
+        self.tframes = np.zeros(0, dtype=np.int64)
+        self.max_ene = np.zeros(0)
+        self.nnth_frac = np.zeros(0)
+        self.enth_frac = np.zeros(0)
+        self.nacc = np.zeros((0, nbins))
+        self.eacc = np.zeros((0, nbins))
+        if os.path.isfile(fname):
+            self.load()
+
+    def load(self):
+        """Load the tracker state
+        """
+        state = np.load(self.fname)
+        if not np.array_equal(state['ebins'], self.ebins):
+            raise ValueError("energy bins in %s do not match" % self.fname)
+        self.tframes = state['tframes']
+        self.max_ene = state['max_ene']
+        self.nnth_frac = state['nnth_frac']
+        self.enth_frac = state['enth_frac']
+        self.nacc = state['nacc']
+        self.eacc = state['eacc']
+
+    def save(self):
+        """Save the tracker state
+        """
+        fname_tmp = self.fname + '.tmp.npz'
+        np.savez(fname_tmp, ebins=self.ebins, tframes=self.tframes,
+                 max_ene=self.max_ene, nnth_frac=self.nnth_frac,
+                 enth_frac=self.enth_frac, nacc=self.nacc, eacc=self.eacc)
+        os.rename(fname_tmp, self.fname)  # avoid a partially written state
+
+    @property
+    def last_tframe(self):
+        return self.tframes[-1] if len(self.tframes) else -1
+
+    def update(self, tframes, fspects):
+        """Update the diagnostics with new spectra
+
+        Frames that are not newer than the last tracked frame are skipped.
+
+        Args:
+            tframes: time frames of the spectra, in increasing order
+            fspects: (len(tframes), nbins) spectra
+        """
+        tframes = np.asarray(tframes)
+        fspects = np.asarray(fspects, dtype=np.float64)
+        cond = tframes > self.last_tframe
+        if not np.any(cond):
+            return
+        tframes = tframes[cond]
+        fspects = fspects[cond]
+
+        # the last nonzero bin of each spectrum
+        nonzero = fspects > 0
+        nbins = fspects.shape[1]
+        imax = nbins - 1 - np.argmax(nonzero[:, ::-1], axis=1)
+        max_ene = np.where(np.any(nonzero, axis=1), self.ebins[imax], 0.0)
+
+        _, _, _, fthermal = spectrum_fitting_batch.fit_thermal_core_batch(
+            self.ebins, fspects, self.core, nshift=self.nshift, ncores=1)
+        nacc, eacc = spectrum_fitting_batch.accumulated_particle_info_batch(
+            self.ebins, fspects)
+        nnth, enth = spectrum_fitting_batch.accumulated_particle_info_batch(
+            self.ebins, fspects - fthermal)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            nnth_frac = nnth[:, -1] / nacc[:, -1]
+            enth_frac = enth[:, -1] / eacc[:, -1]
+
+        self.tframes = np.concatenate([self.tframes, tframes])
+        self.max_ene = np.concatenate([self.max_ene, max_ene / self.eth])
+        self.nnth_frac = np.concatenate([self.nnth_frac, nnth_frac])
+        self.enth_frac = np.concatenate([self.enth_frac, enth_frac])
+        self.nacc = np.concatenate([self.nacc, nacc], axis=0)
+        self.eacc = np.concatenate([self.eacc, eacc], axis=0)
+
+    def update_from_series(self, fname_series):
+        """Read the new frames from a spectrum time series and update
+        """
+        tframes, fspects, _ = spectrum_series.read_series(
+            fname_series, tstart=self.last_tframe + 1)
+        print("Number of new frames: %d" % len(tframes))
+        self.update(tframes, fspects)
+        self.save()
+
+
+def tracker_name(run_name, species, fdir='../data/spectra/'):
+    """File name of the tracker state of one run
+    """
+    return fdir + run_name + '/tracker-' + species.lower() + '.npz'
+
+
+def track_run(run_name, species, fdir='../data/spectra/'):
+    """Update the tracker of one run with the frames in its spectrum store
+
+    Args:
+        run_name: PIC run name
+        species: particle species
+        fdir: directory of the spectra
+    """
+    fname_series = spectrum_series.series_name(run_name, species, fdir)
+    meta = spectrum_series.read_meta(fname_series)
+    picinfo_fname = '../data/pic_info/pic_info_' + run_name + '.json'
+    pic_info = read_data_from_json(picinfo_fname)
+    vth = pic_info.vthe if species == 'e' else pic_info.vthi
+    gama = 1.0 / math.sqrt(1.0 - 3 * vth**2)
+    eth = gama - 1.0
+    tracker = SpectrumTracker(tracker_name(run_name, species, fdir),
+                              meta['ebins'], eth)
+    tracker.update_from_series(fname_series)
+    return tracker
+
+
+def get_cmd_args():
+    """Get command line arguments """
+    default_run_name = 'mime400_beta002_bg00'
+    parser = argparse.ArgumentParser(description='Track maximum energy and '
+                                     'nonthermal fractions')
+    parser.add_argument('--species', action="store", default='e',
+                        help='particle species')
+    parser.add_argument('--run_name', action="store", default=default_run_name,
+                        help='run name')
+    return parser.parse_args()
+
+
+def main():
+    """business logic for when running this module as the primary one!"""
+    args = get_cmd_args()
+    tracker = track_run(args.run_name, args.species)
+    for tframe, emax, nnth, enth in zip(tracker.tframes, tracker.max_ene,
+                                        tracker.nnth_frac, tracker.enth_frac):
+        print("%d %f %5.2f %5.2f" % (tframe, emax, nnth, enth))
+
+
+if __name__ == "__main__":
+    main()
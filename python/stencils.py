@@ -0,0 +1,196 @@
+"""
+Finite-difference operators for 2D and 3D grids
+
+Arrays have the shape (nz, nx) for 2D runs or (nz, ny, nx) for 3D runs.
+Derivatives along an axis that is missing or has only one cell are 0.
+A derivative is
+    shift = 0: centered (f[i+1] - f[i-1]) / 2h on a collocated grid
+    shift = 1: forward (f[i+1] - f[i]) / h, at i + 1/2 on a staggered grid
+    shift = -1: backward (f[i] - f[i-1]) / h, at i - 1/2
+Periodic boundaries wrap around. Open boundaries use one-sided differences,
+the same as np.gradient for the centered derivative. Every operator
+writes into the output buffers given by the caller (new float32 arrays
+otherwise), and the work is split into slabs along z that are processed
+by a pool of threads. Only slab-sized temporaries are allocated.
+"""
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+
+class Stencil(object):
+    def __init__(self, shape, spacing, periodic=(False, False, False),
+                 nthreads=1):
+        """
+        Args:
+            shape: array shape, (nz, nx) or (nz, ny, nx)
+            spacing: dictionary of the grid sizes dx, dy, dz
+            periodic: whether the boundaries along x, y, z are periodic
+            nthreads: number of threads
+        """
+        self.shape = tuple(shape)
+        dims = ['z', 'x'] if len(self.shape) == 2 else ['z', 'y', 'x']
+        self.axes = {dim: axis for axis, dim in enumerate(dims)}
+        self.spacing = spacing
+        self.periodic = dict(zip(['x', 'y', 'z'], periodic))
+        self.nthreads = nthreads
+
+    def empty(self, ncomp=None):
+        """Output buffer(s) of one scalar or ncomp components
+        """
+        if ncomp is None:
+            return np.empty(self.shape, dtype=np.float32)
+        return [np.empty(self.shape, dtype=np.float32) for _ in range(ncomp)]
+
+    def is_flat(self, dim):
+        return dim not in self.axes or self.shape[self.axes[dim]] < 2
+
+    def indices(self, dim, start, end, shift):
+        """Indices of the upper and lower points and the distances
+
+        Returns:
+            ip, im: indices along the axis of dim for the points [start, end)
+            dist: distances between the upper and lower points
+        """
+        nlen = self.shape[self.axes[dim]]
+        index = np.arange(start, end)
+        hval = self.spacing['d' + dim]
+        dist = np.full(len(index), hval * (2.0 if shift == 0 else 1.0))
+        ip = index + 1 if shift >= 0 else index.copy()
+        im = index - 1 if shift <= 0 else index.copy()
+        if self.periodic[dim]:
+            return ip % nlen, im % nlen, dist
+        if shift == 0:
+            dist[index == 0] = hval
+            dist[index == nlen - 1] = hval
+            im[index == 0] = 0
+            ip[index == nlen - 1] = nlen - 1
+        elif shift > 0:
+            ip[index == nlen - 1] = nlen - 1
+            im[index == nlen - 1] = nlen - 2
+        else:
+            ip[index == 0] = 1
+            im[index == 0] = 0
+        return ip, im, dist
+
+    def diff_slab(self, fdata, dim, zs, ze, shift=0):
+        """Derivative along dim of the slab [zs, ze) along z
+
+        Returns:
+            the derivative in a new slab-sized array, or None when it is 0
+        """
+        if self.is_flat(dim):
+            return None
+        axis = self.axes[dim]
+        if axis == 0:
+            ip, im, dist = self.indices(dim, zs, ze, shift)
+            src = fdata
+        else:
+            ip, im, dist = self.indices(dim, 0, self.shape[axis], shift)
+            src = fdata[zs:ze]
+        res = np.take(src, ip, axis=axis)
+        res -= np.take(src, im, axis=axis)
+        bshape = [1] * len(self.shape)
+        bshape[axis] = len(dist)
+        res /= dist.reshape(bshape).astype(res.dtype)
+        return res
+
+    def run(self, func):
+        """Call func(zs, ze) for the slabs along z, in a pool of threads
+        """
+        nz = self.shape[0]
+        nslab = min(self.nthreads, nz)
+        bounds = np.linspace(0, nz, nslab + 1).astype(int)
+        slabs = list(zip(bounds[:-1], bounds[1:]))
+        if nslab == 1:
+            func(*slabs[0])
+            return
+        pool = ThreadPool(nslab)
+        pool.map(lambda slab: func(*slab), slabs)
+        pool.close()
+        pool.join()
+
+    def linear_slab(self, out, terms, zs, ze, shift):
+        """out[zs:ze] = sum of coeff * d(fdata)/d(dim) over the terms
+
+        Args:
+            terms: list of (coeff, fdata, dim), where coeff is a number or
+                an array of the full shape
+        """
+        out[zs:ze] = 0
+        for coeff, fdata, dim in terms:
+            res = self.diff_slab(fdata, dim, zs, ze, shift)
+            if res is None:
+                continue
+            if np.ndim(coeff) > 0:
+                res *= coeff[zs:ze]
+            elif coeff != 1:
+                res *= coeff
+            out[zs:ze] += res
+
+    def linear(self, out, terms, shift=0):
+        if out is None:
+            out = self.empty()
+        self.run(lambda zs, ze: self.linear_slab(out, terms, zs, ze, shift))
+        return out
+
+    def ddx(self, fdata, dim, out=None, shift=0):
+        """Derivative along dim ('x', 'y' or 'z')
+        """
+        return self.linear(out, [(1, fdata, dim)], shift)
+
+    def gradient(self, fdata, out=None, shift=0):
+        """Gradient [df/dx, df/dy, df/dz] of a scalar field
+        """
+        if out is None:
+            out = self.empty(3)
+        for idim, dim in enumerate(['x', 'y', 'z']):
+            self.ddx(fdata, dim, out[idim], shift)
+        return out
+
+    def divergence(self, vec, out=None, shift=0):
+        """Divergence of a vector field [vx, vy, vz]
+        """
+        terms = [(1, vec[0], 'x'), (1, vec[1], 'y'), (1, vec[2], 'z')]
+        return self.linear(out, terms, shift)
+
+    def curl(self, vec, out=None, shift=0):
+        """Curl of a vector field [vx, vy, vz]
+        """
+        if out is None:
+            out = self.empty(3)
+        self.linear(out[0], [(1, vec[2], 'y'), (-1, vec[1], 'z')], shift)
+        self.linear(out[1], [(1, vec[0], 'z'), (-1, vec[2], 'x')], shift)
+        self.linear(out[2], [(1, vec[1], 'x'), (-1, vec[0], 'y')], shift)
+        return out
+
+    def bdotgrad(self, bvec, fdata, out=None, shift=0):
+        """(b.grad)f of a scalar field f along a vector field b
+        """
+        terms = [(bvec[0], fdata, 'x'), (bvec[1], fdata, 'y'),
+                 (bvec[2], fdata, 'z')]
+        return self.linear(out, terms, shift)
+
+    def curvature(self, bvec, out=None, shift=0):
+        """Curvature kappa = (b.grad)b of a unit vector field b
+        """
+        if out is None:
+            out = self.empty(3)
+        for icomp in range(3):
+            self.bdotgrad(bvec, bvec[icomp], out[icomp], shift)
+        return out
+
+    def tensor_divergence(self, tensor, out=None, shift=0):
+        """Divergence of a symmetric tensor {"xx": ..., "xy": ..., ...}
+
+        Returns:
+            [sum_j d(T_jx)/dj, sum_j d(T_jy)/dj, sum_j d(T_jz)/dj]
+        """
+        def comp(i, j):
+            return tensor[i + j] if i + j in tensor else tensor[j + i]
+        if out is None:
+            out = self.empty(3)
+        for icomp, ci in enumerate(['x', 'y', 'z']):
+            self.divergence([comp('x', ci), comp('y', ci), comp('z', ci)],
+                            out[icomp], shift)
+        return out
@@ -0,0 +1,309 @@
+"""
+Compact storage of the time-major tracer files
+
+A tracer file (e.g. electron_tracer_qtag_sorted.h5p or tracers.h5p) has
+one 'Step#' group per time step. The encoded file keeps the same groups
+and dataset names, and each dataset has a 'codec' attribute:
+    raw: stored as it is (with shuffle and gzip compression)
+    quant: float data quantized to integers in float64, x ~ n * step with
+        |x - n * step| <= error after rounding back to the data type
+    delta: quantized data stored as the difference from the same particle
+        at the previous step (attribute 'prev'). The integer differences
+        are exact, so the error does not grow along time.
+The smallest integer type that holds the (differences of) quantized
+values is used, and compression works on top of that. Delta encoding
+needs the same particles in the same rows at every step, which is the
+case in the qtag-sorted files. Every key_interval steps and at the first
+step of a file the data is stored as 'quant' so that a step can be decoded
+without reading the whole file.
+
+The codec is configured by a dictionary, e.g.
+    codec_config = {"error": {"dX": 1E-3, "dY": 1E-3, "dZ": 1E-3,
+                              "Ex": 1E-5, "Ey": 1E-5, "Ez": 1E-5},
+                    "delta": ["dX", "dY", "dZ"],
+                    "key_interval": 16,
+                    "compression": "gzip",
+                    "compression_opts": 4}
+Variables without an error bound are stored losslessly.
+"""
+from __future__ import print_function
+
+import argparse
+import multiprocessing
+
+import h5py
+import numpy as np
+from joblib import delayed
+
+from parallel_functions import bounded_parallel
+
+DEFAULT_CODEC = {"error": {},
+                 "delta": [],
+                 "key_interval": 16,
+                 "compression": "gzip",
+                 "compression_opts": 4}
+
+
+def get_codec_config(codec_config=None):
+    """Fill in the default codec configuration
+    """
+    config = dict(DEFAULT_CODEC)
+    if codec_config is not None:
+        config.update(codec_config)
+    return config
+
+
+def step_groups(fh):
+    """Names of the 'Step#' groups sorted by time index
+    """
+    gnames = [gname for gname in fh if gname.startswith('Step#')]
+    return sorted(gnames, key=lambda gname: int(gname[5:]))
+
+
+def dataset_paths(group):
+    """Paths of all datasets in one step group, relative to the group
+    """
+    paths = []
+
+    def visitor(name, obj):
+        if isinstance(obj, h5py.Dataset):
+            paths.append(name)
+    group.visititems(visitor)
+    return paths
+
+
+def smallest_int_type(nmax):
+    """The smallest signed integer type holding [-nmax, nmax]
+    """
+    for dtype in [np.int8, np.int16, np.int32, np.int64]:
+        if nmax <= np.iinfo(dtype).max:
+            return dtype
+
+
+def quantize_step(error, fmax, dtype):
+    """Quantization step keeping the decoded data within the error bound
+
+    The decoded data are rounded back to dtype, so part of the error bound
+    is left for that rounding at the largest magnitude fmax of the data.
+    """
+    step = 2.0 * (error - np.finfo(dtype).eps * fmax)
+    if step <= 0:
+        raise ValueError("Error bound %g is below the %s precision at %g" %
+                         (error, np.dtype(dtype).name, fmax))
+    return step
+
+
+def quantize(fdata, step):
+    """Quantize float data in float64 with a given step
+
+    Returns:
+        qdata: int64 quantized data
+    """
+    return np.rint(fdata.astype(np.float64) / step).astype(np.int64)
+
+
+def encode_segment(fname, gnames, paths, config):
+    """Encode consecutive steps of a tracer file
+
+    The first step of the segment is a key step.
+
+    Args:
+        fname: input tracer file
+        gnames: step group names in time order
+        paths: dataset paths in each step group
+        config: codec configuration
+
+    Returns:
+        encoded: list over steps of {path: (data, attributes)}
+    """
+    errors = config["error"]
+    encoded = []
+    qprev = {}
+    with h5py.File(fname, 'r') as fh:
+        # one step for each variable in the segment, so the deltas add up
+        steps = {}
+        for path in paths:
+            var = path.split('/')[-1]
+            dset = fh[gnames[0]][path]
+            if var not in errors or dset.dtype.kind != 'f':
+                continue
+            fmax = 0.0
+            for gname in gnames:
+                fdata = fh[gname][path][...]
+                if fdata.size:
+                    fmax = max(fmax, float(np.max(np.abs(fdata))))
+            steps[path] = quantize_step(errors[var], fmax, dset.dtype)
+        for istep, gname in enumerate(gnames):
+            enc = {}
+            for path in paths:
+                dset = fh[gname][path]
+                var = path.split('/')[-1]
+                fdata = dset[...]
+                if path not in steps:
+                    enc[path] = (fdata, {'codec': 'raw'})
+                    continue
+                step = steps[path]
+                qdata = quantize(fdata, step)
+                attrs = {'codec': 'quant', 'step': step,
+                         'dtype': fdata.dtype.str}
+                if var in config["delta"] and istep > 0:
+                    qstore = qdata - qprev[path]
+                    attrs['codec'] = 'delta'
+                    attrs['prev'] = gnames[istep - 1] + '/' + path
+                else:
+                    qstore = qdata
+                qprev[path] = qdata
+                nmax = np.max(np.abs(qstore)) if qstore.size else 0
+                enc[path] = (qstore.astype(smallest_int_type(nmax)), attrs)
+            encoded.append(enc)
+    return encoded
+
+
+def encode_file(fname_in, fname_out, codec_config=None, ncores=None):
+    """Encode a time-major tracer file
+
+    Args:
+        fname_in: input tracer file
+        fname_out: encoded tracer file
+        codec_config: codec configuration
+        ncores: number of processes
+    """
+    config = get_codec_config(codec_config)
+    if ncores is None:
+        ncores = multiprocessing.cpu_count()
+    with h5py.File(fname_in, 'r') as fh:
+        gnames = step_groups(fh)
+        paths = dataset_paths(fh[gnames[0]])
+    kint = config["key_interval"]
+    segments = [gnames[i:i+kint] for i in range(0, len(gnames), kint)]
+    with h5py.File(fname_out, 'w') as fh_out:
+        res = bounded_parallel(
+            (delayed(encode_segment)(fname_in, seg, paths, config)
+             for seg in segments), ncores)
+        for seg, encoded in zip(segments, res):
+            for gname, enc in zip(seg, encoded):
+                print("Encoding %s" % gname)
+                grp = fh_out.create_group(gname)
+                for path in paths:
+                    fdata, attrs = enc[path]
+                    dset = grp.create_dataset(
+                        path, data=fdata, shuffle=True,
+                        compression=config["compression"],
+                        compression_opts=config["compression_opts"])
+                    for key in attrs:
+                        dset.attrs[key] = attrs[key]
+
+
+def read_quantized(fh, path):
+    """Read the quantized data of one dataset, following the delta chain
+
+    Returns:
+        qdata: int64 quantized data
+    """
+    chain = []
+    dset = fh[path]
+    while dset.attrs['codec'] == 'delta':
+        chain.append(dset)
+        dset = fh[dset.attrs['prev']]
+    qdata = dset[...].astype(np.int64)
+    for dset in chain:
+        qdata += dset[...]
+    return qdata
+
+
+def read_dataset(fh, path, out=None, source_sel=None):
+    """Read one dataset of a tracer file, encoded or not
+
+    Args:
+        fh: HDF5 file handler
+        path: dataset path, e.g. 'Step#0/Ux'
+        out: array to read into
+        source_sel: selection in the dataset, e.g. np.s_[ps:pe]
+
+    Returns:
+        fdata: decoded data (out when it is given)
+    """
+    dset = fh[path]
+    codec = dset.attrs.get('codec', 'raw')
+    if isinstance(codec, bytes):
+        codec = codec.decode()
+    if codec == 'raw':
+        if out is None:
+            return dset[...] if source_sel is None else dset[source_sel]
+        dset.read_direct(out, source_sel)
+        return out
+    qdata = read_quantized(fh, path)
+    if source_sel is not None:
+        qdata = qdata[source_sel]
+    fdata = qdata * dset.attrs['step']
+    if out is None:
+        return fdata.astype(np.dtype(dset.attrs['dtype']))
+    out[...] = fdata
+    return out
+
+
+def check_codec(fname_in, fname_out, codec_config=None):
+    """Maximum decoding error of each variable of an encoded file
+
+    Raises:
+        ValueError: when an error is over its bound (0 for the variables
+            stored losslessly)
+    """
+    bounds = get_codec_config(codec_config)["error"]
+    errors = {}
+    with h5py.File(fname_in, 'r') as fh_in, h5py.File(fname_out, 'r') as fh:
+        gnames = step_groups(fh_in)
+        paths = dataset_paths(fh_in[gnames[0]])
+        for gname in gnames:
+            for path in paths:
+                fdata = fh_in[gname][path][...]
+                fdecode = read_dataset(fh, gname + '/' + path)
+                diff = np.max(np.abs(fdecode.astype(np.float64) - fdata))
+                errors[path] = max(errors.get(path, 0), diff)
+    over = [path for path in sorted(errors)
+            if errors[path] > bounds.get(path.split('/')[-1], 0)]
+    if over:
+        raise ValueError("Decoding errors over the bounds: " +
+                         ", ".join("%s %e" % (path, errors[path])
+                                   for path in over))
+    return errors
+
+
+def get_cmd_args():
+    """Get command line arguments """
+    parser = argparse.ArgumentParser(description='Encode tracer files')
+    parser.add_argument('fname_in', action="store", help='input tracer file')
+    parser.add_argument('fname_out', action="store",
+                        help='encoded tracer file')
+    parser.add_argument('--pos_error', action="store", default=0, type=float,
+                        help='error bound of the positions (0: lossless)')
+    parser.add_argument('--emf_error', action="store", default=0, type=float,
+                        help='error bound of the fields (0: lossless)')
+    parser.add_argument('--key_interval', action="store", default=16,
+                        type=int, help='steps between two key steps')
+    parser.add_argument('--check', action="store_true", default=False,
+                        help='whether to check the decoding errors')
+    return parser.parse_args()
+
+
+def main():
+    """business logic for when running this module as the primary one!"""
+    args = get_cmd_args()
+    codec_config = {"error": {}, "delta": [],
+                    "key_interval": args.key_interval}
+    if args.pos_error > 0:
+        for var in ["dX", "dY", "dZ"]:
+            codec_config["error"][var] = args.pos_error
+        codec_config["delta"] = ["dX", "dY", "dZ"]
+    if args.emf_error > 0:
+        for var in ["Ex", "Ey", "Ez", "Bx", "By", "Bz"]:
+            codec_config["error"][var] = args.emf_error
+    encode_file(args.fname_in, args.fname_out, codec_config)
+    if args.check:
+        errors = check_codec(args.fname_in, args.fname_out, codec_config)
+        for path in sorted(errors):
+            print("%s: %e" % (path, errors[path]))
+
+
+if __name__ == "__main__":
+    main()
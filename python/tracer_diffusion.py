@@ -0,0 +1,141 @@
+"""
+Energy diffusion coefficients and acceleration rates from tracer particles
+
+The estimator consumes the tracer steps once, in time order. It keeps the
+energies of the last max(lags) steps and, for every lag tau and every
+step, accumulates the energy changes d = e(t + tau) - e(t) of all tracers
+conditioned on the energy bin of e(t):
+    n(tau, e), sum d(tau, e), sum d^2(tau, e)
+with one np.bincount per lag. The tracers are randomly split into groups,
+and the sums are kept per group, so bootstrap error bars come from
+resampling the groups without another pass over the data. The results are
+    drift rate: <d> / tau
+    diffusion coefficient: D_ee = (<d^2> - <d>^2) / (2 tau)
+"""
+from __future__ import print_function
+
+import numpy as np
+
+import tracer_stream
+
+
+class EnergyDiffusionEstimator(object):
+    def __init__(self, ebins, lags, dt, ngroups=64, seed=0):
+        """
+        Args:
+            ebins: energy bin edges
+            lags: lags in number of steps, e.g. [1, 2, 4, 8]
+            dt: time interval between two steps
+            ngroups: number of random tracer groups for the bootstrap
+            seed: random seed of the groups
+        """
+        self.ebins = np.asarray(ebins, dtype=np.float64)
+        self.lags = np.asarray(lags, dtype=np.int64)
+        self.dt = dt
+        self.ngroups = ngroups
+        self.seed = seed
+        self.nbins = len(self.ebins) - 1
+        shape = (len(self.lags), ngroups, self.nbins)
+        self.counts = np.zeros(shape)
+        self.dsum = np.zeros(shape)
+        self.dsum2 = np.zeros(shape)
+        self.history = []  # (energy, valid) of the previous steps
+        self.groups = None
+
+    def update(self, ene, valid=None):
+        """Add the energies of the tracers at the next step
+
+        Args:
+            ene: (nptl, ) energies. The tracers must be in the same order
+                at all steps.
+            valid: (nptl, ) mask of the tracers present at this step
+        """
+        ene = np.asarray(ene, dtype=np.float64)
+        if valid is None:
+            valid = np.ones(len(ene), dtype=bool)
+        if self.groups is None:
+            rng = np.random.RandomState(self.seed)
+            self.groups = rng.randint(self.ngroups, size=len(ene))
+        nhist = len(self.history)
+        for ilag, lag in enumerate(self.lags):
+            if lag > nhist:
+                continue
+            ene0, valid0 = self.history[nhist - lag]
+            ibin = np.searchsorted(self.ebins, ene0, side='right') - 1
+            cond = valid & valid0 & (ibin >= 0) & (ibin < self.nbins)
+            index = self.groups[cond] * self.nbins + ibin[cond]
+            dene = ene[cond] - ene0[cond]
+            size = self.ngroups * self.nbins
+            self.counts[ilag] += np.bincount(
+                index, minlength=size).reshape(self.ngroups, self.nbins)
+            self.dsum[ilag] += np.bincount(
+                index, weights=dene, minlength=size).reshape(self.ngroups,
+                                                             self.nbins)
+            self.dsum2[ilag] += np.bincount(
+                index, weights=dene**2, minlength=size).reshape(self.ngroups,
+                                                                self.nbins)
+        self.history.append((ene.copy(), valid.copy()))
+        if len(self.history) > np.max(self.lags):
+            self.history.pop(0)
+
+    def rates(self, counts, dsum, dsum2):
+        """Drift rates and diffusion coefficients from the sums over groups
+        """
+        tau = (self.lags * self.dt)[:, np.newaxis]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dmean = dsum / counts
+            dvar = dsum2 / counts - dmean**2
+        return dmean / tau, 0.5 * dvar / tau
+
+    def finalize(self, nboot=200, seed=1):
+        """Drift rates and diffusion coefficients with bootstrap errors
+
+        Returns:
+            result: dictionary of (nlags, nbins) arrays: counts, drift,
+                drift_err, dee, dee_err, and the ebins and lags
+        """
+        counts = np.sum(self.counts, axis=1)
+        drift, dee = self.rates(counts, np.sum(self.dsum, axis=1),
+                                np.sum(self.dsum2, axis=1))
+        rng = np.random.RandomState(seed)
+        drift_boot = np.zeros((nboot, ) + drift.shape)
+        dee_boot = np.zeros((nboot, ) + dee.shape)
+        for iboot in range(nboot):
+            igroups = rng.randint(self.ngroups, size=self.ngroups)
+            drift_boot[iboot], dee_boot[iboot] = self.rates(
+                np.sum(self.counts[:, igroups], axis=1),
+                np.sum(self.dsum[:, igroups], axis=1),
+                np.sum(self.dsum2[:, igroups], axis=1))
+        result = {"ebins": self.ebins, "lags": self.lags, "counts": counts,
+                  "drift": drift, "dee": dee,
+                  "drift_err": np.nanstd(drift_boot, axis=0),
+                  "dee_err": np.nanstd(dee_boot, axis=0)}
+        return result
+
+
+def estimate_diffusion(steps, ebins, lags, dt, ngroups=64, nboot=200,
+                       pmass=1.0, pslice=None, nworkers=None):
+    """Estimate the energy diffusion from the tracer steps in one pass
+
+    Args:
+        steps: list of (file name, group name, ...) in time order
+        ebins: energy bin edges, in the units of the kinetic energy
+            (gamma - 1) * pmass
+        lags: lags in number of steps
+        dt: time interval between two steps
+        ngroups: number of random tracer groups for the bootstrap
+        nboot: number of bootstrap samples
+        pmass: particle mass
+        pslice: [start, end) of the tracers to use
+        nworkers: number of reading processes
+
+    Returns:
+        result: dictionary from EnergyDiffusionEstimator.finalize
+    """
+    estimator = EnergyDiffusionEstimator(ebins, lags, dt, ngroups)
+    varnames = ["q", "Ux", "Uy", "Uz"]
+    for istep, ptl in tracer_stream.stream_tracer_steps(steps, varnames,
+                                                        pslice, nworkers):
+        gamma = np.sqrt(1.0 + ptl["Ux"]**2 + ptl["Uy"]**2 + ptl["Uz"]**2)
+        estimator.update((gamma - 1) * pmass, ptl["q"] != 0)
+    return estimator.finalize(nboot)
@@ -0,0 +1,176 @@
+"""
+Energization of the whole tracer population along the trajectories
+
+The tracer file is particle-major (one group per particle). Blocks of
+particles are read as (nsteps, nptl) arrays, so the decomposition of q v.E
+into the parallel, perpendicular and inductive (v x B) parts and the time
+integration are 2D array operations instead of one interp1d and cumsum per
+particle. Blocks are computed in parallel and written by the parent process
+to one HDF5 file:
+    <var>: (nptl, ) work at the end of the trajectories
+    cumulative/<var>: (nsteps, nptl) work along the trajectories (optional)
+    mean/<var>, std/<var>: (nsteps, ) statistics over all tracers
+where <var> is para, perp, tot, in (when the file has Vx, Vy, Vz) and
+dgamma. Time steps where q is 0 (missing data) do not add work.
+"""
+from __future__ import print_function
+
+import multiprocessing
+
+import h5py
+import numpy as np
+from joblib import delayed
+
+import tracer_transpose
+from parallel_functions import bounded_parallel
+
+
+def energization_rates(ptl):
+    """Rates of work done by the parallel, perpendicular and total E
+
+    The arrays in ptl can have any shape, e.g. (nsteps, ) for a single
+    particle or (nsteps, nptl) for a block of particles.
+
+    Args:
+        ptl: dictionary with Ux, Uy, Uz, Ex, Ey, Ez, Bx, By, Bz, and
+            optionally gamma and the flow velocity Vx, Vy, Vz
+
+    Returns:
+        rates: dictionary of para, perp, tot and in (when Vx is in ptl)
+    """
+    if 'gamma' in ptl:
+        igamma = 1.0 / ptl['gamma']
+    else:
+        igamma = 1.0 / np.sqrt(1 + ptl['Ux']**2 + ptl['Uy']**2 +
+                               ptl['Uz']**2)
+    ibtot2 = 1.0 / (ptl['Bx']**2 + ptl['By']**2 + ptl['Bz']**2)
+    udotb = ptl['Ux'] * ptl['Bx'] + ptl['Uy'] * ptl['By'] + ptl['Uz'] * ptl['Bz']
+    edotb = ptl['Ex'] * ptl['Bx'] + ptl['Ey'] * ptl['By'] + ptl['Ez'] * ptl['Bz']
+    udote = ptl['Ux'] * ptl['Ex'] + ptl['Uy'] * ptl['Ey'] + ptl['Uz'] * ptl['Ez']
+    rates = {}
+    # u.E_para = (u.b)(E.b)/B^2, so E_para is never formed
+    rates['para'] = -udotb * edotb * ibtot2 * igamma
+    rates['tot'] = -udote * igamma
+    rates['perp'] = rates['tot'] - rates['para']
+    if 'Vx' in ptl:
+        # E_vB = v x B of the flow
+        einx = ptl['Vz'] * ptl['By'] - ptl['Vy'] * ptl['Bz']
+        einy = ptl['Vx'] * ptl['Bz'] - ptl['Vz'] * ptl['Bx']
+        einz = ptl['Vy'] * ptl['Bx'] - ptl['Vx'] * ptl['By']
+        rates['in'] = -(ptl['Ux'] * einx + ptl['Uy'] * einy +
+                        ptl['Uz'] * einz) * igamma
+    return rates
+
+
+def compensated_cumsum(rates, dt, dtype=np.float64):
+    """Cumulative time integral with Kahan summation
+
+    The compensation keeps float32 accumulation accurate over long
+    trajectories.
+
+    Args:
+        rates: (nsteps, ...) rates
+        dt: time interval
+        dtype: accumulation data type
+
+    Returns:
+        cum: (nsteps, ...) integrals
+    """
+    cum = np.empty(rates.shape, dtype=dtype)
+    total = np.zeros(rates.shape[1:], dtype=dtype)
+    comp = np.zeros(rates.shape[1:], dtype=dtype)
+    dt = dtype(dt)
+    for it in range(rates.shape[0]):
+        y = rates[it].astype(dtype) * dt - comp
+        tsum = total + y
+        comp = (tsum - total) - y
+        total = tsum
+        cum[it] = total
+    return cum
+
+
+def block_energization(fname, tags, dt, varnames, dtype=np.float64):
+    """Energization of a block of particles
+
+    Args:
+        fname: particle-major tracer file
+        tags: particle tags of this block
+        dt: time interval between two steps
+        varnames: variables to read
+        dtype: accumulation data type
+
+    Returns:
+        cums: dictionary of (nsteps, nptl) integrals
+    """
+    with h5py.File(fname, 'r') as fh:
+        ntf, = fh[tags[0]][varnames[0]].shape
+    ptl = tracer_transpose.read_block(fname, tags, 0, ntf, varnames, {})
+    rates = energization_rates(ptl)
+    valid = ptl['q'] != 0
+    cums = {}
+    for var in rates:
+        rates[var][~valid] = 0
+        cums[var] = compensated_cumsum(rates[var], dt, dtype)
+    # gamma - gamma0, with gamma0 at the first valid step of each particle
+    gamma = ptl['gamma']
+    ifirst = np.argmax(valid, axis=0)
+    gamma0 = gamma[ifirst, np.arange(len(tags))]
+    cums['dgamma'] = np.where(valid, gamma - gamma0, 0).astype(dtype)
+    return cums
+
+
+def calc_energization(fname_in, fname_out, dt, nptl_block=1024, ncores=None,
+                      dtype=np.float64, save_cumulative=False):
+    """Energization of all tracers in a particle-major file
+
+    Args:
+        fname_in: particle-major tracer file
+        fname_out: output file
+        dt: time interval between two steps
+        nptl_block: number of particles in one block
+        ncores: number of processes
+        dtype: accumulation data type, np.float32 or np.float64
+        save_cumulative: whether to save the work along the trajectories
+    """
+    if ncores is None:
+        ncores = multiprocessing.cpu_count()
+    with h5py.File(fname_in, 'r') as fh:
+        tags, ntf, varnames = tracer_transpose.get_trajectory_info(fh)
+    varnames = [var for var in varnames if var in
+                ['q', 'Ux', 'Uy', 'Uz', 'Ex', 'Ey', 'Ez', 'Bx', 'By', 'Bz',
+                 'Vx', 'Vy', 'Vz']]
+    nptl = len(tags)
+    nptl_block = min(nptl_block, nptl)
+    blocks = [(ps, min(ps + nptl_block, nptl))
+              for ps in range(0, nptl, nptl_block)]
+    outvars = ['para', 'perp', 'tot', 'dgamma']
+    if 'Vx' in varnames:
+        outvars.insert(3, 'in')
+    esum = {var: np.zeros(ntf) for var in outvars}
+    esum2 = {var: np.zeros(ntf) for var in outvars}
+
+    with h5py.File(fname_out, 'w') as fh_out:
+        for var in outvars:
+            fh_out.create_dataset(var, (nptl, ), dtype=dtype)
+            if save_cumulative:
+                fh_out.create_dataset('cumulative/' + var, (ntf, nptl),
+                                      dtype=dtype,
+                                      chunks=(min(ntf, 64), nptl_block))
+        res = bounded_parallel(
+            (delayed(block_energization)(fname_in, tags[ps:pe], dt,
+                                         varnames, dtype)
+             for ps, pe in blocks), ncores)
+        for iblock, ((ps, pe), cums) in enumerate(zip(blocks, res)):
+            print("Block %d of %d" % (iblock, len(blocks)))
+            for var in outvars:
+                fh_out[var][ps:pe] = cums[var][-1]
+                if save_cumulative:
+                    fh_out['cumulative/' + var][:, ps:pe] = cums[var]
+                esum[var] += np.sum(cums[var], axis=1, dtype=np.float64)
+                esum2[var] += np.sum(cums[var].astype(np.float64)**2,
+                                     axis=1)
+        for var in outvars:
+            emean = esum[var] / nptl
+            fh_out.create_dataset('mean/' + var, data=emean)
+            fh_out.create_dataset('std/' + var, data=np.sqrt(np.maximum(
+                esum2[var] / nptl - emean**2, 0)))
@@ -0,0 +1,231 @@
+"""
+Batch export of tracer trajectories for visualization
+
+Blocks of particles are read from a particle-major tracer file, decimated
+in time and unwrapped across the periodic boundaries in parallel, and
+written as
+    vtu: one VTU file of poly lines per block, with the data in raw
+        appended binary, and a .vtm file collecting the blocks
+    h5part: one H5Part file with one 'Step#' group per output step
+    csv: one CSV file per block with the tag and step of each point
+Steps where q is 0 (missing data) are not exported in the vtu and csv
+formats. The H5Part file keeps all particles at all steps.
+"""
+from __future__ import print_function
+
+import multiprocessing
+import os
+import struct
+
+import h5py
+import numpy as np
+import pandas as pd
+from joblib import delayed
+
+import tracer_periodic
+import tracer_transpose
+from parallel_functions import bounded_parallel
+
+VTK_POLY_LINE = 4
+# numpy kind and item size -> VTK data type. Booleans are written as bytes.
+VTK_TYPES = {'f4': 'Float32', 'f8': 'Float64',
+             'i1': 'Int8', 'i2': 'Int16', 'i4': 'Int32', 'i8': 'Int64',
+             'u1': 'UInt8', 'u2': 'UInt16', 'u4': 'UInt32', 'u8': 'UInt64',
+             'b1': 'UInt8'}
+
+
+def vtk_type(dtype):
+    """VTK data type of a numpy data type
+    """
+    key = dtype.kind + str(dtype.itemsize)
+    if key not in VTK_TYPES:
+        raise ValueError("Data type %s cannot be written to VTK files" % dtype)
+    return VTK_TYPES[key]
+
+
+def read_export_block(fname, tags, varnames, config):
+    """Read a block of trajectories for exporting
+
+    Args:
+        fname: particle-major tracer file
+        tags: particle tags of this block
+        varnames: variables to read
+        config: dictionary with optional
+            'tstride': keep every tstride steps
+            'pos_scale': [x, y, z] scales of the positions
+            'lengths': [x, y, z] box sizes (after scaling) for unwrapping
+                the periodic boundaries
+
+    Returns:
+        ptl: dictionary of (nsteps, len(tags)) arrays
+    """
+    with h5py.File(fname, 'r') as fh:
+        ntf, = fh[tags[0]][varnames[0]].shape
+    rconfig = {}
+    if 'pos_scale' in config:
+        rconfig['pos_scale'] = config['pos_scale']
+    ptl = tracer_transpose.read_block(fname, tags, 0, ntf, varnames, rconfig)
+    if 'lengths' in config:
+        if 'q' in ptl:
+            # missing points would look like boundary crossings, so they
+            # take the positions of the closest valid points before them
+            valid = ptl['q'] != 0
+            it = np.arange(ntf)[:, np.newaxis]
+            rows = np.maximum.accumulate(np.where(valid, it, 0), axis=0)
+            rows = np.maximum(rows, np.argmax(valid, axis=0))
+            cols = np.arange(len(tags))
+        for var, length in zip(['dX', 'dY', 'dZ'], config['lengths']):
+            if 'q' in ptl:
+                ptl[var] = ptl[var][rows, cols]
+            ptl[var] = tracer_periodic.unwrap_positions(ptl[var], length)
+    tstride = config.get('tstride', 1)
+    if tstride > 1:
+        for var in ptl:
+            ptl[var] = ptl[var][::tstride]
+    return ptl
+
+
+def write_vtu(fname, ptl, valid):
+    """Write trajectories as poly lines in a VTU file with appended data
+
+    Args:
+        fname: output file name
+        ptl: dictionary of (nsteps, nptl) arrays, including dX, dY, dZ
+        valid: (nsteps, nptl) mask of the points to write
+    """
+    # points of one particle are contiguous
+    validt = valid.T
+    npoints = np.count_nonzero(validt, axis=1)
+    points = np.stack([ptl[var].T[validt] for var in ['dX', 'dY', 'dZ']],
+                      axis=1).astype(np.float32)
+    arrays = []
+    for var in sorted(ptl):
+        if var not in ['dX', 'dY', 'dZ']:
+            arrays.append(('PointData', var, 1,
+                           np.ascontiguousarray(ptl[var].T[validt])))
+    arrays.append(('Points', 'Points', 3, points))
+    npoints = npoints[npoints > 0]
+    connectivity = np.arange(np.sum(npoints), dtype=np.int64)
+    offsets = np.cumsum(npoints).astype(np.int64)
+    types = np.full(len(npoints), VTK_POLY_LINE, dtype=np.uint8)
+    arrays.append(('Cells', 'connectivity', 1, connectivity))
+    arrays.append(('Cells', 'offsets', 1, offsets))
+    arrays.append(('Cells', 'types', 1, types))
+
+    headers = {'PointData': [], 'Points': [], 'Cells': []}
+    offset = 0
+    for section, name, ncomp, data in arrays:
+        dtype = vtk_type(data.dtype)
+        headers[section].append(
+            '<DataArray type="%s" Name="%s" NumberOfComponents="%d" '
+            'format="appended" offset="%d"/>' % (dtype, name, ncomp, offset))
+        offset += 8 + data.nbytes
+    with open(fname, 'wb') as f:
+        f.write(('<?xml version="1.0"?>\n'
+                 '<VTKFile type="UnstructuredGrid" version="1.0" '
+                 'byte_order="LittleEndian" header_type="UInt64">\n'
+                 '<UnstructuredGrid>\n'
+                 '<Piece NumberOfPoints="%d" NumberOfCells="%d">\n' %
+                 (len(points), len(npoints))).encode())
+        for section in ['PointData', 'Points', 'Cells']:
+            f.write(('<%s>\n%s\n</%s>\n' %
+                     (section, '\n'.join(headers[section]),
+                      section)).encode())
+        f.write(b'</Piece>\n</UnstructuredGrid>\n'
+                b'<AppendedData encoding="raw">\n_')
+        for _, _, _, data in arrays:
+            f.write(struct.pack('<Q', data.nbytes))
+            f.write(data.astype(data.dtype.newbyteorder('<')).tobytes())
+        f.write(b'\n</AppendedData>\n</VTKFile>\n')
+
+
+def write_vtm(fname, fnames_block):
+    """Write a multi-block file collecting the VTU files of all blocks
+    """
+    with open(fname, 'w') as f:
+        f.write('<?xml version="1.0"?>\n'
+                '<VTKFile type="vtkMultiBlockDataSet" version="1.0">\n'
+                '<vtkMultiBlockDataSet>\n')
+        for iblock, fname_block in enumerate(fnames_block):
+            f.write('<DataSet index="%d" file="%s"/>\n' %
+                    (iblock, os.path.basename(fname_block)))
+        f.write('</vtkMultiBlockDataSet>\n</VTKFile>\n')
+
+
+def write_csv(fname, ptl, valid, tags):
+    """Write trajectories to a CSV file with the tag and step of each point
+    """
+    validt = valid.T
+    nt = valid.shape[0]
+    pdata = {'tag': np.repeat(np.asarray(tags), nt)[validt.ravel()],
+             'step': np.tile(np.arange(nt), len(tags))[validt.ravel()]}
+    for var in ptl:
+        pdata[var] = ptl[var].T[validt]
+    df = pd.DataFrame(pdata)
+    df.to_csv(fname, mode='w', index=False)
+
+
+def export_block(fname, tags, varnames, config, fmt, fname_block):
+    """Export one block of trajectories
+
+    The vtu and csv formats are written by the workers, and the h5part
+    data is returned to the parent process.
+    """
+    ptl = read_export_block(fname, tags, varnames, config)
+    valid = ptl['q'] != 0 if 'q' in ptl else np.ones(ptl['dX'].shape, bool)
+    if fmt == 'vtu':
+        write_vtu(fname_block, ptl, valid)
+    elif fmt == 'csv':
+        write_csv(fname_block, ptl, valid, tags)
+    else:
+        return ptl
+
+
+def export_tracers(fname, fbase, fmt='vtu', config=None, nptl_block=1024,
+                   ncores=None):
+    """Export all trajectories in a particle-major tracer file
+
+    Args:
+        fname: particle-major tracer file
+        fbase: output file name without the extension
+        fmt: 'vtu', 'h5part' or 'csv'
+        config: dictionary passed to read_export_block
+        nptl_block: number of particles in one block
+        ncores: number of processes
+    """
+    if config is None:
+        config = {}
+    if ncores is None:
+        ncores = multiprocessing.cpu_count()
+    with h5py.File(fname, 'r') as fh:
+        tags, ntf, varnames = tracer_transpose.get_trajectory_info(fh)
+    nptl = len(tags)
+    nptl_block = min(nptl_block, nptl)
+    blocks = [(ps, min(ps + nptl_block, nptl))
+              for ps in range(0, nptl, nptl_block)]
+    fnames_block = [fbase + '_' + str(iblock) + '.' + fmt
+                    for iblock in range(len(blocks))]
+    if fmt == 'h5part':
+        fh_out = h5py.File(fbase + '.h5part', 'w')
+    res = bounded_parallel(
+        (delayed(export_block)(fname, tags[ps:pe], varnames, config, fmt,
+                               fname_block)
+         for (ps, pe), fname_block in zip(blocks, fnames_block)), ncores)
+    for iblock, ((ps, pe), ptl) in enumerate(zip(blocks, res)):
+        print("Block %d of %d" % (iblock, len(blocks)))
+        if fmt != 'h5part':
+            continue
+        nt_out = ptl['dX'].shape[0]
+        for tindex in range(nt_out):
+            gname = 'Step#' + str(tindex)
+            if gname not in fh_out:
+                grp = fh_out.create_group(gname)
+                for var in ptl:
+                    grp.create_dataset(var, (nptl, ), dtype=ptl[var].dtype,
+                                       chunks=(nptl_block, ))
+            for var in ptl:
+                fh_out[gname][var][ps:pe] = ptl[var][tindex]
+    if fmt == 'h5part':
+        fh_out.close()
+    elif fmt == 'vtu':
+        write_vtm(fbase + '.vtm', fnames_block)
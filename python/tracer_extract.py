@@ -0,0 +1,140 @@
+"""
+On-demand extraction of single trajectories from time-major tracer files
+
+The rows of the requested tags in every step file are found with the tag
+index (tracer_index), and the step files are read in parallel. Each
+trajectory is returned as a compact (nsteps, ) structured array with one
+field per variable in the dtype of the step files, so integer columns
+such as q and i are kept exactly. The
+extracted trajectories are cached as .npy files in a local directory, so
+inspecting the same particles again does not touch the step files. The
+least recently used files are removed when the cache is full.
+"""
+from __future__ import print_function
+
+import hashlib
+import multiprocessing
+import os
+
+import h5py
+import numpy as np
+from joblib import Parallel, delayed
+
+import tracer_index
+from shell_functions import mkdir_p
+
+
+class TrajectoryExtractor(object):
+    def __init__(self, fname_index, cache_dir, max_cache=1000, ncores=None):
+        """
+        Args:
+            fname_index: file name of the tag index
+            cache_dir: directory of the cached trajectories
+            max_cache: maximum number of cached trajectories
+            ncores: number of processes for reading the step files
+        """
+        self.fname_index = fname_index
+        # the steps are read once for each extraction, so they are not kept
+        self.index = tracer_index.TracerIndex(fname_index, cache_steps=False)
+        self.cache_dir = cache_dir
+        self.max_cache = max_cache
+        self.ncores = multiprocessing.cpu_count() if ncores is None else ncores
+        mkdir_p(cache_dir)
+
+    def close(self):
+        self.index.close()
+
+    def available_varnames(self):
+        """Names of the variables in the step files
+        """
+        tindex = self.index.tindices[0]
+        step_config = self.index.step_config
+        fname = tracer_index.step_file_name(step_config, tindex)
+        with h5py.File(fname, 'r') as fh:
+            group = fh[tracer_index.step_group_name(step_config, tindex)]
+            return [str(var) for var in group
+                    if isinstance(group[var], h5py.Dataset)]
+
+    def get_tindices(self, tstart=None, tend=None):
+        """Time indices of the steps in [tstart, tend]
+        """
+        tindices = self.index.tindices
+        cond = np.ones(len(tindices), dtype=bool)
+        if tstart is not None:
+            cond &= tindices >= tstart
+        if tend is not None:
+            cond &= tindices <= tend
+        return tindices[cond]
+
+    def cache_name(self, tag, tindices, varnames):
+        """File name of one cached trajectory
+        """
+        key = "struct:%s:%d:%d:%d:%d:%s" % (
+            os.path.abspath(self.fname_index), int(tag), tindices[0],
+            tindices[-1], len(tindices), ','.join(varnames))
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.cache_dir, 'traj_' + digest + '.npy')
+
+    def evict(self):
+        """Remove the least recently used trajectories from the cache
+        """
+        fnames = [os.path.join(self.cache_dir, fname)
+                  for fname in os.listdir(self.cache_dir)
+                  if fname.startswith('traj_')]
+        if len(fnames) <= self.max_cache:
+            return
+        fnames.sort(key=os.path.getmtime)
+        for fname in fnames[:len(fnames) - self.max_cache]:
+            os.remove(fname)
+
+    def extract(self, tags, varnames, tstart=None, tend=None):
+        """Extract the trajectories of some tracers
+
+        Args:
+            tags: tracer tags
+            varnames: variables to extract, e.g. ['dX', 'dY', 'Ux']
+            tstart, tend: the first and last time indices (both included)
+
+        Returns:
+            tindices: (nsteps, ) time indices of the steps
+            trajs: dictionary of tag -> (nsteps, ) structured array with
+                the fields varnames. Steps where a tracer is not present
+                are zeros.
+        """
+        tindices = self.get_tindices(tstart, tend)
+        if len(tindices) == 0:
+            dtype = [(str(var), np.float32) for var in varnames]
+            return tindices, {tag: np.zeros(0, dtype=dtype) for tag in tags}
+        trajs = {}
+        missing = []
+        for tag in tags:
+            fname = self.cache_name(tag, tindices, varnames)
+            if os.path.isfile(fname):
+                trajs[tag] = np.load(fname)
+                os.utime(fname, None)  # recently used
+            else:
+                missing.append(tag)
+        if not missing:
+            return tindices, trajs
+
+        rows = [self.index.rows(tindex, missing) for tindex in tindices]
+        res = Parallel(n_jobs=self.ncores)(
+            delayed(tracer_index.read_step_rows)(self.index.step_config,
+                                                 tindex, rows_step, varnames)
+            for tindex, rows_step in zip(tindices, rows))
+        dtype = [(str(var), res[0][var].dtype) for var in varnames]
+        tdata = np.zeros((len(missing), len(tindices)), dtype=dtype)
+        for it, ptl in enumerate(res):
+            for var in varnames:
+                tdata[var][:, it] = ptl[var]
+        for iptl, tag in enumerate(missing):
+            trajs[tag] = tdata[iptl]
+            np.save(self.cache_name(tag, tindices, varnames), tdata[iptl])
+        self.evict()
+        return tindices, trajs
+
+
+def trajectory_dict(traj, varnames):
+    """Dictionary of the variables of one extracted trajectory
+    """
+    return {var: traj[var] for var in varnames}
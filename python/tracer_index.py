@@ -0,0 +1,235 @@
+"""
+Tag-keyed index of the time-major tracer files
+
+For every step file the index stores the tracer tags q in sorted order and
+the rows where they are in the step file. A tag can then be found with
+np.searchsorted in O(log n) instead of scanning the whole step with
+np.in1d. The index is built once, in parallel over step files, and saved
+in one HDF5 file:
+    tindex: (nsteps, ) time indices of the step files
+    Step#<tindex>/q: sorted tags
+    Step#<tindex>/rows: rows of the sorted tags in the step file
+
+Step files are described by a dictionary
+    tracer_dir: directory of the tracer data
+    fname_pattern: step file name relative to tracer_dir, e.g.
+        'T.{tindex}/tracers.h5p'
+    group_pattern: HDF5 group of the step, e.g.
+        'Step#{tindex}/electron_tracer'
+"""
+from __future__ import print_function
+
+import multiprocessing
+import os
+
+import h5py
+import numpy as np
+from joblib import delayed
+
+import tracer_codec
+from parallel_functions import bounded_parallel
+
+
+def step_file_name(step_config, tindex):
+    """File name of one tracer step
+    """
+    return (step_config["tracer_dir"] +
+            step_config["fname_pattern"].format(tindex=tindex))
+
+
+def step_group_name(step_config, tindex):
+    """HDF5 group name of one tracer step
+    """
+    return step_config["group_pattern"].format(tindex=tindex)
+
+
+def get_tindices(tracer_dir):
+    """Time indices of the T.* directories in the tracer directory
+    """
+    tindices = []
+    for file_name in os.listdir(tracer_dir):
+        if file_name.startswith('T.'):
+            tindices.append(int(file_name.split(".")[-1]))
+    return np.sort(np.asarray(tindices))
+
+
+def read_step_tags(step_config, tindex):
+    """Read the tags of one step and sort them
+
+    Returns:
+        qsorted: sorted tags
+        rows: rows of the sorted tags in the step file
+    """
+    fname = step_file_name(step_config, tindex)
+    with h5py.File(fname, 'r') as fh:
+        dset = fh[step_group_name(step_config, tindex)]['q']
+        qtag = np.zeros(dset.shape, dtype=dset.dtype)
+        dset.read_direct(qtag)
+    rows = np.argsort(qtag, kind='stable').astype(np.int64)
+    return qtag[rows], rows
+
+
+def build_tracer_index(step_config, tindices, fname_index, ncores=None):
+    """Build the tag index of all step files
+
+    Args:
+        step_config: description of the step files
+        tindices: time indices of the step files
+        fname_index: file name of the index
+        ncores: number of processes
+    """
+    if ncores is None:
+        ncores = multiprocessing.cpu_count()
+    with h5py.File(fname_index, 'w') as fh:
+        fh.create_dataset('tindex', data=np.asarray(tindices))
+        for key in step_config:
+            fh.attrs[key] = step_config[key]
+        res = bounded_parallel(
+            (delayed(read_step_tags)(step_config, tindex)
+             for tindex in tindices), ncores)
+        for tindex, (qsorted, rows) in zip(tindices, res):
+            print("Time index: %d" % tindex)
+            grp = fh.create_group('Step#' + str(tindex))
+            grp.create_dataset('q', data=qsorted)
+            grp.create_dataset('rows', data=rows)
+
+
+def index_is_current(fname_index, tindices):
+    """Whether the index exists and covers exactly the given steps
+    """
+    if not os.path.isfile(fname_index):
+        return False
+    with h5py.File(fname_index, 'r') as fh:
+        if 'tindex' not in fh:
+            return False
+        tindices_index = fh['tindex'][:]
+    return np.array_equal(np.sort(tindices_index), np.sort(tindices))
+
+
+def read_step_rows(step_config, tindex, rows, varnames=None):
+    """Read some rows of a step file
+
+    Args:
+        step_config: description of the step files
+        tindex: time index of the step
+        rows: rows to read. Rows < 0 are filled with zeros.
+        varnames: variables to read. All variables when it is None.
+
+    Returns:
+        ptl: dictionary of the variables
+    """
+    rows = np.asarray(rows)
+    valid = rows >= 0
+    rows_sorted, inverse = np.unique(rows[valid], return_inverse=True)
+    fname = step_file_name(step_config, tindex)
+    gname = step_group_name(step_config, tindex)
+    ptl = {}
+    with h5py.File(fname, 'r') as fh:
+        group = fh[gname]
+        if varnames is None:
+            varnames = list(group.keys())
+        for var in varnames:
+            dset = group[var]
+            dtype = np.dtype(dset.attrs.get('dtype', dset.dtype))
+            pdata = np.zeros(len(rows), dtype=dtype)
+            if dset.attrs.get('codec', 'raw') != 'raw':
+                # encoded data is decoded as a whole
+                fdata = tracer_codec.read_dataset(fh, gname + '/' + var)
+                pdata[valid] = fdata[rows_sorted][inverse]
+            elif len(rows_sorted) > 0.1 * dset.shape[0]:
+                # a contiguous read is faster for many rows
+                pdata[valid] = dset[:][rows_sorted][inverse]
+            elif len(rows_sorted):
+                pdata[valid] = dset[rows_sorted.tolist()][inverse]
+            ptl[var] = pdata
+    return ptl
+
+
+class TracerIndex(object):
+    def __init__(self, fname_index, cache_steps=True):
+        """
+        Args:
+            fname_index: file name of the index
+            cache_steps: whether to keep the loaded steps in memory
+        """
+        self.fh = h5py.File(fname_index, 'r')
+        self.tindices = self.fh['tindex'][:]
+        self.step_config = {key: str(self.fh.attrs[key])
+                            for key in self.fh.attrs}
+        self.cache_steps = cache_steps
+        self.cache = {}
+
+    def close(self):
+        self.fh.close()
+
+    def step(self, tindex):
+        """Sorted tags and their rows at one step
+        """
+        if tindex in self.cache:
+            return self.cache[tindex]
+        grp = self.fh['Step#' + str(tindex)]
+        qsorted = grp['q'][:]
+        rows = grp['rows'][:]
+        if self.cache_steps:
+            self.cache[tindex] = (qsorted, rows)
+        return (qsorted, rows)
+
+    def rows(self, tindex, tags):
+        """Rows of the tags in the step file
+
+        Args:
+            tindex: time index of the step
+            tags: tracer tags
+
+        Returns:
+            rows: rows in the step file, -1 for the tags that are not there
+        """
+        qsorted, rows = self.step(tindex)
+        tags = np.asarray(tags)
+        pos = np.searchsorted(qsorted, tags)
+        pos_clip = np.minimum(pos, len(qsorted) - 1)
+        found = np.logical_and(pos < len(qsorted), qsorted[pos_clip] == tags)
+        return np.where(found, rows[pos_clip], -1)
+
+    def present(self, tags, tindices=None):
+        """Whether the tags are present at each step
+
+        Returns:
+            mask: (nsteps, ntags) boolean array
+        """
+        if tindices is None:
+            tindices = self.tindices
+        tags = np.asarray(tags)
+        mask = np.zeros((len(tindices), len(tags)), dtype=bool)
+        for it, tindex in enumerate(tindices):
+            mask[it] = self.rows(tindex, tags) >= 0
+        return mask
+
+    def steps_with_tag(self, tag):
+        """Time indices of the steps where the tag is present
+        """
+        mask = self.present([tag])
+        return self.tindices[mask[:, 0]]
+
+    def survivors(self, tindices=None):
+        """Tags that are present at all steps, without duplicates
+        """
+        if tindices is None:
+            tindices = self.tindices
+        qunique = np.unique(self.step(tindices[0])[0])
+        for tindex in tindices[1:]:
+            qunique = np.intersect1d(qunique, self.step(tindex)[0])
+        return qunique
+
+    def read_rows(self, tindex, rows, varnames=None):
+        """Read some rows of a step file
+
+        Args:
+            tindex: time index of the step
+            rows: rows to read. Rows < 0 are filled with zeros.
+            varnames: variables to read. All variables when it is None.
+
+        Returns:
+            ptl: dictionary of the variables
+        """
+        return read_step_rows(self.step_config, tindex, rows, varnames)
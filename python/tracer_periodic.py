@@ -0,0 +1,164 @@
+"""
+Periodic-boundary unwrapping and crossing detection for tracer positions
+
+A particle crosses a periodic boundary when its position jumps by more than
+a fraction (0.1 by default) of the box size between two steps. Unwrapping
+adds the accumulated box-size offsets to the following steps. Both are done
+with np.diff and np.cumsum along the time axis, so they work on a single
+trajectory of shape (nsteps, ) or on blocks of trajectories, e.g. of shape
+(nsteps, nptl).
+"""
+from __future__ import print_function
+
+import multiprocessing
+
+import h5py
+import numpy as np
+from joblib import delayed
+
+import tracer_transpose
+from parallel_functions import bounded_parallel
+
+
+def crossing_offsets(pos, length, axis=0, threshold=0.1):
+    """Offsets added at the boundary crossings
+
+    Args:
+        pos: positions along one axis
+        length: the box size along that axis
+        axis: time axis of pos
+        threshold: fraction of the box size for detecting crossings
+
+    Returns:
+        jumps: offsets between step i and i+1: +length, -length or 0.
+            The time axis is one shorter than pos.
+    """
+    dpos = np.diff(pos, axis=axis)
+    jumps = np.zeros(dpos.shape)
+    jumps[dpos < -threshold * length] = length
+    jumps[dpos > threshold * length] = -length
+    return jumps
+
+
+def unwrap_positions(pos, length, axis=0, threshold=0.1):
+    """Adjust positions for periodic boundary conditions
+
+    Args:
+        pos: positions along one axis
+        length: the box size along that axis
+        axis: time axis of pos
+        threshold: fraction of the box size for detecting crossings
+
+    Returns:
+        pos_b: unwrapped positions with the same data type as pos
+    """
+    pos = np.asarray(pos)
+    jumps = crossing_offsets(pos, length, axis, threshold)
+    offsets = np.cumsum(jumps, axis=axis)
+    pad = [(0, 0)] * pos.ndim
+    pad[axis] = (1, 0)
+    offsets = np.pad(offsets, pad, mode='constant')
+    return (pos + offsets).astype(pos.dtype)
+
+
+def get_crossings(pos, length, threshold=0.1):
+    """Get the crossing points of one trajectory along one axis
+
+    Args:
+        pos: the position along one axis
+        length: the box size along that axis
+        threshold: fraction of the box size for detecting crossings
+
+    Returns:
+        nc: number of crossings
+        crossings: steps right before the crossings
+        offsets: accumulated offsets after each crossing
+    """
+    jumps = crossing_offsets(pos, length, 0, threshold)
+    crossings, = np.nonzero(jumps)
+    nc = len(crossings)
+    offsets = np.cumsum(jumps[crossings])
+    return (nc, crossings, offsets)
+
+
+def count_crossings(pos, length, axis=0, threshold=0.1):
+    """Number of boundary crossings of each trajectory
+
+    Returns:
+        nplus: crossings in the positive direction
+        nminus: crossings in the negative direction
+    """
+    jumps = crossing_offsets(pos, length, axis, threshold)
+    return np.sum(jumps > 0, axis=axis), np.sum(jumps < 0, axis=axis)
+
+
+def block_crossings(fname, tags, lengths, pos_scale, threshold):
+    """Crossings and displacements of a block of particles
+
+    Args:
+        fname: particle-major tracer file
+        tags: particle tags of this block
+        lengths: box sizes along x, y and z
+        pos_scale: scales applied to dX, dY and dZ
+        threshold: fraction of the box size for detecting crossings
+
+    Returns:
+        ncross: (nptl, 3, 2) crossings in positive and negative directions
+        dsum: (nsteps, 3) sums of the displacements
+        dsum2: (nsteps, 3) sums of the squared displacements
+    """
+    with h5py.File(fname, 'r') as fh:
+        ntf, = fh[tags[0]]['dX'].shape
+    config = {'pos_scale': pos_scale}
+    ptl = tracer_transpose.read_block(fname, tags, 0, ntf,
+                                      ['dX', 'dY', 'dZ'], config)
+    ncross = np.zeros((len(tags), 3, 2), dtype=np.int64)
+    dsum = np.zeros((ntf, 3))
+    dsum2 = np.zeros((ntf, 3))
+    for i, (var, length) in enumerate(zip(['dX', 'dY', 'dZ'], lengths)):
+        pos = ptl[var].astype(np.float64)
+        ncross[:, i, 0], ncross[:, i, 1] = count_crossings(pos, length,
+                                                           0, threshold)
+        pos_b = unwrap_positions(pos, length, 0, threshold)
+        disp = pos_b - pos_b[0]
+        dsum[:, i] = np.sum(disp, axis=1)
+        dsum2[:, i] = np.sum(disp**2, axis=1)
+    return ncross, dsum, dsum2
+
+
+def crossing_statistics(fname, lengths, pos_scale=(1, 1, 1), threshold=0.1,
+                        nptl_block=4096, ncores=None):
+    """Crossing counts and displacement statistics of all tracers
+
+    Args:
+        fname: particle-major tracer file
+        lengths: box sizes along x, y and z, in the units after pos_scale
+        pos_scale: scales applied to dX, dY and dZ
+        threshold: fraction of the box size for detecting crossings
+        nptl_block: number of particles in one block
+        ncores: number of processes
+
+    Returns:
+        ncross: (nptl, 3, 2) crossings in positive and negative directions
+        disp_mean: (nsteps, 3) mean displacements
+        disp_msq: (nsteps, 3) mean squared displacements
+    """
+    if ncores is None:
+        ncores = multiprocessing.cpu_count()
+    with h5py.File(fname, 'r') as fh:
+        tags, ntf, _ = tracer_transpose.get_trajectory_info(fh)
+    nptl = len(tags)
+    blocks = [(ps, min(ps + nptl_block, nptl))
+              for ps in range(0, nptl, nptl_block)]
+    ncross = np.zeros((nptl, 3, 2), dtype=np.int64)
+    dsum = np.zeros((ntf, 3))
+    dsum2 = np.zeros((ntf, 3))
+    res = bounded_parallel(
+        (delayed(block_crossings)(fname, tags[ps:pe], lengths, pos_scale,
+                                  threshold)
+         for ps, pe in blocks), ncores)
+    for (ps, pe), (nc, ds, ds2) in zip(blocks, res):
+        ncross[ps:pe] = nc
+        dsum += ds
+        dsum2 += ds2
+    return ncross, dsum / nptl, dsum2 / nptl
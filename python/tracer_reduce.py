@@ -5,7 +5,9 @@ import collections
 import math
 import multiprocessing
 import os.path
+import shutil
 import struct
+import tempfile
 
 import h5py
 import matplotlib as mpl
@@ -80,29 +82,58 @@ def get_meta_data(pic_info):
     return meta_data
 
 
+def rank_sort_index(keys, nbuckets):
+    """Stable argsort of integer keys in [0, nbuckets) and the bucket sizes
+
+    For up to 65536 buckets, the keys are cast to uint8 or uint16, for which
+    numpy's stable sort is a radix sort, so the permutation costs O(n)
+    instead of the O(n log n) of a comparison sort.
+
+    Args:
+        keys: integer keys, e.g. the MPI rank of each particle
+        nbuckets: number of buckets
+
+    Returns:
+        sort_index: the permutation
+        counts: number of keys in each bucket
+    """
+    counts = np.bincount(keys, minlength=nbuckets)
+    if nbuckets <= 256:
+        keys = keys.astype(np.uint8)
+    elif nbuckets <= 65536:
+        keys = keys.astype(np.uint16)
+    sort_index = np.argsort(keys, kind='stable')
+    return sort_index, counts
+
+
+def check_rank_sort(nptl=100000, nbuckets=4096, seed=0):
+    """Check rank_sort_index against np.argsort on random keys
+
+    Run it by hand together with check_sort_tracer_data.
+    """
+    keys = np.random.RandomState(seed).randint(0, nbuckets, nptl)
+    sort_index, counts = rank_sort_index(keys, nbuckets)
+    assert np.array_equal(sort_index, np.argsort(keys, kind='mergesort'))
+    elements, repeats = np.unique(keys, return_counts=True)
+    assert np.array_equal(counts[elements], repeats)
+    assert np.sum(counts) == nptl
+
+
 def sort_tracer_data(pic_info,
                      pmin,
                      meta_data,
                      ct,
                      species,
                      root_path='../../'):
-    """Sort tracer data
+    """Sort tracer data by MPI rank
+
+    The particles are sorted by MPI rank with a stable radix sort. The
+    columns are then read, converted and written one at a time, so only
+    one data column is in memory besides the rank and cell indices.
     """
     fpath = root_path + 'tracer/T.' + str(ct) + '/'
     fname_reduced = fpath + species + '_tracer_reduced.h5p'
-    with h5py.File(fname_reduced, 'r') as fh:
-        key = 'Step#' + str(ct)
-        group = fh[key]
-        dset = group['q']
-        sz, = dset.shape
-        dX = read_var(group, 'dX', sz)
-        dY = read_var(group, 'dY', sz)
-        dZ = read_var(group, 'dZ', sz)
-        Ux = read_var(group, 'Ux', sz)
-        Uy = read_var(group, 'Uy', sz)
-        Uz = read_var(group, 'Uz', sz)
-        icell = read_var(group, 'i', sz)
-        q = read_var(group, 'q', sz)
+    key = 'Step#' + str(ct)
 
     grid_size_mpi = meta_data['grid_size_mpi']
     grid_dims = meta_data['grid_dims']
@@ -111,54 +142,41 @@ def sort_tracer_data(pic_info,
     tpx = pic_info.topology_x
     tpy = pic_info.topology_y
     tpz = pic_info.topology_z
-    xmin, ymin, zmin = pmin
+    tps = [tpx, tpy, tpz]
     dx_mpi, dy_mpi, dz_mpi = grid_size_mpi
-    dx, dy, dz = grid_size
     nx, ny, nz = grid_dims
-    ix = (dX - xmin) // dx_mpi
-    iy = (dY - ymin) // dy_mpi
-    iz = (dZ - zmin) // dz_mpi
-    ix[ix > tpx - 1] = tpx - 1
-    iy[iy > tpy - 1] = tpy - 1
-    iz[iz > tpz - 1] = tpz - 1
-    mpi_rank = ix + iy * tpx + iz * tpx * tpy
-    mpi_rank = mpi_rank.astype(np.int32)
     nx1 = nx + 2
     ny1 = ny + 2
-    nz1 = nz + 2
-    izp = icell / (nx1 * ny1)
-    iyp = (icell % (nx1 * ny1)) / nx1
-    ixp = icell - izp * nx1 * ny1 - iyp * nx1
-    idx = 1 / dx
-    idy = 1 / dy
-    idz = 1 / dz
-    dX = ((dX - ix * dx_mpi - xmin) * idx - ixp + 1) * 2 - 1
-    dY = ((dY - iy * dy_mpi - ymin) * idy - iyp + 1) * 2 - 1
-    dZ = ((dZ - iz * dz_mpi - zmin) * idz - izp + 1) * 2 - 1
-    dX = dX.astype(np.float32)
-    dY = dX.astype(np.float32)
-    dZ = dX.astype(np.float32)
-
-    dX[(dX < -1) & (ixp == nx)] = 1.0
-    dX[(dX > 1) & (ixp == 1)] = -1.0
-    dY[(dY < -1) & (iyp == ny)] = 1.0
-    dY[(dY > 1) & (iyp == 1)] = -1.0
-    dZ[(dZ < -1) & (izp == nz)] = 1.0
-    dZ[(dZ > 1) & (izp == 1)] = -1.0
-
-    sort_index = np.argsort(mpi_rank)
-    dX = dX[sort_index]
-    dY = dY[sort_index]
-    dZ = dZ[sort_index]
-    Ux = Ux[sort_index]
-    Uy = Uy[sort_index]
-    Uz = Uz[sort_index]
-    icell = icell[sort_index]
-    q = q[sort_index]
+
+    def mpi_index(pos, iaxis):
+        """MPI index of particles along one axis"""
+        ipos = (pos - pmin[iaxis]) // grid_size_mpi[iaxis]
+        ipos = ipos.astype(np.int32)
+        ipos[ipos > tps[iaxis] - 1] = tps[iaxis] - 1
+        return ipos
+
+    def cell_index(icell, iaxis):
+        """Cell index (with ghost cells) of particles along one axis"""
+        if iaxis == 0:
+            return icell % nx1
+        elif iaxis == 1:
+            return (icell % (nx1 * ny1)) // nx1
+        else:
+            return icell // (nx1 * ny1)
+
+    with h5py.File(fname_reduced, 'r') as fh:
+        group = fh[key]
+        dset = group['q']
+        sz, = dset.shape
+        icell = read_var(group, 'i', sz)
+        mpi_rank = np.zeros(sz, dtype=np.int32)
+        for iaxis, (var, stride) in enumerate(zip(['dX', 'dY', 'dZ'],
+                                                  [1, tpx, tpx * tpy])):
+            mpi_rank += mpi_index(read_var(group, var, sz), iaxis) * stride
 
     ncpu = tpx * tpy * tpz
-    elements, repeats = np.unique(mpi_rank, return_counts=True)
-    repeats = repeats.astype(np.int32)
+    sort_index, np_local = rank_sort_index(mpi_rank, ncpu)
+    np_local = np_local.astype(np.int32)
 
     fname = fpath + 'grid_metadata_' + species + '_tracer_reduced.h5p'
     with h5py.File(fname, 'w') as fh:
@@ -173,21 +191,111 @@ def sort_tracer_data(pic_info,
         grp.create_dataset('x0', (ncpu, ), data=meta_data['x0'])
         grp.create_dataset('y0', (ncpu, ), data=meta_data['y0'])
         grp.create_dataset('z0', (ncpu, ), data=meta_data['z0'])
-        grp.create_dataset('np_local', (ncpu, ), data=repeats)
+        grp.create_dataset('np_local', (ncpu, ), data=np_local)
 
-    nptl, = dX.shape
+    nptl = sz
     fname_reduced_sorted = fpath + species + '_tracer_reduced_sorted.h5p'
-    with h5py.File(fname_reduced_sorted, 'w') as fh:
-        gname = 'Step#' + str(ct)
-        grp = fh.create_group(gname)
-        grp.create_dataset('dX', (nptl, ), data=dX)
-        grp.create_dataset('dY', (nptl, ), data=dY)
-        grp.create_dataset('dZ', (nptl, ), data=dZ)
-        grp.create_dataset('Ux', (nptl, ), data=Ux)
-        grp.create_dataset('Uy', (nptl, ), data=Uy)
-        grp.create_dataset('Uz', (nptl, ), data=Uz)
-        grp.create_dataset('i', (nptl, ), data=icell)
-        grp.create_dataset('q', (nptl, ), data=q)
+    with h5py.File(fname_reduced, 'r') as fh_in, \
+            h5py.File(fname_reduced_sorted, 'w') as fh:
+        group = fh_in[key]
+        grp = fh.create_group(key)
+        # positions relative to the cell centers
+        for iaxis, var in enumerate(['dX', 'dY', 'dZ']):
+            pos = read_var(group, var, sz)
+            ipos = mpi_index(pos, iaxis)
+            icell_axis = cell_index(icell, iaxis)
+            pos = ((pos - ipos * grid_size_mpi[iaxis] - pmin[iaxis]) /
+                   grid_size[iaxis] - icell_axis + 1) * 2 - 1
+            pos = pos.astype(np.float32)
+            pos[(pos < -1) & (icell_axis == grid_dims[iaxis])] = 1.0
+            pos[(pos > 1) & (icell_axis == 1)] = -1.0
+            grp.create_dataset(var, (nptl, ), data=pos[sort_index])
+            del pos, ipos, icell_axis
+        grp.create_dataset('i', (nptl, ), data=icell[sort_index])
+        del icell
+        for var in ['Ux', 'Uy', 'Uz', 'q']:
+            pdata = read_var(group, var, sz)
+            grp.create_dataset(var, (nptl, ), data=pdata[sort_index])
+            del pdata
+
+
+def check_sort_tracer_data(nptl=10000, seed=0):
+    """Check sort_tracer_data against an argsort-based reference
+
+    A small tracer file is made up in a temporary directory. The sorted
+    dX, dY, dZ, i and the other columns are compared with the reference,
+    which converts each position from its own column. Run it by hand, e.g.
+        python -c "import tracer_reduce; tracer_reduce.check_sort_tracer_data()"
+    """
+    rng = np.random.RandomState(seed)
+    PicInfo = collections.namedtuple('PicInfo', ['topology_x', 'topology_y',
+                                                 'topology_z'])
+    tps = [4, 3, 2]
+    pic_info = PicInfo(*tps)
+    grid_dims = [8, 6, 5]
+    grid_size = [0.5, 0.25, 1.0]
+    grid_size_mpi = [n * h for n, h in zip(grid_dims, grid_size)]
+    pmin = [-1.0, 2.0, -3.0]
+    ncpu = tps[0] * tps[1] * tps[2]
+    meta_data = {'grid_size_mpi': grid_size_mpi, 'grid_dims': grid_dims,
+                 'grid_size': grid_size, 'x0': np.zeros(ncpu),
+                 'y0': np.zeros(ncpu), 'z0': np.zeros(ncpu)}
+    nx1 = grid_dims[0] + 2
+    ny1 = grid_dims[1] + 2
+    ptl = {}
+    ipos, icell_axis = [], []
+    for iaxis, var in enumerate(['dX', 'dY', 'dZ']):
+        lpos = rng.uniform(0, tps[iaxis] * grid_size_mpi[iaxis], nptl)
+        ptl[var] = (lpos + pmin[iaxis]).astype(np.float32)
+        lpos = ptl[var] - pmin[iaxis]
+        ipos.append(np.minimum(lpos // grid_size_mpi[iaxis],
+                               tps[iaxis] - 1).astype(np.int32))
+        lcell = lpos - ipos[iaxis] * grid_size_mpi[iaxis]
+        icell_axis.append(np.minimum(lcell // grid_size[iaxis],
+                                     grid_dims[iaxis] - 1).astype(np.int32) + 1)
+    ptl['i'] = (icell_axis[0] + icell_axis[1] * nx1 +
+                icell_axis[2] * nx1 * ny1).astype(np.int32)
+    for var in ['Ux', 'Uy', 'Uz']:
+        ptl[var] = rng.normal(size=nptl).astype(np.float32)
+    ptl['q'] = rng.permutation(nptl).astype(np.int32) + 1
+
+    # reference: argsort of the MPI ranks and one conversion for each column
+    mpi_rank = ipos[0] + ipos[1] * tps[0] + ipos[2] * tps[0] * tps[1]
+    sort_index = np.argsort(mpi_rank, kind='mergesort')
+    ref = {}
+    for iaxis, var in enumerate(['dX', 'dY', 'dZ']):
+        pos = ((ptl[var] - ipos[iaxis] * grid_size_mpi[iaxis] - pmin[iaxis]) /
+               grid_size[iaxis] - icell_axis[iaxis] + 1) * 2 - 1
+        pos = pos.astype(np.float32)
+        pos[(pos < -1) & (icell_axis[iaxis] == grid_dims[iaxis])] = 1.0
+        pos[(pos > 1) & (icell_axis[iaxis] == 1)] = -1.0
+        ref[var] = pos[sort_index]
+    for var in ['i', 'Ux', 'Uy', 'Uz', 'q']:
+        ref[var] = ptl[var][sort_index]
+
+    ct = 0
+    root_path = tempfile.mkdtemp() + '/'
+    try:
+        fpath = root_path + 'tracer/T.' + str(ct) + '/'
+        mkdir_p(fpath)
+        with h5py.File(fpath + 'electron_tracer_reduced.h5p', 'w') as fh:
+            grp = fh.create_group('Step#' + str(ct))
+            for var in ptl:
+                grp.create_dataset(var, (nptl, ), data=ptl[var])
+        sort_tracer_data(pic_info, pmin, meta_data, ct, 'electron', root_path)
+        fname = fpath + 'electron_tracer_reduced_sorted.h5p'
+        with h5py.File(fname, 'r') as fh:
+            grp = fh['Step#' + str(ct)]
+            for var in ['dX', 'dY', 'dZ']:
+                assert np.allclose(grp[var][:], ref[var], rtol=0, atol=1E-5), var
+            for var in ['i', 'Ux', 'Uy', 'Uz', 'q']:
+                assert np.array_equal(grp[var][:], ref[var]), var
+        fname = fpath + 'grid_metadata_electron_tracer_reduced.h5p'
+        with h5py.File(fname, 'r') as fh:
+            np_local = fh['Step#' + str(ct)]['np_local'][:]
+        assert np.array_equal(np_local, np.bincount(mpi_rank, minlength=ncpu))
+    finally:
+        shutil.rmtree(root_path)
 
 
 if __name__ == "__main__":
@@ -200,9 +308,11 @@ if __name__ == "__main__":
     pmin = [xmin, ymin, zmin]
     cts = range(4394, 16615, 13)
 
-    def processInput(ct):
-        print ct
-        sort_tracer_data(pic_info, pmin, meta_data, ct, 'electron', root_dir)
+    def processInput(ct, species):
+        print(ct, species)
+        sort_tracer_data(pic_info, pmin, meta_data, ct, species, root_dir)
 
     num_cores = multiprocessing.cpu_count()
-    Parallel(n_jobs=num_cores)(delayed(processInput)(ct) for ct in cts)
+    Parallel(n_jobs=num_cores)(delayed(processInput)(ct, species)
+                               for ct in cts
+                               for species in ['electron', 'ion'])
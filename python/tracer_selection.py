@@ -0,0 +1,235 @@
+"""
+Energy-band selection index of the tracer particles
+
+The index is built once from the time-major tracer steps and saved in one
+HDF5 file:
+    tindex: (nsteps, ) time indices of the steps
+    Step#<tindex>/gamma: Lorentz factors sorted in decreasing order
+    Step#<tindex>/q: tags of the sorted particles
+    Step#<tindex>/rows: rows of the sorted particles in the step
+    tags: (nptl, ) sorted tags of the particles at the first step
+    gamma_max: (nptl, ) maximum Lorentz factor over all steps
+    tindex_max: (nptl, ) time index of the maximum
+    gamma_final: (nptl, ) Lorentz factor at the last step where the
+        particle is present
+Top-N, percentile, band and threshold-crossing queries only read the
+index, not the tracer data. The Lorentz factor is the 'gamma' dataset of a
+step when there is one and is computed from U otherwise. Ties are ordered
+by decreasing tag and row. Particles with q = 0 (missing data) are not
+indexed unless keep_zero_tags is set, which keeps the rows of a step
+aligned with the step data. The run summaries only cover the particles
+with nonzero tags of the first step.
+"""
+from __future__ import print_function
+
+import multiprocessing
+import os
+
+import h5py
+import numpy as np
+from joblib import delayed
+
+from parallel_functions import bounded_parallel
+
+
+def read_step_gamma(fname, gname, keep_zero_tags=False):
+    """Read one step and sort its particles by decreasing Lorentz factor
+
+    Args:
+        fname: file name of the step
+        gname: group name of the step
+        keep_zero_tags: whether to keep the particles with q = 0
+
+    Returns:
+        gamma: sorted Lorentz factors
+        qtag: tags of the sorted particles
+        rows: rows of the sorted particles in the step
+    """
+    with h5py.File(fname, 'r') as fh:
+        group = fh[gname]
+        qtag = group['q'][:]
+        if 'gamma' in group:
+            gamma = group['gamma'][:]
+        else:
+            gamma = np.sqrt(1 + group['Ux'][:].astype(np.float64)**2 +
+                            group['Uy'][:]**2 + group['Uz'][:]**2)
+            gamma = gamma.astype(np.float32)
+    if keep_zero_tags:
+        rows = np.arange(len(qtag))
+    else:
+        rows, = np.nonzero(qtag)
+    # decreasing gamma, then decreasing tag and row
+    order = np.lexsort((rows, qtag[rows], gamma[rows]))[::-1]
+    rows = rows[order]
+    return gamma[rows], qtag[rows], rows
+
+
+def build_selection_index(steps, fname_index, keep_zero_tags=False,
+                          ncores=None):
+    """Build the selection index
+
+    Args:
+        steps: list of (file name, group name, time index) in time order
+        fname_index: file name of the index
+        keep_zero_tags: whether to keep the particles with q = 0
+        ncores: number of processes
+    """
+    if ncores is None:
+        ncores = multiprocessing.cpu_count()
+    with h5py.File(fname_index, 'w') as fh:
+        fh.create_dataset('tindex', data=[step[2] for step in steps])
+        fh.attrs['keep_zero_tags'] = keep_zero_tags
+        tags = None
+        res = bounded_parallel(
+            (delayed(read_step_gamma)(fname, gname, keep_zero_tags)
+             for fname, gname, _ in steps), ncores)
+        for (_, _, tindex), (gamma, qtag, rows) in zip(steps, res):
+            print("Time index: %d" % tindex)
+            if tags is None:
+                tags = np.sort(qtag[qtag != 0])
+                gamma_max = np.zeros(len(tags), dtype=np.float32)
+                tindex_max = np.full(len(tags), tindex, dtype=np.int64)
+                gamma_final = np.zeros(len(tags), dtype=np.float32)
+            grp = fh.create_group('Step#' + str(tindex))
+            grp.create_dataset('gamma', data=gamma)
+            grp.create_dataset('q', data=qtag)
+            grp.create_dataset('rows', data=rows)
+            pos = np.searchsorted(tags, qtag)
+            pos_clip = np.minimum(pos, len(tags) - 1)
+            found = tags[pos_clip] == qtag
+            pos = pos_clip[found]
+            gamma_step = gamma[found]
+            cond = gamma_step > gamma_max[pos]
+            gamma_max[pos[cond]] = gamma_step[cond]
+            tindex_max[pos[cond]] = tindex
+            gamma_final[pos] = gamma_step
+        fh.create_dataset('tags', data=tags)
+        fh.create_dataset('gamma_max', data=gamma_max)
+        fh.create_dataset('tindex_max', data=tindex_max)
+        fh.create_dataset('gamma_final', data=gamma_final)
+
+
+def open_selection_index(steps, fname_index, keep_zero_tags=False,
+                         ncores=None):
+    """Open the selection index, built first when it is missing or when it
+    does not match the steps
+
+    Returns:
+        selection: TracerSelection
+    """
+    current = False
+    if os.path.isfile(fname_index):
+        with h5py.File(fname_index, 'r') as fh:
+            current = (fh.attrs.get('keep_zero_tags', False) == keep_zero_tags
+                       and np.array_equal(fh['tindex'][:],
+                                          [step[2] for step in steps]))
+    if not current:
+        build_selection_index(steps, fname_index, keep_zero_tags, ncores)
+    return TracerSelection(fname_index)
+
+
+class TracerSelection(object):
+    def __init__(self, fname_index):
+        """
+        Args:
+            fname_index: file name of the selection index
+        """
+        self.fh = h5py.File(fname_index, 'r')
+        self.tindices = self.fh['tindex'][:]
+        self.tags = self.fh['tags'][:]
+        self.gamma_max = self.fh['gamma_max'][:]
+        self.tindex_max = self.fh['tindex_max'][:]
+        self.gamma_final = self.fh['gamma_final'][:]
+
+    def close(self):
+        self.fh.close()
+
+    def step(self, tindex):
+        """Sorted Lorentz factors, tags and rows at one step
+        """
+        grp = self.fh['Step#' + str(tindex)]
+        return grp['gamma'][:], grp['q'][:], grp['rows'][:]
+
+    def summary(self, key):
+        """Per-particle summary: 'max' or 'final' Lorentz factor
+        """
+        if key == 'max':
+            return self.gamma_max
+        elif key == 'final':
+            return self.gamma_final
+        raise ValueError("Unknown summary: %s" % key)
+
+    def top_n(self, n, tindex=None, key='final'):
+        """Tags of the n most energetic particles
+
+        Args:
+            n: number of particles
+            tindex: time index of the step. The per-particle summary is
+                used when it is None.
+            key: 'max' or 'final' summary
+
+        Returns:
+            tags: tags in decreasing energy order
+            gamma: their Lorentz factors
+        """
+        if tindex is not None:
+            grp = self.fh['Step#' + str(tindex)]
+            return grp['q'][:n], grp['gamma'][:n]
+        gamma = self.summary(key)
+        order = np.argsort(-gamma, kind='stable')[:n]
+        return self.tags[order], gamma[order]
+
+    def band(self, gamma_min, gamma_max, tindex=None, key='final'):
+        """Tags of the particles with gamma_min <= gamma < gamma_max
+        """
+        if tindex is not None:
+            gamma, qtag, _ = self.step(tindex)
+            # gamma is in decreasing order
+            ie = np.searchsorted(-gamma, -gamma_min, side='right')
+            ib = np.searchsorted(-gamma, -gamma_max, side='right')
+            return qtag[ib:ie]
+        gamma = self.summary(key)
+        cond = np.logical_and(gamma >= gamma_min, gamma < gamma_max)
+        return self.tags[cond]
+
+    def percentile(self, percent, tindex=None, key='final'):
+        """Tags of the particles above a percentile of the Lorentz factor
+
+        Args:
+            percent: percentile in [0, 100], e.g. 99 for the top 1%
+        """
+        if tindex is not None:
+            gamma, qtag, _ = self.step(tindex)
+            n = int(round(len(gamma) * (100 - percent) / 100.0))
+            return qtag[:n]
+        gamma = self.summary(key)
+        return self.tags[gamma >= np.percentile(gamma, percent)]
+
+    def threshold(self, gamma_th, tindex=None, key='final'):
+        """Tags of the particles with Lorentz factor >= gamma_th
+        """
+        return self.band(gamma_th, np.inf, tindex, key)
+
+    def first_crossing(self, gamma_th):
+        """Time index when each particle first reaches gamma_th
+
+        Returns:
+            tags: tags of the particles that reach gamma_th
+            tcross: time indices of the first crossings
+        """
+        cand = self.gamma_max >= gamma_th
+        tags = self.tags[cand]
+        tcross = np.full(len(tags), -1, dtype=np.int64)
+        if len(tags) == 0:
+            return tags, tcross
+        for tindex in self.tindices:
+            qtag = self.threshold(gamma_th, tindex)
+            pos = np.searchsorted(tags, qtag)
+            pos_clip = np.minimum(pos, len(tags) - 1)
+            found = np.logical_and(pos < len(tags), tags[pos_clip] == qtag)
+            pos = pos_clip[found]
+            pos = pos[tcross[pos] < 0]
+            tcross[pos] = tindex
+            if np.all(tcross >= 0):
+                break
+        return tags, tcross
@@ -0,0 +1,215 @@
+"""
+Parallel streaming of tracer steps
+
+Worker processes read the requested columns of the tracer steps into a
+ring of shared-memory slots, and the consumer gets the steps back in time
+order. While the consumer works on one step, the workers are already
+reading the following ones, so the per-particle accumulations are not
+waiting for the file system. A step is a (file name, group name, ...)
+tuple, and all steps must have the same number of particles.
+"""
+from __future__ import print_function
+
+import multiprocessing
+import traceback
+from multiprocessing import shared_memory
+
+import h5py
+import numpy as np
+
+import tracer_codec
+
+
+def tracer_steps(tracer_dir, tindices_file, nsteps_file, tracer_interval,
+                 file_name, tmax=None):
+    """List the steps of time-major tracer files in time order
+
+    Args:
+        tracer_dir: directory including the T.* directories
+        tindices_file: time indices of the T.* directories, sorted
+        nsteps_file: number of steps in each file
+        tracer_interval: time index interval between two steps
+        file_name: file name in each T.* directory,
+            e.g. 'electron_tracer_qtag_sorted.h5p'
+        tmax: the last time index
+
+    Returns:
+        steps: list of (file name, group name, time index)
+    """
+    steps = []
+    for tindex_file in tindices_file:
+        fname = tracer_dir + 'T.' + str(tindex_file) + '/' + file_name
+        for istep in range(nsteps_file):
+            tindex = tindex_file + istep * tracer_interval
+            if tmax is not None and tindex > tmax:
+                break
+            steps.append((fname, 'Step#' + str(tindex), tindex))
+    return steps
+
+
+def sorted_tracer_steps(tracer_dir, sname, nframes, nsteps, tracer_interval):
+    """List the steps of the <sname>_tracer_qtag_sorted.h5p files
+
+    The files are in T.<tframe * nsteps * tracer_interval>, and the steps
+    of one file stop at its first missing step.
+
+    Args:
+        tracer_dir: directory including the T.* directories
+        sname: species name in the file names, e.g. 'electron'
+        nframes: number of files
+        nsteps: number of steps in each file
+        tracer_interval: time index interval between two steps
+
+    Returns:
+        steps: list of (file name, group name, time index)
+    """
+    steps = []
+    for tframe in range(nframes):
+        tindex0 = tframe * tracer_interval * nsteps
+        fname = (tracer_dir + 'T.' + str(tindex0) + '/' +
+                 sname + '_tracer_qtag_sorted.h5p')
+        with h5py.File(fname, 'r') as fh:
+            for step in range(nsteps):
+                tindex = step * tracer_interval + tindex0
+                gname = 'Step#' + str(tindex)
+                if gname not in fh:
+                    break
+                steps.append((fname, gname, tindex))
+    return steps
+
+
+def slot_layout(varnames, dtypes, nptl):
+    """Offsets of the columns in one shared-memory slot
+
+    Returns:
+        layout: list of (variable, dtype, offset)
+        slot_bytes: size of one slot
+    """
+    layout = []
+    offset = 0
+    for var in varnames:
+        dtype = np.dtype(dtypes[var])
+        offset = (offset + 7) // 8 * 8  # 8-byte alignment
+        layout.append((var, dtype.str, offset))
+        offset += dtype.itemsize * nptl
+    slot_bytes = (offset + 7) // 8 * 8
+    return layout, slot_bytes
+
+
+def slot_arrays(buf, islot, layout, slot_bytes, nptl):
+    """Arrays of the columns in one shared-memory slot
+    """
+    ptl = {}
+    for var, dtype, offset in layout:
+        ptl[var] = np.ndarray((nptl, ), dtype=dtype, buffer=buf,
+                              offset=islot * slot_bytes + offset)
+    return ptl
+
+
+def stream_worker(task_queue, done_queue, shm_name, layout, slot_bytes,
+                  pslice):
+    """Read tracer steps into shared-memory slots until told to stop
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    ps, pe = pslice
+    nptl = pe - ps
+    try:
+        while True:
+            task = task_queue.get()
+            if task is None:
+                break
+            istep, islot, fname, gname = task
+            try:
+                ptl = slot_arrays(shm.buf, islot, layout, slot_bytes, nptl)
+                with h5py.File(fname, 'r') as fh:
+                    for var in ptl:
+                        tracer_codec.read_dataset(fh, gname + '/' + var,
+                                                  ptl[var], np.s_[ps:pe])
+                del ptl
+                done_queue.put((istep, islot, None))
+            except Exception:
+                done_queue.put((istep, islot, traceback.format_exc()))
+    finally:
+        shm.close()
+
+
+def stream_tracer_steps(steps, varnames, pslice=None, nworkers=None,
+                        nslots=None):
+    """Stream the columns of tracer steps in time order
+
+    Args:
+        steps: list of (file name, group name, ...) in time order
+        varnames: columns to read, e.g. ['Ux', 'Uy', 'Uz']
+        pslice: [start, end) of the particles to read. All particles
+            when it is None.
+        nworkers: number of reading processes
+        nslots: number of shared-memory slots. Workers can read up to
+            nslots - 1 steps ahead of the consumer.
+
+    Yields:
+        istep: index of the step in steps
+        ptl: dictionary of (nptl, ) arrays. They are views into shared
+            memory and are only valid until the next step is requested;
+            copy them to keep them.
+    """
+    if not steps:
+        return
+    if nworkers is None:
+        nworkers = max(1, multiprocessing.cpu_count() - 1)
+    if nslots is None:
+        nslots = 2 * nworkers
+    nslots = min(nslots, len(steps))
+    with h5py.File(steps[0][0], 'r') as fh:
+        group = fh[steps[0][1]]
+        nptl_tot, = group[varnames[0]].shape
+        # encoded datasets keep the original data type as an attribute
+        dtypes = {var: group[var].attrs.get('dtype', group[var].dtype)
+                  for var in varnames}
+    if pslice is None:
+        pslice = (0, nptl_tot)
+    nptl = pslice[1] - pslice[0]
+    layout, slot_bytes = slot_layout(varnames, dtypes, nptl)
+    shm = shared_memory.SharedMemory(create=True,
+                                     size=max(1, slot_bytes * nslots))
+    task_queue = multiprocessing.Queue()
+    done_queue = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=stream_worker,
+                                       args=(task_queue, done_queue, shm.name,
+                                             layout, slot_bytes, pslice))
+               for _ in range(nworkers)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    try:
+        for istep in range(nslots):
+            task_queue.put((istep, istep, steps[istep][0], steps[istep][1]))
+        arrived = {}
+        for istep in range(len(steps)):
+            while istep not in arrived:
+                iarrived, islot, error = done_queue.get()
+                if error is not None:
+                    raise RuntimeError("Failed to read %s/%s:\n%s" %
+                                       (steps[iarrived][0], steps[iarrived][1],
+                                        error))
+                arrived[iarrived] = islot
+            islot = arrived.pop(istep)
+            ptl = slot_arrays(shm.buf, islot, layout, slot_bytes, nptl)
+            yield istep, ptl
+            del ptl
+            # the slot is free again, so the next step can go into it
+            inext = istep + nslots
+            if inext < len(steps):
+                task_queue.put((inext, islot, steps[inext][0],
+                                steps[inext][1]))
+    finally:
+        for _ in workers:
+            task_queue.put(None)
+        for worker in workers:
+            worker.join(timeout=10)
+            if worker.is_alive():
+                worker.terminate()
+        try:
+            shm.close()
+        except BufferError:
+            pass  # the consumer still holds views of the last step
+        shm.unlink()
@@ -0,0 +1,142 @@
+"""
+Transpose particle-major tracer files into time-major H5Part files
+
+The input has one group per particle, each with one dataset per variable
+holding the whole trajectory. The output has one 'Step#' group per time
+step, each with one dataset per variable holding all particles. The data
+is moved in blocks of particles x blocks of steps, so the memory is
+bounded by the block size instead of the total data size. Blocks are read
+in parallel and written to chunked datasets by the parent process.
+"""
+from __future__ import print_function
+
+import multiprocessing
+
+import h5py
+import numpy as np
+from joblib import delayed
+from scipy.interpolate import interp1d
+
+from parallel_functions import bounded_parallel
+
+
+def read_block(fname, tags, ts, te, varnames, config):
+    """Read a block of particles and time steps from a particle-major file
+
+    Args:
+        fname: input file name
+        tags: particle tags (group names) of this block
+        ts, te: [ts, te) time steps of this block in the input file
+        varnames: variables to read
+        config: dictionary with optional
+            'dt': time interval between steps, for adding 't'
+            'pos_scale', 'pos_shift': [x, y, z] scales and shifts applied
+                to dX, dY and dZ
+            'tinterval', 'interp_kind': interpolation in time. It needs
+                all steps, so ts and te should cover the whole trajectory.
+
+    Returns:
+        ptl: dictionary of (nsteps, len(tags)) arrays
+    """
+    nptl = len(tags)
+    nt = te - ts
+    with h5py.File(fname, 'r') as fh:
+        group = fh[tags[0]]
+        ptl = {var: np.empty((nptl, nt), dtype=group[var].dtype)
+               for var in varnames}
+        for iptl, tag in enumerate(tags):
+            group = fh[tag]
+            for var in varnames:
+                group[var].read_direct(ptl[var], np.s_[ts:te],
+                                       np.s_[iptl, :])
+    # the transpose is done in memory on one block
+    for var in varnames:
+        ptl[var] = np.ascontiguousarray(ptl[var].T)
+    if 'gamma' not in ptl and 'Ux' in ptl:
+        ptl['gamma'] = np.sqrt(1 + ptl['Ux']**2 + ptl['Uy']**2 +
+                               ptl['Uz']**2)
+    if 't' not in ptl and 'dt' in config:
+        tsteps = np.arange(ts, te) * config['dt']
+        ptl['t'] = np.repeat(tsteps[:, np.newaxis], nptl, axis=1)
+    tinterval = config.get('tinterval', 1)
+    if tinterval > 1:
+        told = np.arange(nt)
+        tnew = np.linspace(0, nt - 1, (nt - 1) * tinterval + 1)
+        kind = config.get('interp_kind', 'linear')
+        for var in ptl:
+            f = interp1d(told, ptl[var], kind=kind, axis=0)
+            ptl[var] = f(tnew).astype(ptl[var].dtype)
+    if 'pos_scale' in config:
+        shift = config.get('pos_shift', [0, 0, 0])
+        for var, scale, pshift in zip(['dX', 'dY', 'dZ'],
+                                      config['pos_scale'], shift):
+            if var in ptl:
+                ptl[var] *= scale
+                ptl[var] += pshift
+    return ptl
+
+
+def get_trajectory_info(fh):
+    """Particle tags, number of time steps and variables of a tracer file
+    """
+    tags = list(fh.keys())
+    group = fh[tags[0]]
+    varnames = [str(var) for var in group]
+    ntf, = group[varnames[0]].shape
+    return tags, ntf, varnames
+
+
+def transpose_tracers(fname_in, fname_out, config=None, nptl_block=4096,
+                      mem_block=256 * 1024**2, ncores=None):
+    """Transpose a particle-major tracer file into a time-major file
+
+    Args:
+        fname_in: particle-major input file
+        fname_out: time-major output file
+        config: dictionary passed to read_block
+        nptl_block: number of particles in one block. It is also the chunk
+            size of the output datasets.
+        mem_block: approximate memory of one block in bytes
+        ncores: number of processes
+    """
+    if config is None:
+        config = {}
+    if ncores is None:
+        ncores = multiprocessing.cpu_count()
+    with h5py.File(fname_in, 'r') as fh:
+        tags, ntf, varnames = get_trajectory_info(fh)
+    nptl = len(tags)
+    nptl_block = min(nptl_block, nptl)
+    tinterval = config.get('tinterval', 1)
+    ntf_out = (ntf - 1) * tinterval + 1
+
+    # a dry run on one particle gives the output variables
+    ptl = read_block(fname_in, tags[:1], 0, ntf, varnames, config)
+    dtypes = {var: ptl[var].dtype for var in ptl}
+    if tinterval > 1:
+        nstep_block = ntf  # interpolation needs the whole trajectory
+    else:
+        nbytes = sum(dtypes[var].itemsize for var in dtypes)
+        nstep_block = max(1, min(ntf, mem_block // (nbytes * nptl_block)))
+    blocks = [(ps, min(ps + nptl_block, nptl), ts, min(ts + nstep_block, ntf))
+              for ts in range(0, ntf, nstep_block)
+              for ps in range(0, nptl, nptl_block)]
+
+    with h5py.File(fname_out, 'w') as fh_out:
+        for tindex in range(ntf_out):
+            grp = fh_out.create_group('Step#' + str(tindex))
+            for var in dtypes:
+                grp.create_dataset(var, (nptl, ), dtype=dtypes[var],
+                                   chunks=(nptl_block, ))
+        res = bounded_parallel(
+            (delayed(read_block)(fname_in, tags[ps:pe], ts, te, varnames,
+                                 config)
+             for ps, pe, ts, te in blocks), ncores)
+        for iblock, ((ps, pe, ts, te), ptl) in enumerate(zip(blocks, res)):
+            print("Block %d of %d" % (iblock, len(blocks)))
+            ts_out = ts * tinterval
+            nt_out = ptl[varnames[0]].shape[0]
+            for it in range(nt_out):
+                grp = fh_out['Step#' + str(ts_out + it)]
+                for var in ptl:
+                    grp[var][ps:pe] = ptl[var][it]
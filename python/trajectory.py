@@ -22,6 +22,7 @@ import color_maps as cm
 import colormap.colormaps as cmaps
 import palettable
 import pic_information
+import tracer_periodic
 from contour_plots import plot_2d_contour, read_2d_fields
 
 rc('font', **{'family': 'serif', 'serif': ['Computer Modern']})
@@ -49,29 +50,7 @@ def adjust_pos(pos, length):
         pos: the position along one axis
         length: the box size along that axis
     """
-    crossings = []
-    offsets = []
-    offset = 0
-    nt, = pos.shape
-    pos_b = np.zeros(nt)
-    pos_b = np.copy(pos)
-    for i in range(nt - 1):
-        if (pos[i] - pos[i + 1] > 0.1 * length):
-            crossings.append(i)
-            offset += length
-            offsets.append(offset)
-        if (pos[i] - pos[i + 1] < -0.1 * length):
-            crossings.append(i)
-            offset -= length
-            offsets.append(offset)
-    nc = len(crossings)
-    if nc > 0:
-        crossings = np.asarray(crossings)
-        offsets = np.asarray(offsets)
-        for i in range(nc - 1):
-            pos_b[crossings[i] + 1:crossings[i + 1] + 1] += offsets[i]
-        pos_b[crossings[nc - 1] + 1:] += offsets[nc - 1]
-    return pos_b
+    return tracer_periodic.unwrap_positions(pos, length)
 
 
 class Viewer2d(object):
@@ -20,6 +20,7 @@ from scipy.interpolate import interp1d
 
 import fitting_funcs
 import pic_information
+import tracer_transpose
 from contour_plots import read_2d_fields
 from joblib import Parallel, delayed
 from json_functions import read_data_from_json
@@ -90,8 +91,9 @@ def read_particle_data(iptl, particle_tags, pic_info, fh):
 def transfer_to_h5part(plot_config):
     """Transfer current HDF5 file to H5Part format
 
-    All particles at the same time step are stored in the same time step
-
+    All particles at the same time step are stored in the same time step.
+    The data is transposed in blocks, so the memory does not scale with
+    the total size of the trajectories.
     """
     pic_run = plot_config["pic_run"]
     pic_run_dir = plot_config["pic_run_dir"]
@@ -104,94 +106,11 @@ def transfer_to_h5part(plot_config):
     pic_info = read_data_from_json(picinfo_fname)
     fpath_traj = pic_run_dir + traj_dir + '/'
     fname = fpath_traj + species + 's.h5p'
-    fh_in = h5py.File(fname, 'r')
-    particle_tags = list(fh_in.keys())
-    nptl = len(particle_tags)
-    ptl, ntf = read_particle_data(0, particle_tags, pic_info, fh_in)
-    Ux = np.zeros(ntf * nptl, dtype=ptl['Ux'].dtype)
-    Uy = np.zeros(ntf * nptl, dtype=ptl['Uy'].dtype)
-    Uz = np.zeros(ntf * nptl, dtype=ptl['Uz'].dtype)
-    dX = np.zeros(ntf * nptl, dtype=ptl['dX'].dtype)
-    dY = np.zeros(ntf * nptl, dtype=ptl['dY'].dtype)
-    dZ = np.zeros(ntf * nptl, dtype=ptl['dZ'].dtype)
-    i = np.zeros(ntf * nptl, dtype=ptl['i'].dtype)
-    q = np.zeros(ntf * nptl, dtype=ptl['q'].dtype)
-    gamma = np.zeros(ntf * nptl, dtype=ptl['gamma'].dtype)
-    t = np.zeros(ntf * nptl, dtype=ptl['t'].dtype)
-    if 'Bx' in ptl:
-        Bx = np.zeros(ntf * nptl, dtype=ptl['Bx'].dtype)
-        By = np.zeros(ntf * nptl, dtype=ptl['By'].dtype)
-        Bz = np.zeros(ntf * nptl, dtype=ptl['Bz'].dtype)
-        Ex = np.zeros(ntf * nptl, dtype=ptl['Ex'].dtype)
-        Ey = np.zeros(ntf * nptl, dtype=ptl['Ey'].dtype)
-        Ez = np.zeros(ntf * nptl, dtype=ptl['Ez'].dtype)
-    if 'Vx' in ptl:
-        Vx = np.zeros(ntf * nptl, dtype=ptl['Vx'].dtype)
-        Vy = np.zeros(ntf * nptl, dtype=ptl['Vy'].dtype)
-        Vz = np.zeros(ntf * nptl, dtype=ptl['Vz'].dtype)
-        ne = np.zeros(ntf * nptl, dtype=ptl['ne'].dtype)
-        ni = np.zeros(ntf * nptl, dtype=ptl['ni'].dtype)
-
-    # Read all particle data
-    for iptl in range(nptl):
-        ptl, ntf = read_particle_data(iptl, particle_tags, pic_info, fh_in)
-        Ux[iptl::nptl] = ptl['Ux']
-        Uy[iptl::nptl] = ptl['Uy']
-        Uz[iptl::nptl] = ptl['Uz']
-        dX[iptl::nptl] = ptl['dX']
-        dY[iptl::nptl] = ptl['dY']
-        dZ[iptl::nptl] = ptl['dZ']
-        i[iptl::nptl] = ptl['i']
-        q[iptl::nptl] = ptl['q']
-        gamma[iptl::nptl] = ptl['gamma']
-        t[iptl::nptl] = ptl['t']
-        if 'Bx' in ptl:
-            Bx[iptl::nptl] = ptl['Bx']
-            By[iptl::nptl] = ptl['By']
-            Bz[iptl::nptl] = ptl['Bz']
-            Ex[iptl::nptl] = ptl['Ex']
-            Ey[iptl::nptl] = ptl['Ey']
-            Ez[iptl::nptl] = ptl['Ez']
-        if 'Vx' in ptl:
-            Vx[iptl::nptl] = ptl['Vx']
-            Vy[iptl::nptl] = ptl['Vy']
-            Vz[iptl::nptl] = ptl['Vz']
-            ne[iptl::nptl] = ptl['ne']
-            ni[iptl::nptl] = ptl['ni']
-
-    fh_in.close()
-
     fname_out = fpath_traj + species + 's.h5part'
-    fh_out = h5py.File(fname_out, 'w')
-
-    for tindex in range(0, ntf):
-        grp = fh_out.create_group('Step#' + str(tindex))
-        es, ee = tindex * nptl, (tindex + 1) * nptl
-        grp.create_dataset('Ux', (nptl, ), data=Ux[es:ee])
-        grp.create_dataset('Uy', (nptl, ), data=Uy[es:ee])
-        grp.create_dataset('Uz', (nptl, ), data=Uz[es:ee])
-        grp.create_dataset('dX', (nptl, ), data=dX[es:ee])
-        grp.create_dataset('dY', (nptl, ), data=dY[es:ee])
-        grp.create_dataset('dZ', (nptl, ), data=dZ[es:ee])
-        grp.create_dataset('i', (nptl, ), data=i[es:ee])
-        grp.create_dataset('q', (nptl, ), data=q[es:ee])
-        grp.create_dataset('gamma', (nptl, ), data=gamma[es:ee])
-        grp.create_dataset('t', (nptl, ), data=t[es:ee])
-        if 'Bx' in ptl:
-            grp.create_dataset('Bx', (nptl, ), data=Bx[es:ee])
-            grp.create_dataset('By', (nptl, ), data=By[es:ee])
-            grp.create_dataset('Bz', (nptl, ), data=Bz[es:ee])
-            grp.create_dataset('Ex', (nptl, ), data=Ex[es:ee])
-            grp.create_dataset('Ey', (nptl, ), data=Ey[es:ee])
-            grp.create_dataset('Ez', (nptl, ), data=Ez[es:ee])
-        if 'Vx' in ptl:
-            grp.create_dataset('Vx', (nptl, ), data=Vx[es:ee])
-            grp.create_dataset('Vy', (nptl, ), data=Vy[es:ee])
-            grp.create_dataset('Vz', (nptl, ), data=Vz[es:ee])
-            grp.create_dataset('ne', (nptl, ), data=ne[es:ee])
-            grp.create_dataset('ni', (nptl, ), data=ni[es:ee])
-
-    fh_out.close()
+    smime = math.sqrt(pic_info.mime)
+    config = {"dt": pic_info.dt_fields * pic_info.dtwpe / pic_info.dtwci,
+              "pos_scale": [1.0 / smime] * 3}
+    tracer_transpose.transpose_tracers(fname, fname_out, config)
 
 
 def particle_trajectory(plot_config):
@@ -21,6 +21,7 @@ from scipy.optimize import curve_fit
 
 import fitting_funcs
 import pic_information
+import tracer_stream
 from contour_plots import read_2d_fields
 from joblib import Parallel, delayed
 from json_functions import read_data_from_json
@@ -248,176 +249,165 @@ def cumulative_energization(plot_config, show_plot=True):
         fdir += 'all/'
     mkdir_p(fdir)
 
-    for tframe in range(nframes):
-        print("Time frame %d of %d" % (tframe, nframes))
-        tindex0 = tframe * pic_info.tracer_interval * plot_config["nsteps"]
-        fname = (tracer_dir + 'T.' + str(tindex0) + '/' +
-                 sname + '_tracer_qtag_sorted.h5p')
-        fh = h5py.File(fname, 'r')
-        for step in range(plot_config["nsteps"]):
-            tindex = step * pic_info.tracer_interval + tindex0
-            print("Time index: %d" % tindex)
-            gname = 'Step#' + str(tindex)
-            if not gname in fh:
-                break
-            group = fh[gname]
-            ptl = {}
-            for dset in group:
-                dset = str(dset)
-                ptl[str(dset)] = read_var(group, dset, nptl)
-            ux = ptl["Ux"]
-            uy = ptl["Uy"]
-            uz = ptl["Uz"]
-            gamma = np.sqrt(1.0 + ux**2 + uy**2 + uz**2)
-            dgamma = gamma - gamma0
-            ib2 = 1.0 / (ptl["Bx"]**2 + ptl["By"]**2 + ptl["Bz"]**2)
-            edotb = ptl["Ex"] * ptl["Bx"] + ptl["Ey"] * ptl["By"] + ptl["Ez"] * ptl["Bz"]
-            eparax = edotb * ptl["Bx"] * ib2
-            eparay = edotb * ptl["By"] * ib2
-            eparaz = edotb * ptl["Bz"] * ib2
-            eperpx = ptl["Ex"] - eparax
-            eperpy = ptl["Ey"] - eparay
-            eperpz = ptl["Ez"] - eparaz
-            igamma = 1.0 / gamma
-            vx = ux * igamma
-            vy = uy * igamma
-            vz = uz * igamma
-            dene_para[0, :] += -vx * eparax
-            dene_para[1, :] += -vy * eparay
-            dene_para[2, :] += -vz * eparaz
-            dene_para[3, :] = np.sum(dene_para[:3, :], axis=0)
-            dene_perp[0, :] += -vx * eperpx
-            dene_perp[1, :] += -vy * eperpy
-            dene_perp[2, :] += -vz * eperpz
-            dene_perp[3, :] = np.sum(dene_perp[:3, :], axis=0)
-            dene_para *= dtwpe_tracer
-            dene_perp *= dtwpe_tracer
-            istep = tindex // pic_info.tracer_interval
-            if istep % plot_interval == 0 and istep != 0:
-                for para, ixyz in itertools.product(range(2), range(4)):
-                    if para:
-                        dene = dene_para[ixyz, :]
-                        comp = '\parallel'
-                        cname = 'para'
-                    else:
-                        dene = dene_perp[ixyz, :]
-                        comp = '\perp'
-                        cname = 'perp'
-                    fig = plt.figure(figsize=[10, 5])
-                    rect = [0.08, 0.12, 0.4, 0.8]
-                    hgap, vgap = 0.03, 0.03
-                    ax1 = fig.add_axes(rect)
-                    cond1 = dgamma > 0
-                    cond2 = dene < 0
-                    cond = np.logical_and(cond1, cond2)
-                    if plot_config["exclude_cs"]:
-                        cond = np.logical_and(cond, cond_exclude_cs)
-                    nptl_cond = len(dgamma[cond])
-                    hist, ubins_edges, ubins_edges = np.histogram2d(np.log10(dgamma[cond]),
-                                                                    np.log10(-dene[cond]),
-                                                                    bins=nbins, range=drange)
-                    hist1d_1, _ = np.histogram(-dene[cond2], bins=ebins)
-                    hist1d_2, _ = np.histogram(-dene[cond2], bins=ebins, weights=dgamma[cond2])
-                    dgamma_avg = div0(hist1d_2, hist1d_1)
-                    p1 = ax1.imshow(hist,
-                                    extent=[dgamma_min, dgamma_max, dene_min, dene_max],
-                                    norm = LogNorm(vmin=vmin, vmax=vmax),
-                                    cmap=plt.cm.viridis, aspect='auto',
-                                    origin='lower', interpolation='nearest')
-                    ax1.plot(np.log10(ebins_mid), np.log10(dgamma_avg), color=COLORS[0],
-                             label=r'$\left<\Delta\gamma\right>$')
-                    if ixyz < 3:
-                        xlabel = r'$\log(' + '|W_{' + comp + ',' + xyz[ixyz] + '}<0|' + ')$'
-                    else:
-                        xlabel = r'$\log(' + '|W_{' + comp + '}<0|' + ')$'
-                    ax1.plot([0, 4], [0, 4], color='k', linewidth=1, linestyle='--',
-                            label=r'$\Delta\gamma=$' + xlabel)
-                    ax1.plot([0, 4], [math.log10(sigma_e*0.5), math.log10(sigma_e*0.5)],
-                            color='k', linewidth=1, linestyle='-',
-                            label=r'$\Delta\gamma=\sigma_e/2$')
-                    ax1.legend(loc=1, prop={'size': 12}, ncol=1,
-                              shadow=False, fancybox=False, frameon=False)
-                    ax1.tick_params(bottom=True, top=True, left=True, right=True)
-                    ax1.tick_params(axis='x', which='minor', direction='in')
-                    ax1.tick_params(axis='x', which='major', direction='in')
-                    ax1.tick_params(axis='y', which='minor', direction='in')
-                    ax1.tick_params(axis='y', which='major', direction='in')
-                    ax1.set_xlim([4, 0])
-                    ax1.set_ylim([0, 4])
-                    ax1.set_xlabel(xlabel, fontsize=16)
-                    ax1.set_ylabel(r'$\log(\Delta\gamma)$', fontsize=16)
-                    ax1.tick_params(labelsize=12)
-
-                    rect[0] += rect[2] + hgap
-                    ax2 = fig.add_axes(rect)
-                    cond1 = dgamma > 0
-                    cond2 = dene > 0
-                    cond = np.logical_and(cond1, cond2)
-                    if plot_config["exclude_cs"]:
-                        cond = np.logical_and(cond, cond_exclude_cs)
-                    nptl_cond = len(dgamma[cond])
-                    hist, ubins_edges, ubins_edges = np.histogram2d(np.log10(dgamma[cond]),
-                                                                    np.log10(dene[cond]),
-                                                                    bins=nbins, range=drange)
-                    hist1d_1, _ = np.histogram(dene[cond2], bins=ebins)
-                    hist1d_2, _ = np.histogram(dene[cond2], bins=ebins, weights=dgamma[cond2])
-                    dgamma_avg = div0(hist1d_2, hist1d_1)
-                    p1 = ax2.imshow(hist,
-                                    extent=[dgamma_min, dgamma_max, dene_min, dene_max],
-                                    norm = LogNorm(vmin=vmin, vmax=vmax),
-                                    cmap=plt.cm.viridis, aspect='auto',
-                                    origin='lower', interpolation='nearest')
-                    ax2.plot(np.log10(ebins_mid), np.log10(dgamma_avg), color=COLORS[0],
-                             label=r'$\left<\Delta\gamma\right>$')
-                    if ixyz < 3:
-                        xlabel = r'$\log(' + '|W_{' + comp + ',' + xyz[ixyz] + '}>0|' + ')$'
-                    else:
-                        xlabel = r'$\log(' + '|W_{' + comp + '}>0|' + ')$'
-                    ax2.plot([0, 4], [0, 4], color='k', linewidth=1, linestyle='--',
-                            label=r'$\Delta\gamma=$' + xlabel)
-                    ax2.plot([0, 4], [math.log10(sigma_e*0.5), math.log10(sigma_e*0.5)],
-                            color='k', linewidth=1, linestyle='-',
-                            label=r'$\Delta\gamma=\sigma_e/2$')
-                    ax2.legend(loc=2, prop={'size': 12}, ncol=1,
-                              shadow=False, fancybox=False, frameon=False)
-                    ax2.tick_params(bottom=True, top=True, left=True, right=True)
-                    ax2.tick_params(axis='x', which='minor', direction='in')
-                    ax2.tick_params(axis='x', which='major', direction='in')
-                    ax2.tick_params(axis='y', which='minor', direction='in')
-                    ax2.tick_params(axis='y', which='major', direction='in')
-                    ax2.set_xlim([0, 4])
-                    ax2.set_ylim([0, 4])
-                    ax2.set_xlabel(xlabel, fontsize=16)
-                    ax2.tick_params(axis='y', labelleft=False)
-                    ax2.tick_params(labelsize=12)
-
-                    rect_cbar = np.copy(rect)
-                    rect_cbar[0] += rect[2] + 0.01
-                    rect_cbar[2] = 0.02
-                    cbar_ax = fig.add_axes(rect_cbar)
-                    cbar = fig.colorbar(p1, cax=cbar_ax, extend='both')
-                    cbar_ax.tick_params(bottom=False, top=False, left=False, right=True)
-                    cbar_ax.tick_params(axis='y', which='major', direction='out')
-                    cbar_ax.tick_params(axis='y', which='minor', direction='in', right=False)
-                    cbar_ax.set_title(r'$N_e$', fontsize=16)
-                    cbar.ax.tick_params(labelsize=12)
-                    twpe = math.ceil(tindex * pic_info.dtwpe / 0.1) * 0.1
-                    text1 = r'$t\omega_{pe}=' + ("{%0.0f}" % twpe) + '$'
-                    fig.suptitle(text1, fontsize=16)
-                    fname = fdir + 'hist_dw_' + cname + '_'
-                    if plot_config["exclude_cs"]:
-                        fname += 'nocs_'
-                    if ixyz < 3:
-                        fname += xyz[ixyz]
-                    else:
-                        fname += 'tot'
-                    fname += '_' + species + '_' + str(istep) + '.pdf'
-                    fig.savefig(fname)
-                    plt.close()
-                    # plt.show()
-            dene_para /= dtwpe_tracer
-            dene_perp /= dtwpe_tracer
-        fh.close()
+    steps = tracer_stream.sorted_tracer_steps(tracer_dir, sname, nframes,
+                                              plot_config["nsteps"],
+                                              pic_info.tracer_interval)
+    varnames = ["Ux", "Uy", "Uz", "Ex", "Ey", "Ez", "Bx", "By", "Bz"]
+    for istep_read, ptl in tracer_stream.stream_tracer_steps(steps, varnames):
+        tindex = steps[istep_read][2]
+        print("Time index: %d" % tindex)
+        ux = ptl["Ux"]
+        uy = ptl["Uy"]
+        uz = ptl["Uz"]
+        gamma = np.sqrt(1.0 + ux**2 + uy**2 + uz**2)
+        dgamma = gamma - gamma0
+        ib2 = 1.0 / (ptl["Bx"]**2 + ptl["By"]**2 + ptl["Bz"]**2)
+        edotb = ptl["Ex"] * ptl["Bx"] + ptl["Ey"] * ptl["By"] + ptl["Ez"] * ptl["Bz"]
+        eparax = edotb * ptl["Bx"] * ib2
+        eparay = edotb * ptl["By"] * ib2
+        eparaz = edotb * ptl["Bz"] * ib2
+        eperpx = ptl["Ex"] - eparax
+        eperpy = ptl["Ey"] - eparay
+        eperpz = ptl["Ez"] - eparaz
+        igamma = 1.0 / gamma
+        vx = ux * igamma
+        vy = uy * igamma
+        vz = uz * igamma
+        dene_para[0, :] += -vx * eparax
+        dene_para[1, :] += -vy * eparay
+        dene_para[2, :] += -vz * eparaz
+        dene_para[3, :] = np.sum(dene_para[:3, :], axis=0)
+        dene_perp[0, :] += -vx * eperpx
+        dene_perp[1, :] += -vy * eperpy
+        dene_perp[2, :] += -vz * eperpz
+        dene_perp[3, :] = np.sum(dene_perp[:3, :], axis=0)
+        dene_para *= dtwpe_tracer
+        dene_perp *= dtwpe_tracer
+        istep = tindex // pic_info.tracer_interval
+        if istep % plot_interval == 0 and istep != 0:
+            for para, ixyz in itertools.product(range(2), range(4)):
+                if para:
+                    dene = dene_para[ixyz, :]
+                    comp = '\parallel'
+                    cname = 'para'
+                else:
+                    dene = dene_perp[ixyz, :]
+                    comp = '\perp'
+                    cname = 'perp'
+                fig = plt.figure(figsize=[10, 5])
+                rect = [0.08, 0.12, 0.4, 0.8]
+                hgap, vgap = 0.03, 0.03
+                ax1 = fig.add_axes(rect)
+                cond1 = dgamma > 0
+                cond2 = dene < 0
+                cond = np.logical_and(cond1, cond2)
+                if plot_config["exclude_cs"]:
+                    cond = np.logical_and(cond, cond_exclude_cs)
+                nptl_cond = len(dgamma[cond])
+                hist, ubins_edges, ubins_edges = np.histogram2d(np.log10(dgamma[cond]),
+                                                                np.log10(-dene[cond]),
+                                                                bins=nbins, range=drange)
+                hist1d_1, _ = np.histogram(-dene[cond2], bins=ebins)
+                hist1d_2, _ = np.histogram(-dene[cond2], bins=ebins, weights=dgamma[cond2])
+                dgamma_avg = div0(hist1d_2, hist1d_1)
+                p1 = ax1.imshow(hist,
+                                extent=[dgamma_min, dgamma_max, dene_min, dene_max],
+                                norm = LogNorm(vmin=vmin, vmax=vmax),
+                                cmap=plt.cm.viridis, aspect='auto',
+                                origin='lower', interpolation='nearest')
+                ax1.plot(np.log10(ebins_mid), np.log10(dgamma_avg), color=COLORS[0],
+                         label=r'$\left<\Delta\gamma\right>$')
+                if ixyz < 3:
+                    xlabel = r'$\log(' + '|W_{' + comp + ',' + xyz[ixyz] + '}<0|' + ')$'
+                else:
+                    xlabel = r'$\log(' + '|W_{' + comp + '}<0|' + ')$'
+                ax1.plot([0, 4], [0, 4], color='k', linewidth=1, linestyle='--',
+                        label=r'$\Delta\gamma=$' + xlabel)
+                ax1.plot([0, 4], [math.log10(sigma_e*0.5), math.log10(sigma_e*0.5)],
+                        color='k', linewidth=1, linestyle='-',
+                        label=r'$\Delta\gamma=\sigma_e/2$')
+                ax1.legend(loc=1, prop={'size': 12}, ncol=1,
+                          shadow=False, fancybox=False, frameon=False)
+                ax1.tick_params(bottom=True, top=True, left=True, right=True)
+                ax1.tick_params(axis='x', which='minor', direction='in')
+                ax1.tick_params(axis='x', which='major', direction='in')
+                ax1.tick_params(axis='y', which='minor', direction='in')
+                ax1.tick_params(axis='y', which='major', direction='in')
+                ax1.set_xlim([4, 0])
+                ax1.set_ylim([0, 4])
+                ax1.set_xlabel(xlabel, fontsize=16)
+                ax1.set_ylabel(r'$\log(\Delta\gamma)$', fontsize=16)
+                ax1.tick_params(labelsize=12)
+
+                rect[0] += rect[2] + hgap
+                ax2 = fig.add_axes(rect)
+                cond1 = dgamma > 0
+                cond2 = dene > 0
+                cond = np.logical_and(cond1, cond2)
+                if plot_config["exclude_cs"]:
+                    cond = np.logical_and(cond, cond_exclude_cs)
+                nptl_cond = len(dgamma[cond])
+                hist, ubins_edges, ubins_edges = np.histogram2d(np.log10(dgamma[cond]),
+                                                                np.log10(dene[cond]),
+                                                                bins=nbins, range=drange)
+                hist1d_1, _ = np.histogram(dene[cond2], bins=ebins)
+                hist1d_2, _ = np.histogram(dene[cond2], bins=ebins, weights=dgamma[cond2])
+                dgamma_avg = div0(hist1d_2, hist1d_1)
+                p1 = ax2.imshow(hist,
+                                extent=[dgamma_min, dgamma_max, dene_min, dene_max],
+                                norm = LogNorm(vmin=vmin, vmax=vmax),
+                                cmap=plt.cm.viridis, aspect='auto',
+                                origin='lower', interpolation='nearest')
+                ax2.plot(np.log10(ebins_mid), np.log10(dgamma_avg), color=COLORS[0],
+                         label=r'$\left<\Delta\gamma\right>$')
+                if ixyz < 3:
+                    xlabel = r'$\log(' + '|W_{' + comp + ',' + xyz[ixyz] + '}>0|' + ')$'
+                else:
+                    xlabel = r'$\log(' + '|W_{' + comp + '}>0|' + ')$'
+                ax2.plot([0, 4], [0, 4], color='k', linewidth=1, linestyle='--',
+                        label=r'$\Delta\gamma=$' + xlabel)
+                ax2.plot([0, 4], [math.log10(sigma_e*0.5), math.log10(sigma_e*0.5)],
+                        color='k', linewidth=1, linestyle='-',
+                        label=r'$\Delta\gamma=\sigma_e/2$')
+                ax2.legend(loc=2, prop={'size': 12}, ncol=1,
+                          shadow=False, fancybox=False, frameon=False)
+                ax2.tick_params(bottom=True, top=True, left=True, right=True)
+                ax2.tick_params(axis='x', which='minor', direction='in')
+                ax2.tick_params(axis='x', which='major', direction='in')
+                ax2.tick_params(axis='y', which='minor', direction='in')
+                ax2.tick_params(axis='y', which='major', direction='in')
+                ax2.set_xlim([0, 4])
+                ax2.set_ylim([0, 4])
+                ax2.set_xlabel(xlabel, fontsize=16)
+                ax2.tick_params(axis='y', labelleft=False)
+                ax2.tick_params(labelsize=12)
+
+                rect_cbar = np.copy(rect)
+                rect_cbar[0] += rect[2] + 0.01
+                rect_cbar[2] = 0.02
+                cbar_ax = fig.add_axes(rect_cbar)
+                cbar = fig.colorbar(p1, cax=cbar_ax, extend='both')
+                cbar_ax.tick_params(bottom=False, top=False, left=False, right=True)
+                cbar_ax.tick_params(axis='y', which='major', direction='out')
+                cbar_ax.tick_params(axis='y', which='minor', direction='in', right=False)
+                cbar_ax.set_title(r'$N_e$', fontsize=16)
+                cbar.ax.tick_params(labelsize=12)
+                twpe = math.ceil(tindex * pic_info.dtwpe / 0.1) * 0.1
+                text1 = r'$t\omega_{pe}=' + ("{%0.0f}" % twpe) + '$'
+                fig.suptitle(text1, fontsize=16)
+                fname = fdir + 'hist_dw_' + cname + '_'
+                if plot_config["exclude_cs"]:
+                    fname += 'nocs_'
+                if ixyz < 3:
+                    fname += xyz[ixyz]
+                else:
+                    fname += 'tot'
+                fname += '_' + species + '_' + str(istep) + '.pdf'
+                fig.savefig(fname)
+                plt.close()
+                # plt.show()
+        dene_para /= dtwpe_tracer
+        dene_perp /= dtwpe_tracer
 
 
 def compare_dw_para_perp(plot_config, show_plot=True):
@@ -1090,77 +1080,66 @@ def calc_wpara_wperp(plot_config, show_plot=True):
         fdir += 'all/'
     mkdir_p(fdir)
 
-    for tframe in range(nframes):
-        print("Time frame %d of %d" % (tframe, nframes))
-        tindex0 = tframe * pic_info.tracer_interval * plot_config["nsteps"]
-        fname = (tracer_dir + 'T.' + str(tindex0) + '/' +
-                 sname + '_tracer_qtag_sorted.h5p')
-        fh = h5py.File(fname, 'r')
-        for step in range(plot_config["nsteps"]):
-            tindex = step * pic_info.tracer_interval + tindex0
-            print("Time index: %d" % tindex)
-            gname = 'Step#' + str(tindex)
-            if not gname in fh:
-                break
-            group = fh[gname]
-            ptl = {}
-            for dset in group:
-                dset = str(dset)
-                ptl[str(dset)] = read_var(group, dset, nptl)
-            ux = ptl["Ux"]
-            uy = ptl["Uy"]
-            uz = ptl["Uz"]
-            gamma = np.sqrt(1.0 + ux**2 + uy**2 + uz**2)
-            dgamma = gamma - gamma0
-            dgamma_pos = np.copy(dgamma)
-            ib2 = 1.0 / (ptl["Bx"]**2 + ptl["By"]**2 + ptl["Bz"]**2)
-            edotb = ptl["Ex"] * ptl["Bx"] + ptl["Ey"] * ptl["By"] + ptl["Ez"] * ptl["Bz"]
-            eparax = edotb * ptl["Bx"] * ib2
-            eparay = edotb * ptl["By"] * ib2
-            eparaz = edotb * ptl["Bz"] * ib2
-            eperpx = ptl["Ex"] - eparax
-            eperpy = ptl["Ey"] - eparay
-            eperpz = ptl["Ez"] - eparaz
-            igamma = 1.0 / gamma
-            vx = ux * igamma
-            vy = uy * igamma
-            vz = uz * igamma
-            dene_para[0, :] += -vx * eparax
-            dene_para[1, :] += -vy * eparay
-            dene_para[2, :] += -vz * eparaz
-            dene_para[3, :] = np.sum(dene_para[:3, :], axis=0)
-            dene_perp[0, :] += -vx * eperpx
-            dene_perp[1, :] += -vy * eperpy
-            dene_perp[2, :] += -vz * eperpz
-            dene_perp[3, :] = np.sum(dene_perp[:3, :], axis=0)
-            dene_para *= dtwpe_tracer
-            dene_perp *= dtwpe_tracer
-            cond = np.logical_and(dgamma_pre < 0.5 * sigma_e, dgamma_pos > 0.5 * sigma_e)
-            cond = np.logical_and(cond, np.logical_not(cross_half_sigmae))
-            if plot_config["exclude_cs"]:
-                cond = np.logical_and(cond, cond_exclude_cs)
-            dene_para_cross[:, cond] = dene_para[:, cond]
-            dene_perp_cross[:, cond] = dene_perp[:, cond]
-            dgamma_pre = np.copy(dgamma_pos)
-
-            istep = tindex // pic_info.tracer_interval
-            if istep % plot_interval == 0:
-                fname = fdir + 'wpara_cross_' + str(istep) + '.dat'
-                dene_para_cross.tofile(fname)
-                fname = fdir + 'wperp_cross_' + str(istep) + '.dat'
-                dene_perp_cross.tofile(fname)
-                fname = fdir + 'wpara_' + str(istep) + '.dat'
-                dene_para.tofile(fname)
-                fname = fdir + 'wperp_' + str(istep) + '.dat'
-                dene_perp.tofile(fname)
-                fdata = cross_half_sigmae.astype(int)
-                fname = fdir + 'cross_half_sigma_' + str(istep) + '.dat'
-                fdata.tofile(fname)
+    steps = tracer_stream.sorted_tracer_steps(tracer_dir, sname, nframes,
+                                              plot_config["nsteps"],
+                                              pic_info.tracer_interval)
+    varnames = ["Ux", "Uy", "Uz", "Ex", "Ey", "Ez", "Bx", "By", "Bz"]
+    for istep_read, ptl in tracer_stream.stream_tracer_steps(steps, varnames):
+        tindex = steps[istep_read][2]
+        print("Time index: %d" % tindex)
+        ux = ptl["Ux"]
+        uy = ptl["Uy"]
+        uz = ptl["Uz"]
+        gamma = np.sqrt(1.0 + ux**2 + uy**2 + uz**2)
+        dgamma = gamma - gamma0
+        dgamma_pos = np.copy(dgamma)
+        ib2 = 1.0 / (ptl["Bx"]**2 + ptl["By"]**2 + ptl["Bz"]**2)
+        edotb = ptl["Ex"] * ptl["Bx"] + ptl["Ey"] * ptl["By"] + ptl["Ez"] * ptl["Bz"]
+        eparax = edotb * ptl["Bx"] * ib2
+        eparay = edotb * ptl["By"] * ib2
+        eparaz = edotb * ptl["Bz"] * ib2
+        eperpx = ptl["Ex"] - eparax
+        eperpy = ptl["Ey"] - eparay
+        eperpz = ptl["Ez"] - eparaz
+        igamma = 1.0 / gamma
+        vx = ux * igamma
+        vy = uy * igamma
+        vz = uz * igamma
+        dene_para[0, :] += -vx * eparax
+        dene_para[1, :] += -vy * eparay
+        dene_para[2, :] += -vz * eparaz
+        dene_para[3, :] = np.sum(dene_para[:3, :], axis=0)
+        dene_perp[0, :] += -vx * eperpx
+        dene_perp[1, :] += -vy * eperpy
+        dene_perp[2, :] += -vz * eperpz
+        dene_perp[3, :] = np.sum(dene_perp[:3, :], axis=0)
+        dene_para *= dtwpe_tracer
+        dene_perp *= dtwpe_tracer
+        cond = np.logical_and(dgamma_pre < 0.5 * sigma_e, dgamma_pos > 0.5 * sigma_e)
+        cond = np.logical_and(cond, np.logical_not(cross_half_sigmae))
+        if plot_config["exclude_cs"]:
+            cond = np.logical_and(cond, cond_exclude_cs)
+        dene_para_cross[:, cond] = dene_para[:, cond]
+        dene_perp_cross[:, cond] = dene_perp[:, cond]
+        dgamma_pre = np.copy(dgamma_pos)
 
-            cross_half_sigmae = np.logical_or(cond, cross_half_sigmae)
-            dene_para /= dtwpe_tracer
-            dene_perp /= dtwpe_tracer
-        fh.close()
+        istep = tindex // pic_info.tracer_interval
+        if istep % plot_interval == 0:
+            fname = fdir + 'wpara_cross_' + str(istep) + '.dat'
+            dene_para_cross.tofile(fname)
+            fname = fdir + 'wperp_cross_' + str(istep) + '.dat'
+            dene_perp_cross.tofile(fname)
+            fname = fdir + 'wpara_' + str(istep) + '.dat'
+            dene_para.tofile(fname)
+            fname = fdir + 'wperp_' + str(istep) + '.dat'
+            dene_perp.tofile(fname)
+            fdata = cross_half_sigmae.astype(int)
+            fname = fdir + 'cross_half_sigma_' + str(istep) + '.dat'
+            fdata.tofile(fname)
+
+        cross_half_sigmae = np.logical_or(cond, cross_half_sigmae)
+        dene_para /= dtwpe_tracer
+        dene_perp /= dtwpe_tracer
 
 
 def plot_wpara_wperp(plot_config, show_plot=True):
@@ -0,0 +1,85 @@
+"""
+Interpolation of the Yee-staggered electric and magnetic fields to the
+grid nodes where the hydro quantities are
+
+On the Yee grid, the field components are shifted by half a cell from the
+nodes along
+    ex: x, ey: y, ez: z, bx: y and z, by: x and z, bz: x and y
+The value at node i along a shifted axis is the average of the values at
+i - 1/2 and i + 1/2, which are elements i - 1 and i of the data. Fields
+are float32 arrays of the shape (nz, nx) for 2D runs or (nz, ny, nx) for
+3D runs and are interpolated in place. At the lower boundary the value
+at i - 1/2 is taken from the other end of the box for periodic
+boundaries and is the value at i + 1/2 for conducting boundaries. The
+default is periodic along x and y and conducting along z, as in the
+reconnection runs.
+"""
+import numpy as np
+
+# periodic along x and y and conducting along z
+DEFAULT_PERIODIC = (True, True, False)
+
+STAGGER = {'ex': 'x', 'ey': 'y', 'ez': 'z',
+           'bx': 'yz', 'by': 'xz', 'bz': 'xy'}
+
+
+def half_average(fdata, axis, periodic=True, nchunk=64):
+    """Average the neighbours along one axis in place
+
+    Args:
+        fdata: field data
+        axis: the shifted axis
+        periodic: periodic (True) or conducting (False) boundary
+        nchunk: number of slices updated at a time. Only one chunk of the
+            data is buffered.
+    """
+    fdata = np.moveaxis(fdata, axis, 0)
+    nlen = fdata.shape[0]
+    if nlen < 2:
+        return
+    lower = fdata[-1].copy() if periodic else fdata[0].copy()
+    # update from the upper end, so the lower neighbours are still the
+    # original values
+    for ie in range(nlen, 1, -nchunk):
+        ib = max(ie - nchunk, 1)
+        fdata[ib:ie] += fdata[ib-1:ie-1]
+    fdata[0] += lower
+    fdata *= 0.5
+
+
+def field_axes(fdata):
+    """Array axes of x, y and z
+    """
+    if fdata.ndim == 2:
+        return {'x': 1, 'z': 0}
+    return {'x': 2, 'y': 1, 'z': 0}
+
+
+def interp_node(fdata, field_name, periodic=DEFAULT_PERIODIC):
+    """Interpolate one field component to the grid nodes in place
+
+    Args:
+        fdata: field data
+        field_name: 'ex', 'ey', 'ez', 'bx', 'by' or 'bz'. Names including
+            them, e.g. 'ex_original', are accepted.
+        periodic: boundary along x, y and z, periodic (True) or
+            conducting (False)
+
+    Returns:
+        fdata: the interpolated data, which shares the memory of the input
+    """
+    comp = [name for name in STAGGER if name in field_name][0]
+    axes = field_axes(fdata)
+    bcs = dict(zip(['x', 'y', 'z'], periodic))
+    for dim in STAGGER[comp]:
+        if dim in axes:
+            half_average(fdata, axes[dim], bcs[dim])
+    return fdata
+
+
+def interp_emf_node(emf, periodic=DEFAULT_PERIODIC):
+    """Interpolate all field components in a dictionary to the grid nodes
+    """
+    for field_name in emf:
+        interp_node(emf[field_name], field_name, periodic)
+    return emf